@@ -28,9 +28,9 @@ from PyQt5.Qt import QObject, QWidget, QHBoxLayout, QLabel, \
     QToolButton, Qt, QColor, QImage, QPixmap, QPainter, QGridLayout, QBrush, QTimer
 from PyQt5.Qwt import QwtSlider
 from PyQt5.QtCore import pyqtSignal
-from scipy.ndimage import measurements
 
 import TigGUI.kitties.utils
+from TigGUI.Images.Statistics import computeHistogram, computeStats
 
 _verbosity = TigGUI.kitties.utils.verbosity(name="colormap")
 dprint = _verbosity.dprint
@@ -39,6 +39,9 @@ dprintf = _verbosity.dprintf
 
 class IntensityMap:
     """An IntensityMap maps a float array into a 0...1 range."""
+    # True if remap() is linear in the data (within the data range), in which case images may be quantized in data
+    # space before the map is applied, see SkyImagePlotItem._quantizeTile()
+    linear = False
 
     def __init__(self, dmin=None, dmax=None):
         """Constructor. An optional data range may be supplied."""
@@ -53,6 +56,18 @@ class IntensityMap:
     def copy(self):
         return copy.copy(self)
 
+    def freeze(self):
+        """Computes up front any state that remap() would otherwise compute lazily, so that remap() does not modify
+        the map, and the map can be used from several threads at once (as long as nothing else modifies it, see
+        SkyImagePlotItem.setIntensityMap()). Returns self."""
+        return self
+
+    def renderState(self):
+        """Returns a hashable description of the mapping done by remap() on a frozen map: two maps with equal
+        states map any data identically. Note that a map without a data range normalizes to the data it is given,
+        so its state does not include the data."""
+        return type(self), getattr(self, 'range', None)
+
     def setDataRange(self, dmin, dmax):
         """Sets the data range."""
         self.range = dmin, dmax
@@ -68,7 +83,8 @@ class IntensityMap:
     def getDataRange(self, data):
         """Returns the set data range, or uses data min/max if it is not set"""
         # use data min/max if no explicit ranges are set
-        return self.range or measurements.extrema(data)[:2]
+        # (numpy.ma.getdata() would convert array-like objects such as SkyImage.ScaledData as a whole)
+        return self.range or computeStats(data.data if numpy.ma.isMA(data) else data, numpy.ma.getmask(data)).minMax()
 
     def remap(self, data):
         """Remaps data into 0...1 range"""
@@ -77,6 +93,7 @@ class IntensityMap:
 
 class LinearIntensityMap(IntensityMap):
     """This scales data linearly between preset min and max values."""
+    linear = True
 
     def remap(self, data):
         d0, d1 = self.getDataRange(data)
@@ -93,6 +110,9 @@ class LogIntensityMap(IntensityMap):
     def __init__(self, log_cycles=6):
         self.log_cycles = log_cycles
 
+    def renderState(self):
+        return IntensityMap.renderState(self) + (self.log_cycles,)
+
     def remap(self, data):
         # d0,d1 is current data range
         d0, d1 = self.getDataRange(data)
@@ -102,7 +122,7 @@ class LogIntensityMap(IntensityMap):
         data = data - d0
         dmin = dmax * (10 ** (-self.log_cycles))
         # clip data to between dmin and dmax, and take log
-        data = numpy.ma.log10(data.clip(dmin, dmax))
+        data = numpy.log10(data.clip(dmin, dmax))
         # now rescale
         return (data - math.log10(dmin)) / (math.log10(dmax) - math.log10(dmin))
 
@@ -122,6 +142,16 @@ class HistEqIntensityMap(IntensityMap):
         IntensityMap.setDataRange(self, *range)
         self._bins = None  # to recompute the CDF
 
+    def freeze(self):
+        if self._bins is None and self.subset is not None:
+            self._computeCDF(self.subset)
+        return self
+
+    def renderState(self):
+        # the CDF is computed from the data subset, so the state is the CDF itself
+        cdf = (self._cdf.tobytes(), self._bins.tobytes()) if self._bins is not None else None
+        return IntensityMap.renderState(self) + (self._nbins, cdf)
+
     def _computeCDF(self, data):
         """Recomputes the CDF using the current data subset and range"""
         dmin, dmax = self.getDataRange(self.subset if self.subset is not None else data)
@@ -130,7 +160,14 @@ class HistEqIntensityMap(IntensityMap):
         else:
             dprint(1, "computing CDF for range", dmin, dmax)
             # make cumulative histogram, normalize to 0...1
-            hist = measurements.histogram(self.subset if self.subset is not None else data, dmin, dmax, self._nbins)
+            subset = self.subset if self.subset is not None else data
+            if numpy.ma.isMA(subset):
+                values, mask = numpy.ravel(subset.data, order='K'), numpy.ravel(subset.mask, order='K')
+            else:
+                # (scaled data, see SkyImage.ScaledData, is raveled as such, and only scaled chunk by chunk)
+                values = subset.ravel(order='K') if hasattr(subset, 'ravel') else numpy.ravel(subset, order='K')
+                mask = None
+            hist = computeHistogram(values, mask, dmin, dmax, self._nbins)
             cdf = numpy.cumsum(hist)
             if not numpy.all(cdf == 0):
                 cdf = cdf / float(cdf[-1])
@@ -184,6 +221,8 @@ class Colormap(QObject):
         self._alpha_arg = numpy.arange(len(alpha)) / (len(alpha) - 1.0)
         # background brush
         self._brush = None
+        # lookup table, see lut()
+        self._lut = self._lut_params = None
 
     def makeQImage(self, width, height):
         data = numpy.zeros((width, height), float)
@@ -212,27 +251,67 @@ class Colormap(QObject):
     def makeBrush(self, width, height):
         return QBrush(self.makeQImage(width, height))
 
+    # number of entries in colormap lookup tables
+    LUTSize = 4096
+
+    def lutParameters(self):
+        """Returns the parameters that the colormap depends on, in some comparable form. When these change,
+        the lookup table is rebuilt (see lut()). Colormaps with adjustable parameters must reimplement this."""
+        return None
+
+    def makeLUT(self, values):
+        """Maps an array of normalized values (0...1) into colours, returning an array of packed 32-bit ARGB values.
+        This is used to build the lookup table, see lut()."""
+        alpha = numpy.interp(values, self._alpha_arg, self._alpha)
+        rgbs = [numpy.interp(values, self._rgb_arg, self._rgb[:, i]) for i in range(3)]
+        return self.packARGB(alpha, *rgbs)
+
+    @staticmethod
+    def packARGB(a, r, g, b):
+        """Packs 0...1 A,R,G,B arrays into an array of 32-bit ARGB values"""
+        a, r, g, b = [(numpy.round(255 * x).clip(0, 255)).astype(numpy.uint32) for x in (a, r, g, b)]
+        return (a << 24) | (r << 16) | (g << 8) | b
+
+    def lut(self):
+        """Returns the colormap lookup table: an array of LUTSize packed 32-bit ARGB values, evenly covering
+        the 0...1 range. The table is built on first use, and rebuilt whenever lutParameters() changes."""
+        params = self.lutParameters()
+        lut = self._lut
+        if lut is None or params != self._lut_params:
+            dprint(2, "building lookup table for colormap", self.name)
+            lut = self.makeLUT(numpy.arange(self.LUTSize) / (self.LUTSize - 1.0))
+            self._lut, self._lut_params = lut, params
+        return lut
+
+    def lookup(self, data):
+        """Converts normalized data (0...1) array into an array of packed 32-bit ARGB values, via the lookup table.
+        Masks are ignored. NaNs (i.e. undefined pixels) come out as the colour of 0.
+        The result is always in C order, even if data is not (e.g. is a transposed view)."""
+        lut = self.lut()
+        index = numpy.multiply(numpy.ma.getdata(data), len(lut) - 1, order='C')
+        index += 0.5
+        with numpy.errstate(invalid='ignore'):
+            index = index.astype(numpy.intp)
+        numpy.clip(index, 0, len(lut) - 1, out=index)
+        return lut[index]
+
     def colorize(self, data, alpha=None):
         """Converts normalized data (0...1) array into a QImage of the same dimensions.
         'alpha', if set, is a 0...1 array of the same size, which is mapped to the alpha channel
         (i.e. 0 for fully transparent and 1 for fully opaque).
         If data is a masked array, masked pixels will be fully transparent."""
-        # setup alpha channel
-        if alpha is None:
-            alpha = numpy.interp(data.ravel(), self._alpha_arg, self._alpha).reshape(data.shape)
-        alpha = numpy.round(255 * alpha).astype(numpy.int32).clip(0, 255)
-        # make RGB arrays
-        rgbs = [(numpy.interp(data.ravel(), self._rgb_arg, self._rgb[:, i]).
-                 reshape(data.shape) * 255).round().astype(numpy.int32).clip(0, 255)
-                for i in range(3)]
+        # data is in column-major order, while QImages are in row-major order, so look up the transposed array,
+        # which makes a row-major ARGB array directly
+        argb = self.lookup(data.T)
+        if alpha is not None:
+            argb &= 0xFFFFFF
+            argb |= (numpy.round(255 * alpha.T).clip(0, 255)).astype(numpy.uint32) << 24
         # add data mask
-        mask = getattr(data, 'mask', None)
-        if mask is not None and mask is not False:
-            alpha[mask] = 0
-            for x in rgbs:
-                x[mask] = 0
+        mask = numpy.ma.getmask(data)
+        if mask is not numpy.ma.nomask:
+            argb[mask.T] = 0
         # do the deed
-        return self.QARGBImage(alpha, *rgbs)
+        return self.QARGBImage(argb)
 
     def makeControlWidgets(self, parent):
         """Creates control widgets for the colormap's internal parameters.
@@ -241,15 +320,14 @@ class Colormap(QObject):
         return None
 
     class QARGBImage(QImage):
-        """This is a QImage which is constructed from an A,R,G,B arrays."""
+        """This is a QImage which wraps a [ny,nx] (i.e. row-major) array of 32-bit ARGB values without copying it."""
 
-        def __init__(self, a, r, g, b):
-            nx, ny = r.shape
-            argb = (a << 24) | (r << 16) | (g << 8) | b
-            # transpose array, as it is in column-major (C order), while QImages are in row-major order
+        def __init__(self, argb):
+            ny, nx = argb.shape
             dprint(5, "making qimage of size", nx, ny)
-            self._buffer = argb.transpose().tostring()
-            QImage.__init__(self, self._buffer, nx, ny, QImage.Format_ARGB32)
+            # hold a reference to the array, since the QImage uses its memory
+            self._buffer = numpy.ascontiguousarray(argb, numpy.uint32)
+            QImage.__init__(self, self._buffer.data, nx, ny, nx * 4, QImage.Format_ARGB32)
 
 
 class ColormapWithControls(Colormap):
@@ -351,35 +429,19 @@ class CubeHelixColormap(ColormapWithControls):
         self.cycles = self.SliderControl("Cycles", rots, -10, 10, .1)
         self.hue = self.SliderControl("Hue", hue, 0, 2, .1)
 
-    def colorize(self, data, alpha=None):
-        """Converts normalized data (0...1) array into a QImage of the same dimensions.
-        'alpha', if set, is a 0...1 array of the same size, which is mapped to the alpha channel
-        (i.e. 0 for fully transparent and 1 for fully opaque).
-        If data is a masked array, masked pixels will be fully transparent."""
-        # setup alpha channel
-        if alpha is None:
-            alpha = numpy.zeros(data.shape, dtype=numpy.int32)
-            alpha[...] = 255
-        else:
-            alpha = numpy.round(255 * alpha).astype(numpy.int32).clip(0, 255)
-        # make RGB arrays
-        dg = data ** self.gamma.value
+    def lutParameters(self):
+        return self.gamma.value, self.color.value, self.cycles.value, self.hue.value
+
+    def makeLUT(self, values):
+        dg = values ** self.gamma.value
         a = self.hue.value * dg * (1 - dg) / 2
-        phi = 2 * math.pi * (self.color.value / 3 + self.cycles.value * data)
+        phi = 2 * math.pi * (self.color.value / 3 + self.cycles.value * values)
         cosphi = a * numpy.cos(phi)
         sinphi = a * numpy.sin(phi)
         r = dg - 0.14861 * cosphi + 1.78277 * sinphi
         g = dg - 0.29227 * cosphi - 0.90649 * sinphi
         b = dg + 1.97249 * cosphi
-        rgbs = [(x * 255).round().astype(numpy.int32).clip(0, 255) for x in (r, g, b)]
-        # add data mask
-        mask = getattr(data, 'mask', None)
-        if mask is not None and mask is not False:
-            alpha[mask] = 0
-            for x in rgbs:
-                x[mask] = 0
-        # do the deed
-        return self.QARGBImage(alpha, *rgbs)
+        return self.packARGB(numpy.ones_like(values), r, g, b)
 
     def makeControlWidgets(self, parent):
         """Creates control widgets for the colormap's internal parameters.
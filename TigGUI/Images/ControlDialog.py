@@ -36,12 +36,38 @@ from TigGUI.kitties.utils import PersistentCurrier
 from TigGUI.kitties.widgets import BusyIndicator
 from .RenderControl import RenderControl, dprint
 from TigGUI.Images import Colormaps
+from TigGUI.Images.Statistics import computeStats, HistogramCache, QuantileSketch
+from TigGUI.Images.StatsCache import StatsCache
+from TigGUI.Images.Workers import BackgroundJob
 from TigGUI.Widgets import FloatValidator, TiggerPlotCurve, TiggerPlotMarker, TDockWidget
 from TigGUI.init import pixmaps
 
 DataValueFormat = "%.4g"
 
 
+def _subsetStatsJob(job, image, subset, dmin, dmax, hist, want_stats):
+    """Background job function for ImageControlDialog: makes a HistogramCache for the data subset (using the
+    full-range histogram hist, if not None), and, if want_stats is True, computes its Stats, including a quantile
+    sketch. Returns (histogram cache, stats), with stats None if not wanted."""
+    data, mask = image.optimalRavel(subset)
+    scale = .5 if want_stats else 1
+    hist_cache = HistogramCache(data, mask, dmin, dmax, hist=hist,
+                                progress=lambda fraction: job.setProgress(scale * fraction, "computing histogram"))
+    stats = None
+    if want_stats:
+        stats = computeStats(data, mask, sketch=True,
+                             progress=lambda fraction: job.setProgress(.5 + .5 * fraction, "computing statistics"))
+    return hist_cache, stats
+
+
+def _subsetSketchJob(job, image, subset):
+    """Background job function for ImageControlDialog: computes Stats of the data subset, including a quantile
+    sketch. This is used when the sketch is needed but _subsetStatsJob() has not made it."""
+    data, mask = image.optimalRavel(subset)
+    return computeStats(data, mask, sketch=True,
+                        progress=lambda fraction: job.setProgress(fraction, "computing percentiles"))
+
+
 class Separator(QWidget):
     def __init__(self, parent, label, extra_widgets=[], style=QFrame.HLine + QFrame.Raised, offset=16):
         QWidget.__init__(self, parent)
@@ -77,7 +103,18 @@ class ImageControlDialog(QDialog):
 
         # init internal state
         self._prev_range = self._display_range = None, None
-        self._hist = None
+        self._hist = self._hist_cache = None
+        self._sketch = self._meanstd = None
+        # background job computing histogram and stats of the current subset, and generation counter of subsets:
+        # results of jobs started for an earlier subset are dropped
+        self._subset_job = None
+        self._subset_generation = 0
+        # background job computing the quantile sketch of the subset (if not done by the subset job), and the
+        # percentage range waiting for the sketch, see _changeDisplayRangeToPercent()
+        self._sketch_job = None
+        self._subset_job_stats = False
+        self._pending_percent = None
+        self._subset_type = None
         self._geometry = None
 
         # create layouts
@@ -426,6 +463,7 @@ class ImageControlDialog(QDialog):
         self._rc.colorMapChanged.connect(self._updateColorMap)
         self._rc.dataSubsetChanged.connect(self._updateDataSubset)
         self._rc.displayRangeChanged.connect(self._updateDisplayRange)
+        self._rc.fullRangeProgress.connect(self._fullRangeProgress)
 
         # update widgets
         self._setupHistogramPlot()
@@ -464,13 +502,9 @@ class ImageControlDialog(QDialog):
         if self._geometry:
             dprint(4, "setting geometry")
             self.setGeometry(self._geometry)
-        if self._hist is None:
-            busy = BusyIndicator()
-            dprint(4, "updating histogram")
-            self._updateHistogram()
-            dprint(4, "updating stats")
-            self._updateStats(self._subset, self._subset_range)
-            busy.reset_cursor()
+        if self._hist is None and self._subset_job is None:
+            dprint(4, "starting histogram and stats computation")
+            self._startSubsetStats()
         dprint(4, "calling QDialog.show")
         QDialog.show(self)
 
@@ -479,7 +513,7 @@ class ImageControlDialog(QDialog):
     # number of bins used for displaying histograms
     NumHistBins = 500
     # number of bins used for high-res histograms
-    NumHistBinsHi = 10000
+    NumHistBinsHi = HistogramCache.NumBins
     # colorbar height, as fraction of plot area
     ColorBarHeight = 0.1
 
@@ -703,32 +737,31 @@ class ImageControlDialog(QDialog):
         busy = BusyIndicator()
         self._prev_range = self._display_range
         dmin, dmax = self._subset_range
-        hmin0, hmax0 = dmin, dmax
-        if hmin0 >= hmax0:
-            hmax0 = hmin0 + 1
-        subset, mask = self.image.optimalRavel(self._subset)
-        # compute full-subset hi-res histogram, if we don't have one (for percentile stats)
-        if self._hist_hires is None:
-            dprint(1, "computing histogram for full subset range", hmin0, hmax0)
-            self._hist_hires = measurements.histogram(subset, hmin0, hmax0, self.NumHistBinsHi, labels=mask,
-                                                      index=None if mask is None else False)
-            self._hist_bins_hires = hmin0 + (hmax0 - hmin0) * (numpy.arange(self.NumHistBinsHi) + 0.5) / float(
-                self.NumHistBinsHi)
-            self._hist_binsize_hires = (hmax0 - hmin0) / self.NumHistBins
-        # if hist limits not specified, then compute lo-res histogram based on the hi-res one
+        hmin0, hmax0 = self._fullHistogramRange()
+        # make histogram cache for the subset, if we don't have one. This holds a full-subset hi-res histogram,
+        # from which zoomed-in histograms are derived
+        if self._hist_cache is None:
+            subset, mask = self.image.optimalRavel(self._subset)
+            cache, key = self._subsetStatsCache()
+            hist = cache and cache.getHistogram(key, hmin0, hmax0, self.NumHistBinsHi)
+            if hist is None:
+                self._hist_cache = HistogramCache(subset, mask, hmin0, hmax0)
+                if cache:
+                    cache.setHistogram(key, hmin0, hmax0, self._hist_cache.fullHistogram())
+            else:
+                dprint(1, "using cached histogram for full subset range", hmin0, hmax0)
+                self._hist_cache = HistogramCache(subset, mask, hmin0, hmax0, hist=hist)
+        # if hist limits not specified, then compute histogram of full range
         if hmin is None:
             hmin, hmax = hmin0, hmax0
-            # downsample to low-res histogram
-            self._hist = self._hist_hires.reshape((self.NumHistBins, int(self.NumHistBinsHi / self.NumHistBins))).sum(1)
         else:
-            # zoomed-in low-res histogram
+            # zoomed-in histogram
             # bracket limits at subset range
             hmin, hmax = max(hmin, dmin), min(hmax, dmax)
             if hmin >= hmax:
                 hmax = hmin + 1
             dprint(1, "computing histogram for", self._subset.shape, self._subset.dtype, hmin, hmax)
-            self._hist = measurements.histogram(subset, hmin, hmax, self.NumHistBins, labels=mask,
-                                                index=None if mask is None else False)
+        self._hist = self._hist_cache.histogram(hmin, hmax, self.NumHistBins)
         dprint(1, "histogram computed")
         # compute bins
         self._itf_bins = hmin + (hmax - hmin) * (numpy.arange(self.NumItfBins)) / (float(self.NumItfBins) - 1)
@@ -763,43 +796,164 @@ class ImageControlDialog(QDialog):
         self._updateITF()
         busy.reset_cursor()
 
+    def _fullHistogramRange(self):
+        """Returns range of the full-subset histogram"""
+        hmin0, hmax0 = self._subset_range
+        if hmin0 >= hmax0:
+            hmax0 = hmin0 + 1
+        return hmin0, hmax0
+
+    def _startSubsetStats(self):
+        """Starts a background job computing the histogram and (if the subset is small enough) the stats of the
+        current data subset. Until the results arrive in _subsetStatsReady(), the histogram panel shows "computing"."""
+        self._cancelSubsetStats()
+        generation = self._subset_generation
+        cache, key = self._subsetStatsCache()
+        hmin0, hmax0 = self._fullHistogramRange()
+        hist = cache and cache.getHistogram(key, hmin0, hmax0, self.NumHistBinsHi)
+        self._meanstd = cache and cache.getMeanStd(key)
+        self._sketch = cache and cache.getSketch(key)
+        want_stats = self._subset.size <= (2048 * 2048) and not (self._meanstd and self._sketch)
+        self._histcurve1.setData([], [])
+        self._histcurve2.setData([], [])
+        self._wlab_histpos.setText("computing...")
+        self._histplot.replot()
+        job = self._subset_job = BackgroundJob(_subsetStatsJob, self.image, self._subset, hmin0, hmax0, hist,
+                                               want_stats, description="subset stats for %s" % self.image.name)
+        job.progress.connect(lambda fraction, message, gen=generation: self._subsetStatsProgress(gen, fraction, message))
+        job.finished.connect(lambda result, gen=generation: self._subsetStatsReady(gen, result, hist is None))
+        job.failed.connect(lambda message, gen=generation: self._subsetStatsFailed(gen, message))
+        job.start()
+        self._subset_job_stats = want_stats
+
+    def _startSubsetSketch(self):
+        """Starts a background job computing the quantile sketch of the current data subset. The results arrive in
+        _subsetSketchReady()."""
+        generation = self._subset_generation
+        job = self._sketch_job = BackgroundJob(_subsetSketchJob, self.image, self._subset,
+                                               description="subset percentiles for %s" % self.image.name)
+        job.progress.connect(lambda fraction, message, gen=generation: self._subsetStatsProgress(gen, fraction, message))
+        job.finished.connect(lambda stats, gen=generation: self._subsetSketchReady(gen, stats))
+        job.failed.connect(lambda message, gen=generation: self._subsetSketchFailed(gen, message))
+        job.start()
+
+    def _cancelSubsetStats(self):
+        """Cancels the background jobs started by _startSubsetStats() and _startSubsetSketch(), if any, and discards
+        their results"""
+        for job in self._subset_job, self._sketch_job:
+            if job is not None:
+                job.cancel()
+        self._subset_job = self._sketch_job = self._pending_percent = None
+        self._subset_generation += 1
+
+    def _subsetStatsProgress(self, generation, fraction, message):
+        if generation == self._subset_generation:
+            self._wlab_histpos.setText("%s... %d%%" % (message, round(fraction * 100)))
+
+    def _subsetStatsFailed(self, generation, message):
+        if generation == self._subset_generation:
+            self._subset_job = None
+            self._wlab_histpos.setText("error: %s" % message)
+
+    def _subsetSketchFailed(self, generation, message):
+        if generation == self._subset_generation:
+            self._sketch_job = self._pending_percent = None
+            self._wlab_histpos.setText("error: %s" % message)
+
+    def _subsetStatsReady(self, generation, result, save_histogram):
+        """Called (in the GUI thread) when a background job started by _startSubsetStats() has finished"""
+        if generation != self._subset_generation:
+            dprint(2, "dropping stale subset stats")
+            return
+        self._subset_job = None
+        self._hist_cache, stats = result
+        cache, key = self._subsetStatsCache()
+        if cache and save_histogram:
+            hmin0, hmax0 = self._fullHistogramRange()
+            cache.setHistogram(key, hmin0, hmax0, self._hist_cache.fullHistogram())
+        if stats is not None:
+            self._setSubsetStats(stats)
+        self._wlab_histpos.setText(self._wlab_histpos_text)
+        self._updateHistogram()
+        self._updateStats(self._subset, self._subset_range)
+        self._histplot.replot()
+        if self._pending_percent is not None and self._sketch is not None:
+            self._changeDisplayRangeToPercent(self._pending_percent)
+
+    def _subsetSketchReady(self, generation, stats):
+        """Called (in the GUI thread) when a background job started by _startSubsetSketch() has finished"""
+        if generation != self._subset_generation:
+            dprint(2, "dropping stale subset percentiles")
+            return
+        self._sketch_job = None
+        self._setSubsetStats(stats)
+        if self._subset_job is None:
+            self._wlab_histpos.setText(self._wlab_histpos_text)
+            self._updateStats(self._subset, self._subset_range)
+        if self._pending_percent is not None:
+            self._changeDisplayRangeToPercent(self._pending_percent)
+
+    def _subsetStatsCache(self):
+        """Returns (cache,key) tuple giving the persistent statistics cache (see StatsCache) and key for the
+        current data subset, or (None,None) if the subset's statistics are not cacheable"""
+        cache = self.image.statsCache()
+        if cache is not None:
+            if self._subset_type == RenderControl.SUBSET_FULL:
+                return cache, StatsCache.FULL
+            elif self._subset_type == RenderControl.SUBSET_SLICE:
+                return cache, tuple(self._rc.currentSlice())
+        return None, None
+
     def _updateStats(self, subset, minmax):
         """Recomputes subset statistics."""
-        if subset.size <= (2048 * 2048):
+        if self._meanstd:
             self._showMeanStd(busy=False)
         else:
             self._wlab_stats.setText(
                 ("min: %s  max: %s  np: %d" % (DataValueFormat, DataValueFormat, self._subset.size)) % minmax)
             self._wmore_stats.show()
 
+    def _fullRangeProgress(self, fraction, message):
+        """Shows progress of the full-cube min/max, which the "full" subset waits for (see RenderControl.setFullSubset())"""
+        if self._rc.isComputingFullRange():
+            self._wlab_histpos.setText("%s... %d%%" % (message, round(fraction * 100)))
+
     def _updateDataSubset(self, subset, minmax, desc, subset_type):
         """Called when the displayed data subset is changed. Updates the histogram."""
         self._subset = subset
         self._subset_range = minmax
+        self._subset_type = subset_type
         self._wlab_subset.setText("Subset: %s" % desc)
-        self._hist = self._hist_hires = None
+        # (clears any progress message of the full range)
+        self._wlab_histpos.setText(self._wlab_histpos_text)
+        self._hist = self._hist_cache = None
+        self._sketch = self._meanstd = None
         self._wreset_full.setVisible(subset_type is not RenderControl.SUBSET_FULL)
         self._wreset_slice and self._wreset_slice.setVisible(subset_type is not RenderControl.SUBSET_SLICE)
         # hide the mean/std markers, they will only be shown when _showMeanStd() is called
         self._line_mean.hide()
         self._line_std.hide()
-        # if we're visibile, recompute histograms and stats
+        # if we're visibile, recompute histograms and stats in the background (if subset is sufficiently small,
+        # extended stats are computed along with the histogram. Else the "more" button computes them later).
+        # Otherwise, show() will start this.
         if self.isVisible():
-            # if subset is sufficiently small, compute extended stats on-the-fly. Else show the "more" button to compute them later
-            self._updateHistogram()
-            self._updateStats(subset, minmax)
-            self._histplot.replot()
+            self._startSubsetStats()
+        else:
+            self._cancelSubsetStats()
 
     def _showMeanStd(self, busy=True):
         if busy:
             busy = BusyIndicator()
         dmin, dmax = self._subset_range
-        subset, mask = self.image.optimalRavel(self._subset)
-        dprint(5, "computing mean")
-        mean = measurements.mean(subset, labels=mask, index=None if mask is None else False)
-        dprint(5, "computing std")
-        std = measurements.standard_deviation(subset, labels=mask, index=None if mask is None else False)
-        dprint(5, "done")
+        cache, key = self._subsetStatsCache()
+        meanstd = self._meanstd or (cache and cache.getMeanStd(key))
+        if meanstd:
+            mean, std = meanstd
+        else:
+            dprint(5, "computing mean and std")
+            mean, std = self._computeSubsetStats()
+            dprint(5, "done")
+        self._meanstd = mean, std
         text = "  ".join([("%s: " + DataValueFormat) % (name, value) for name, value in
                           (("min", dmin), ("max", dmax), ("mean", mean), ("\n std", std))] + ["np: %d" % self._subset.size])
         self._wlab_stats.setText(text)
@@ -906,26 +1060,42 @@ class ImageControlDialog(QDialog):
         for i, (iextra, name, labels) in enumerate(self._rc.slicedAxes()):
             self._wslicers[i].setCurrentIndex(_slice[iextra])
 
+    def _computeSubsetStats(self):
+        """Computes mean/std and the quantile sketch of the current subset in one pass over the data, see
+        _setSubsetStats(). Returns (mean, std)."""
+        subset, mask = self.image.optimalRavel(self._subset)
+        self._setSubsetStats(computeStats(subset, mask, sketch=True))
+        return self._meanstd
+
+    def _setSubsetStats(self, stats):
+        """Stores the mean/std and quantile sketch of the current subset from a Stats object, and saves them in the
+        persistent statistics cache"""
+        self._meanstd = stats.mean, stats.std
+        self._sketch = stats.sketch or QuantileSketch()
+        cache, key = self._subsetStatsCache()
+        if cache:
+            cache.setMeanStd(key, *self._meanstd, save=False)
+            cache.setSketch(key, self._sketch)
+
     def _changeDisplayRangeToPercent(self, percent):
+        """Sets the display range to the central percent of the subset's distribution. This needs the subset's quantile
+        sketch (see Statistics.QuantileSketch): if it is not available yet, the range is changed once the background
+        job making it is done (the subset job, if it makes the sketch, else a job started here)."""
+        if self._sketch is None:
+            dprint(1, "waiting for quantile sketch of subset")
+            self._pending_percent = percent
+            if self._sketch_job is None and not (self._subset_job is not None and self._subset_job_stats):
+                self._startSubsetSketch()
+            return
+        self._pending_percent = None
         busy = BusyIndicator()
-        if self._hist is None:
-            self._updateHistogram()
-            self._updateStats(self._subset, self._subset_range)
         # delta: we need the [delta,100-delta] interval of the total distribution
-        delta = self._subset.size * ((100. - percent) / 200.)
-        # get F(x): cumulative sum
-        cumsum = numpy.zeros(len(self._hist_hires) + 1, dtype=int)
-        cumsum[1:] = numpy.cumsum(self._hist_hires)
-        bins = numpy.zeros(len(self._hist_hires) + 1, dtype=float)
-        bins[0] = self._subset_range[0]
-        bins[1:] = self._hist_bins_hires + self._hist_binsize_hires / 2
-        # use interpolation to find value interval corresponding to [delta,100-delta] of the distribution
-        dprint(2, self._subset.size, delta, self._subset.size - delta)
-        dprint(2, cumsum, self._hist_bins_hires)
-        # if first bin is already > delta, then set colour range to first bin
-        x0, x1 = numpy.interp([delta, self._subset.size - delta], cumsum, bins)
+        delta = (100. - percent) / 200.
+        x0, x1 = self._sketch.quantile([delta, 1 - delta])
+        dprint(2, "range for", percent, "percent is", x0, x1)
         # and change the display range (this will also cause a histplot.replot() via _updateDisplayRange above)
-        self._rc.setDisplayRange(x0, x1)
+        if numpy.isfinite([x0, x1]).all():
+            self._rc.setDisplayRange(x0, x1)
         busy.reset_cursor()
 
     def _setZeroLeftLimit(self):
@@ -938,6 +1108,8 @@ class ImageControlDialog(QDialog):
         self._rc.setDisplayRange(self._rc.displayRange()[0], pos.x())
 
     def _unzoomHistogram(self):
+        if self._hist is None:
+            return
         self._updateHistogram()
         self._histplot.replot()
 
@@ -947,6 +1119,8 @@ class ImageControlDialog(QDialog):
         curry=None is due to an error raised from the signal to zoom
         and is unused.
         """
+        if self._hist is None:
+            return
         # get max distance of plot limit from peak
         dprint(1, "zooming histogram by", factor)
         halfdist = (self._hist_range[1] - self._hist_range[0]) / (factor * 2)
@@ -955,7 +1129,7 @@ class ImageControlDialog(QDialog):
 
     def _zoomHistogramIntoRect(self, rect):
         hmin, hmax = rect.bottomLeft().x(), rect.bottomRight().x()
-        if hmax > hmin:
+        if hmax > hmin and self._hist is not None:
             self._updateHistogram(rect.bottomLeft().x(), rect.bottomRight().x())
             self._histplot.replot()
 
@@ -965,7 +1139,7 @@ class ImageControlDialog(QDialog):
         self._whistzoom_timer.start()
 
     def _zoomHistogramFinalize(self, value=None, preview=False):
-        if self._zooming_histogram:
+        if self._zooming_histogram or self._hist is None:
             return
         self._zooming_histogram = True
         try:
@@ -985,6 +1159,8 @@ class ImageControlDialog(QDialog):
 
     def _setHistLogScale(self, logscale, replot=True):
         self._ylogscale = logscale
+        if self._hist is None:
+            return
         if logscale:
             self._histplot.setAxisScaleEngine(QwtPlot.yLeft, QwtLogScaleEngine())
             ymax = max(1, self._hist_max)
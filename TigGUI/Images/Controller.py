@@ -24,14 +24,16 @@ import traceback
 
 import numpy
 from PyQt5.Qt import QHBoxLayout, QFileDialog, QComboBox, QLabel, QLineEdit, QDialog, QToolButton, \
-    Qt, QApplication, QColor, QPixmap, QPainter, QFrame, QMenu, QPen, QKeySequence, QCheckBox
+    Qt, QApplication, QColor, QFrame, QMenu, QPen, QKeySequence, QCheckBox
 from PyQt5.QtGui import QFont
 from PyQt5.QtWidgets import QDockWidget, QSizePolicy, QWidget, QPushButton, QStyle
-from PyQt5.Qwt import QwtText, QwtPlotCurve, QwtPlotMarker, QwtScaleMap, QwtPlotItem
+from PyQt5.Qwt import QwtText, QwtPlotCurve, QwtPlotMarker, QwtPlotItem
 from PyQt5.QtCore import pyqtSignal, QPoint, QPointF, QSize
 
 import TigGUI.kitties.utils
+from TigGUI.Images.Export import exportImage
 from TigGUI.Images.SkyImage import FITSImagePlotItem
+from TigGUI.Images.Workers import BackgroundJob
 from TigGUI.Plot.SkyModelPlot import LiveImageZoom
 from TigGUI.kitties.utils import PersistentCurrier
 from TigGUI.kitties.widgets import BusyIndicator
@@ -48,6 +50,15 @@ from TigGUI.Widgets import FloatValidator, TDockWidget
 from TigGUI.Images.RenderControl import RenderControl
 from TigGUI.Images.ControlDialog import ImageControlDialog
 
+# maximum size (in pixels, along either axis) of exported images when the "limit to 4K" option is checked
+Export4KSize = 4000
+
+
+def _exportImageJob(job, image, filename, scale):
+    """Exports an image to a PNG or TIFF file, see Export.exportImage(). This runs in a worker thread."""
+    exportImage(image, filename, scale, progress=lambda fraction: job.setProgress(fraction, "rendering"))
+    return filename
+
 
 class ImageController(QFrame):
     """An ImageController is a widget for controlling the display of one image.
@@ -205,8 +216,8 @@ class ImageController(QFrame):
                                                 self.showRenderControls)
         if save:
             self._qa_save = self._menu.addAction("Save image...", self._saveImage)
-        self._menu.addAction("Export image to PNG file...", self._exportImageToPNG)
-        self._export_png_dialog = None
+        self._menu.addAction("Export image to PNG or TIFF file...", self._exportImage)
+        self._export_dialog = None
         self._menu.addAction("Unload image", self._currier.curry(self.image.signalUnload.emit, None))
         self._wraise.setMenu(self._menu)
         self._wraise.setPopupMode(QToolButton.DelayedPopup)
@@ -242,6 +253,12 @@ class ImageController(QFrame):
         if self._control_dialog:
             self._control_dialog.close()
             self._control_dialog = None
+        self.renderControl().cancelFullRange()
+        self.renderControl().cancelPrefetch()
+        self.image.releaseCaches()
+        # write out any statistics not yet saved (see StatsCache.saveLater())
+        if self.image.statsCache():
+            self.image.statsCache().save()
 
     def __del__(self):
         self.close()
@@ -553,15 +570,18 @@ class ImageController(QFrame):
             else:
                 self._exportMaxRes = False
 
-    def _exportImageToPNG(self, filename=None):
+    def _exportImage(self, filename=None):
+        """Exports the image (as displayed) to a PNG or TIFF file, at full resolution or limited to 4K. This is done
+        in the background (see Export.exportImage()), with progress shown by the image manager."""
         if not filename:
-            if not self._export_png_dialog:
-                dialog = self._export_png_dialog = QFileDialog(self, "Export image to PNG", ".", "*.png")
+            if not self._export_dialog:
+                dialog = self._export_dialog = QFileDialog(self, "Export image to PNG or TIFF", ".",
+                                                           "PNG images (*.png);;TIFF images (*.tif *.tiff)")
                 dialog.setDefaultSuffix("png")
                 dialog.setFileMode(QFileDialog.AnyFile)
                 dialog.setAcceptMode(QFileDialog.AcceptSave)
                 dialog.setModal(True)
-                dialog.filesSelected['QStringList'].connect(self._exportImageToPNG)
+                dialog.filesSelected['QStringList'].connect(self._exportImage)
                 # attempt to add limit 4K option - not available on Ubuntu Unity
                 layout = dialog.layout()
                 if layout is not None:
@@ -571,67 +591,22 @@ class ImageController(QFrame):
                     checkbox.toggled.connect(self._exportImageResolution)
                     layout.addWidget(checkbox)
                     dialog.setLayout(layout)
-            return self._export_png_dialog.exec_() == QDialog.Accepted
-        busy = BusyIndicator()
+            return self._export_dialog.exec_() == QDialog.Accepted
         if isinstance(filename, QStringList):
             filename = filename[0]
         filename = str(filename)
-        # get image dimensions
+        # export either at full resolution, or limited to 4K. If the image is small then no scaling occurs.
         nx, ny = self.image.imageDims()
-        # export either max resolution possible or default to 4K. If image is small then no scaling occurs.
-        if not self._exportMaxRes:
-            # get free memory. Note: Linux only!
-            import os
-            total_memory, used_memory, free_memory = map(int, os.popen('free -t -m').readlines()[-1].split()[1:])
-            # use 90% of free memory available
-            free_memory = free_memory * 0.9
-            # use an approximation to find the max image size that can be generated
-            if nx >= ny and nx > free_memory:
-                scale_factor = round(free_memory / nx, 1)
-            elif ny > nx and ny > free_memory:
-                scale_factor = round(free_memory / ny, 1)
-            else:
-                scale_factor = 1
-        else:
-            # default to 4K
-            if nx > 4000:
-                scale_factor = 4000 / nx
-            elif ny > nx and ny > 4000:
-                scale_factor = 4000 / ny
-            else:
-                scale_factor = 1
-
-        # make QPixmap
-        nx = nx * scale_factor
-        ny = ny * scale_factor
-        (l0, l1), (m0, m1) = self.image.getExtents()
-        pixmap = QPixmap(nx, ny)
-        painter = QPainter(pixmap)
-        # use QwtPlot implementation of draw canvas, since we want to avoid caching
-        xmap = QwtScaleMap()
-        xmap.setPaintInterval(0, nx)
-        xmap.setScaleInterval(l1, l0)
-        ymap = QwtScaleMap()
-        ymap.setPaintInterval(ny, 0)
-        ymap.setScaleInterval(m0, m1)
-        # call painter with clear cache option for consistent file size output.
-        self.image.draw(painter, xmap, ymap, pixmap.rect(), use_cache=False)
-        painter.end()
-        # save to file
-        try:
-            pixmap.save(filename, "PNG")
-            # clean up export items
-            pixmap.detach()
-            del xmap
-            del ymap
-            del pixmap
-            del painter
-        except Exception as exc:
-            self._imgman.signalShowErrorMessage[str, int].emit("Error writing %s: %s" % (filename, str(exc)), 3000)
-            busy.reset_cursor()
-        else:
-            busy.reset_cursor()
-            self._imgman.signalShowMessage[str, int].emit("Exported image to file %s" % filename, 3000)
+        scale = min(1, Export4KSize / max(nx, ny)) if self._exportMaxRes else 1
+        job = BackgroundJob(_exportImageJob, self.image, filename, scale, description="export %s" % filename)
+        job.finished.connect(lambda filename: self._imgman.signalShowMessage[str, int].emit(
+            "Exported image to file %s" % filename, 3000))
+        job.failed.connect(lambda message: self._imgman.signalShowErrorMessage[str, int].emit(
+            "Error writing %s: %s" % (filename, message), 3000))
+        job.cancelled.connect(lambda: self._imgman.signalShowMessage[str, int].emit(
+            "Cancelled exporting image to file %s" % filename, 3000))
+        self._imgman.showJobProgress(job, filename, "Exporting")
+        job.start()
 
     def _toggleDisplayRangeLock(self):
         self.renderControl().lockDisplayRange(not self.renderControl().isDisplayRangeLocked())
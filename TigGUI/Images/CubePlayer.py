@@ -0,0 +1,170 @@
+# Copyright (C) 2002-2022
+# The MeqTree Foundation &
+# ASTRON (Netherlands Foundation for Research in Astronomy)
+# P.O.Box 2, 7990 AA Dwingeloo, The Netherlands
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>,
+# or write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""Playback ("movie mode") of cubes along a sliced axis."""
+
+import collections
+import math
+import time
+
+from PyQt5.Qt import QObject, QTimer
+from PyQt5.QtCore import Qt, pyqtSignal
+
+import TigGUI.kitties.utils
+from TigGUI.Images.Workers import getThreadPool
+
+_verbosity = TigGUI.kitties.utils.verbosity(name="playback")
+dprint = _verbosity.dprint
+dprintf = _verbosity.dprintf
+
+# default playback frame rate. Can be changed via the playback-fps config option.
+DefaultFrameRate = 10
+
+
+class CubePlayer(QObject):
+    """A CubePlayer steps through the slices of an image (see RenderControl) along one sliced axis, at a target
+    frame rate. Frames are rendered ahead on worker threads (see SkyImagePlotItem.prerenderPlane()), and a frame is
+    only shown once it is ready, so under load frames are skipped rather than playback slowing down.
+    If rendering cannot keep up with the frame rate, only every Nth frame is rendered ahead, with N adapted to the
+    measured render time.
+    Emits the following signals:
+    frameShown(index)             a frame (slice index along the axis) has been shown
+    statusChanged(message)        status message giving frame number and achieved frame rate, about once per second
+    stopped()                     playback has stopped
+    """
+    frameShown = pyqtSignal(int)
+    statusChanged = pyqtSignal(str)
+    stopped = pyqtSignal()
+
+    def __init__(self, parent=None):
+        QObject.__init__(self, parent)
+        self._rc = None
+        self._fps = DefaultFrameRate
+        self._timer = QTimer(self)
+        self._timer.setTimerType(Qt.PreciseTimer)
+        self._timer.timeout.connect(self._tick)
+        # futures of frames being rendered ahead, by (unwrapped) frame number
+        self._futures = {}
+        # times at which recent frames were shown, for measuring the achieved frame rate
+        self._shown_times = collections.deque()
+        # recent render times per frame, for adapting the render-ahead stride
+        self._render_times = collections.deque(maxlen=16)
+
+    def renderControl(self):
+        """Returns the RenderControl being played, or None if not playing"""
+        return self._rc
+
+    def isPlaying(self):
+        return self._timer.isActive()
+
+    def frameRate(self):
+        return self._fps
+
+    def setFrameRate(self, fps):
+        """Sets the target frame rate. Takes effect immediately if playing."""
+        self._fps = max(fps, .1)
+        if self.isPlaying():
+            self._restartClock()
+
+    def start(self, rc, iaxis, fps=None):
+        """Starts playing the image of RenderControl rc, along extra axis iaxis (an index into its current slice)"""
+        self.stop()
+        self._rc, self._iaxis = rc, iaxis
+        self._num_frames = rc.sliceDimensions()[iaxis]
+        self._axis_name = dict([(iextra, name) for iextra, name, labels in rc.slicedAxes()]).get(iaxis, "")
+        if fps:
+            self._fps = fps
+        self._nthreads = rc.image.renderThreads()
+        self._pool = getThreadPool("playback-%d" % self._nthreads, self._nthreads)
+        self._render_times.clear()
+        self._shown_times.clear()
+        self._last_status = 0
+        # prefetching by slice would only compete with rendering ahead
+        rc.setPrefetchEnabled(False)
+        self._restartClock()
+        self._timer.start(max(int(1000 / self._fps / 2), 5))
+        dprint(1, "starting playback along axis", iaxis, "at", self._fps, "fps")
+
+    def stop(self):
+        if self._rc is None:
+            return
+        dprint(1, "stopping playback")
+        self._timer.stop()
+        for future in self._futures.values():
+            future.cancel()
+        self._futures = {}
+        self._rc.setPrefetchEnabled(True)
+        self._rc = None
+        self.stopped.emit()
+
+    def _restartClock(self):
+        """Restarts the frame clock from the current slice"""
+        self._t0 = time.time()
+        self._frame0 = self._shown = self._rc.currentSlice()[self._iaxis]
+        self._timer.setInterval(max(int(1000 / self._fps / 2), 5))
+
+    def _frameKey(self, frame):
+        key = list(self._rc.currentSlice())
+        key[self._iaxis] = frame % self._num_frames
+        return tuple(key)
+
+    def _renderFrame(self, image, key):
+        """Renders a frame ahead. Called in a worker thread."""
+        t0 = time.time()
+        image.prerenderPlane(image.plane(key))
+        self._render_times.append(time.time() - t0)
+
+    def _stride(self):
+        """Returns the spacing of frames rendered ahead: 1 if rendering keeps up with the frame rate, else larger"""
+        if not self._render_times:
+            return 1
+        render_rate = self._nthreads / (sum(self._render_times) / len(self._render_times))
+        return max(1, int(math.ceil(self._fps / render_rate)))
+
+    def _tick(self):
+        target = self._frame0 + int((time.time() - self._t0) * self._fps)
+        # show the most recent ready frame that is due, skipping any others
+        ready = [frame for frame, future in self._futures.items() if self._shown < frame <= target and future.done()]
+        if ready:
+            frame = max(ready)
+            self._shown = frame
+            self._rc.changeSlice(self._iaxis, frame % self._num_frames, write_config=False)
+            self._shown_times.append(time.time())
+            self.frameShown.emit(frame % self._num_frames)
+        # drop frames that are past, and render ahead from the target frame
+        for frame in list(self._futures.keys()):
+            if frame <= self._shown or (frame < target and not self._futures[frame].running()):
+                self._futures.pop(frame).cancel()
+        stride = self._stride()
+        lookahead = max(2 * self._nthreads, int(self._fps / 2))
+        for frame in range(target + 1, target + lookahead * stride + 1, stride):
+            if frame not in self._futures and len(self._futures) < lookahead:
+                self._futures[frame] = self._pool.submit(self._renderFrame, self._rc.image, self._frameKey(frame))
+        self._reportStatus()
+
+    def _reportStatus(self):
+        now = time.time()
+        while self._shown_times and self._shown_times[0] < now - 1:
+            self._shown_times.popleft()
+        if now - self._last_status >= 1:
+            self._last_status = now
+            self.statusChanged.emit("Playing %s axis: frame %d/%d, %.1f fps (target %g)" % (
+                self._axis_name, self._shown % self._num_frames + 1, self._num_frames, len(self._shown_times), self._fps))
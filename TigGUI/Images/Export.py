@@ -0,0 +1,189 @@
+# Copyright (C) 2002-2022
+# The MeqTree Foundation &
+# ASTRON (Netherlands Foundation for Research in Astronomy)
+# P.O.Box 2, 7990 AA Dwingeloo, The Netherlands
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>,
+# or write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""Export of rendered images to PNG and (Big)TIFF files of any size, in bounded memory."""
+
+import os
+import struct
+import zlib
+
+import numpy
+from PyQt5.Qwt import QwtScaleMap
+
+import TigGUI.kitties.utils
+
+_verbosity = TigGUI.kitties.utils.verbosity(name="export")
+dprint = _verbosity.dprint
+dprintf = _verbosity.dprintf
+
+# zlib compression level used for both formats. Above this, files get little smaller but much slower to write.
+CompressionLevel = 6
+
+
+def _rgbaDifferences(argb):
+    """Converts a [rows, width] array of ARGB32 values into a [rows, width*4] array of RGBA bytes, with each byte
+    replaced by its difference from the same channel of the previous pixel (mod 256). This is both the PNG "Sub"
+    filter and the TIFF horizontal predictor, and makes the pixels compress a lot better."""
+    rgba = (argb[..., numpy.newaxis] >> numpy.array([16, 8, 0, 24], numpy.uint32)).astype(numpy.uint8)
+    rgba = rgba.reshape(argb.shape[0], -1)
+    rgba[:, 4:] -= rgba[:, :-4].copy()
+    return rgba
+
+
+class PNGWriter:
+    """Writes an 8-bit RGBA PNG file row by row, compressing as it goes, so the image is never held in memory"""
+
+    def __init__(self, file, width, height):
+        self._file = file
+        self._file.write(b"\x89PNG\r\n\x1a\n")
+        # 8 bits per sample, colour type 6 (RGBA), default compression, filtering and no interlacing
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+        self._compressor = zlib.compressobj(CompressionLevel)
+
+    def _chunk(self, tag, data):
+        self._file.write(struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data)))
+
+    def writeRows(self, argb):
+        """Writes the next rows of the image, given as a [rows, width] array of ARGB32 values"""
+        rows = numpy.empty((argb.shape[0], argb.shape[1] * 4 + 1), numpy.uint8)
+        # each row starts with its filter type, 1 being "Sub"
+        rows[:, 0] = 1
+        rows[:, 1:] = _rgbaDifferences(argb)
+        data = self._compressor.compress(rows.tobytes())
+        if data:
+            self._chunk(b"IDAT", data)
+
+    def finish(self):
+        self._chunk(b"IDAT", self._compressor.flush())
+        self._chunk(b"IEND", b"")
+
+
+class BigTIFFWriter:
+    """Writes an 8-bit RGBA BigTIFF file row by row, as deflate-compressed strips of RowsPerStrip rows. BigTIFF (which
+    has 64-bit offsets) is used since images large enough to need exporting in bounded memory may well exceed the 4 GB
+    limit of classic TIFF. The directory (IFD) goes at the end of the file, once the strips are known."""
+
+    RowsPerStrip = 64
+
+    # TIFF field types
+    SHORT, LONG, LONG8 = 3, 4, 16
+
+    def __init__(self, file, width, height):
+        self._file = file
+        self._width, self._height = width, height
+        # byte order, version (43 for BigTIFF), offset size, reserved, and offset of the IFD, which is filled in
+        # by finish()
+        self._file.write(b"II" + struct.pack("<HHHQ", 43, 8, 0, 0))
+        # rows not yet written out as a strip, and offsets and sizes of strips written
+        self._pending = []
+        self._num_pending = 0
+        self._strip_offsets, self._strip_sizes = [], []
+
+    def writeRows(self, argb):
+        """Writes the next rows of the image, given as a [rows, width] array of ARGB32 values"""
+        self._pending.append(_rgbaDifferences(argb))
+        self._num_pending += argb.shape[0]
+        while self._num_pending >= self.RowsPerStrip:
+            self._writeStrip(self.RowsPerStrip)
+
+    def _writeStrip(self, nrows):
+        rows = numpy.concatenate(self._pending) if len(self._pending) > 1 else self._pending[0]
+        self._pending = [rows[nrows:]] if nrows < len(rows) else []
+        self._num_pending -= nrows
+        data = zlib.compress(rows[:nrows].tobytes(), CompressionLevel)
+        self._strip_offsets.append(self._file.tell())
+        self._strip_sizes.append(len(data))
+        self._file.write(data)
+
+    def _entry(self, tag, ftype, values):
+        """Makes an IFD entry. Values that do not fit in the entry itself are written out first."""
+        fmt = {self.SHORT: "H", self.LONG: "I", self.LONG8: "Q"}[ftype]
+        data = struct.pack("<%d%s" % (len(values), fmt), *values)
+        if len(data) > 8:
+            offset = self._file.tell()
+            self._file.write(data)
+            data = struct.pack("<Q", offset)
+        return struct.pack("<HHQ", tag, ftype, len(values)) + data.ljust(8, b"\0")
+
+    def finish(self):
+        if self._num_pending:
+            self._writeStrip(self._num_pending)
+        entries = [
+            self._entry(256, self.LONG, [self._width]),  # ImageWidth
+            self._entry(257, self.LONG, [self._height]),  # ImageLength
+            self._entry(258, self.SHORT, [8, 8, 8, 8]),  # BitsPerSample
+            self._entry(259, self.SHORT, [8]),  # Compression: deflate
+            self._entry(262, self.SHORT, [2]),  # PhotometricInterpretation: RGB
+            self._entry(273, self.LONG8, self._strip_offsets),  # StripOffsets
+            self._entry(277, self.SHORT, [4]),  # SamplesPerPixel
+            self._entry(278, self.LONG, [self.RowsPerStrip]),  # RowsPerStrip
+            self._entry(279, self.LONG8, self._strip_sizes),  # StripByteCounts
+            self._entry(284, self.SHORT, [1]),  # PlanarConfiguration: contiguous
+            self._entry(317, self.SHORT, [2]),  # Predictor: horizontal differencing
+            self._entry(338, self.SHORT, [2]),  # ExtraSamples: unassociated alpha
+        ]
+        # the IFD must start on a word boundary
+        if self._file.tell() % 2:
+            self._file.write(b"\0")
+        ifd_offset = self._file.tell()
+        self._file.write(struct.pack("<Q", len(entries)) + b"".join(entries) + struct.pack("<Q", 0))
+        self._file.seek(8)
+        self._file.write(struct.pack("<Q", ifd_offset))
+
+
+# writer classes by filename extension
+Writers = dict(png=PNGWriter, tif=BigTIFFWriter, tiff=BigTIFFWriter)
+
+
+def exportImage(image, filename, scale=1, progress=None):
+    """Exports an image (a SkyImagePlotItem) as currently displayed (i.e. with its current slice, colormap and
+    intensity map) to a PNG or TIFF file, as given by the extension of filename. Scale is the number of output
+    pixels per image pixel. The image is rendered and written out one row of tiles at a time (see
+    SkyImagePlotItem.renderRows()), so images of any size can be exported in bounded memory.
+    If progress is given, it is called as progress(fraction) after each row of tiles. If an exception is raised
+    (e.g. to cancel the export, see Workers.BackgroundJob.setProgress()), the partial file is removed."""
+    ext = os.path.splitext(filename)[1].lower().lstrip(".")
+    writer_class = Writers.get(ext)
+    if writer_class is None:
+        raise ValueError("unsupported export format '%s', use one of: %s" % (ext, ", ".join(sorted(Writers))))
+    nx, ny = image.imageDims()
+    width, height = max(int(round(nx * scale)), 1), max(int(round(ny * scale)), 1)
+    (l0, l1), (m0, m1) = image.getExtents()
+    xmap = QwtScaleMap()
+    xmap.setPaintInterval(0, width)
+    xmap.setScaleInterval(l1, l0)
+    ymap = QwtScaleMap()
+    ymap.setPaintInterval(height, 0)
+    ymap.setScaleInterval(m0, m1)
+    dprint(1, "exporting", width, "x", height, "image to", filename)
+    try:
+        with open(filename, "wb") as file:
+            writer = writer_class(file, width, height)
+            for y, argb in image.renderRows(xmap, ymap):
+                writer.writeRows(argb)
+                if progress:
+                    progress((y + argb.shape[0]) / height)
+            writer.finish()
+    except:
+        # do not leave a truncated file behind
+        if os.path.exists(filename):
+            os.remove(filename)
+        raise
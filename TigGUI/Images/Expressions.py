@@ -0,0 +1,287 @@
+# Copyright (C) 2002-2022
+# The MeqTree Foundation &
+# ASTRON (Netherlands Foundation for Research in Astronomy)
+# P.O.Box 2, 7990 AA Dwingeloo, The Netherlands
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>,
+# or write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""Chunk-by-chunk evaluation of elementwise image expressions (see ImageManager.computeImage())."""
+
+import ast
+import tempfile
+import threading
+
+import numpy
+import numpy.ma
+
+import TigGUI.kitties.utils
+from TigGUI.Images.Statistics import reduceChunks
+from TigGUI.init import Config
+
+_verbosity = TigGUI.kitties.utils.verbosity(name="expressions")
+dprint = _verbosity.dprint
+dprintf = _verbosity.dprintf
+
+# number of elements per chunk. Each thread holds a few temporaries of this size.
+ChunkSize = 2 ** 20
+# results larger than this (in megabytes) are memory-mapped to a temporary file. Can be changed via the
+# compute-memmap-mb config option, and the directory via the compute-tmpdir option.
+DefaultMemmapMB = 4096
+
+# numpy functions (besides ufuncs) that operate elementwise
+ElementwiseFunctions = set([name for name, func in numpy.__dict__.items() if isinstance(func, numpy.ufunc)] +
+                           ["where", "clip", "nan_to_num", "real", "imag", "angle", "around", "round", "fix", "sinc"])
+# numpy constants that may be used in elementwise expressions
+ElementwiseConstants = {"pi", "e", "euler_gamma", "nan", "inf"}
+
+
+def isElementwise(expression, argnames):
+    """Returns tuple of (elementwise, used), where elementwise is True if the expression only involves elementwise
+    operations on the arguments (named by argnames), so that it may be evaluated chunk by chunk, and used is the set of
+    argument names that the expression refers to. Anything else (reductions such as a.mean(), attribute access
+    such as fft.fft2(a), indexing, etc.) makes the expression non-elementwise."""
+    used = set()
+    try:
+        tree = ast.parse(expression.strip(), mode="eval")
+    except SyntaxError:
+        return False, used
+
+    def check(node):
+        if isinstance(node, ast.Expression):
+            return check(node.body)
+        if isinstance(node, ast.Constant):
+            return isinstance(node.value, (bool, int, float, complex))
+        if isinstance(node, ast.Name):
+            if node.id in argnames:
+                used.add(node.id)
+                return True
+            return node.id in ElementwiseConstants
+        if isinstance(node, ast.BinOp):
+            return not isinstance(node.op, ast.MatMult) and check(node.left) and check(node.right)
+        if isinstance(node, ast.UnaryOp):
+            return check(node.operand)
+        if isinstance(node, ast.Compare):
+            return check(node.left) and all([check(x) for x in node.comparators])
+        if isinstance(node, ast.Call):
+            return isinstance(node.func, ast.Name) and node.func.id in ElementwiseFunctions and \
+                   not any([isinstance(x, ast.Starred) for x in node.args]) and \
+                   all([check(x) for x in node.args]) and \
+                   all([kw.arg is not None and check(kw.value) for kw in node.keywords])
+        return False
+
+    return check(tree) and bool(used), used
+
+
+def _getData(array):
+    """Returns the data of a masked array, or the array itself. Unlike numpy.ma.getdata(), this leaves array-like
+    objects (such as SkyImage.ScaledData) alone, rather than converting them into numpy arrays."""
+    return array.data if numpy.ma.isMA(array) else array
+
+
+def _memoryOrder(arrays):
+    """Returns 'F' or 'C' if all arrays (and their masks) are contiguous in that order, else None"""
+    parts = []
+    for array in arrays:
+        parts.append(_getData(array))
+        if numpy.ma.getmask(array) is not numpy.ma.nomask:
+            parts.append(numpy.ma.getmask(array))
+    for order, flag in ('F', 'F_CONTIGUOUS'), ('C', 'C_CONTIGUOUS'):
+        if all([part.flags[flag] for part in parts]):
+            return order
+    return None
+
+
+def _allocate(shape, dtype, order):
+    """Allocates an output array, memory-mapped to a temporary file if it is large"""
+    nbytes = int(numpy.prod(shape)) * numpy.dtype(dtype).itemsize
+    if nbytes > Config.getint("compute-memmap-mb", DefaultMemmapMB) * 2 ** 20:
+        dprint(2, "memory-mapping", nbytes, "byte result")
+        # the file is deleted once closed, but remains mapped
+        with tempfile.TemporaryFile(dir=Config.get("compute-tmpdir", "") or None) as tmpfile:
+            return numpy.memmap(tmpfile, dtype=dtype, mode="w+", shape=shape, order=order)
+    return numpy.empty(shape, dtype, order=order)
+
+
+def trimShape(shape):
+    """Trims trivial (length-1) trailing dimensions off a shape. Arguments of image expressions are trimmed like this,
+    since e.g. adding an NxMx1 and an NxMx1x1 array would otherwise give an NxMxMx1 result, following the numpy
+    broadcasting rules."""
+    while shape and shape[-1] == 1:
+        shape = shape[:-1]
+    return shape
+
+
+def trimArray(array):
+    """Returns array with trivial trailing dimensions trimmed (see trimShape()). Arrays with a reshape() method (numpy
+    arrays, and SkyImage.ScaledData) are reshaped into views. Anything else is converted into a numpy array first,
+    which materializes computed cubes (see ExpressionArray)."""
+    if not hasattr(array, 'reshape'):
+        array = numpy.asanyarray(array)
+    return array.reshape(trimShape(array.shape))
+
+
+def commonShape(args):
+    """Returns the shape shared by all arrays in args (ignoring Nones), or None if they differ"""
+    shapes = set([array.shape for array in args if array is not None])
+    return shapes.pop() if len(shapes) == 1 else None
+
+
+def evaluateElementwise(func, args, progress=None, chunk_size=None):
+    """Evaluates func(*args) chunk by chunk, where func is elementwise (see isElementwise()), and args are arrays of
+    the same shape (or None for arguments that are not used). Chunks are evaluated in parallel in the "compute" thread
+    pool, and written into a preallocated output array (see _allocate()). Masked elements of the result are set to
+    NaN. Complex results are converted into their absolute value. Progress is as for Statistics.computeStats().
+    Returns tuple of (result, converted), where converted is True if the result was complex, or (None, False) if
+    the arrays cannot be walked chunk by chunk (i.e. differ in shape, or are not contiguous), in which case func
+    should be evaluated on the whole arrays instead."""
+    arrays = [array for array in args if array is not None]
+    if commonShape(arrays) is None:
+        return None, False
+    order = _memoryOrder(arrays)
+    if order is None:
+        return None, False
+    shape = arrays[0].shape
+    size = arrays[0].size
+    # flat views of arguments and masks, in memory order
+    flat = []
+    for array in args:
+        if array is None:
+            flat.append(None)
+        else:
+            # (array-like arguments such as SkyImage.ScaledData are raveled as such, and only converted chunk by chunk)
+            mask = numpy.ma.getmask(array)
+            flat.append((_getData(array).ravel(order=order),
+                         None if mask is numpy.ma.nomask else numpy.ravel(mask, order=order)))
+    chunk_size = chunk_size or ChunkSize
+
+    def evaluate(i0, i1):
+        chunk_args = []
+        for x in flat:
+            if x is None:
+                chunk_args.append(None)
+            else:
+                data, mask = x
+                chunk_args.append(data[i0:i1] if mask is None else numpy.ma.masked_array(data[i0:i1], mask[i0:i1]))
+        values = func(*chunk_args)
+        # a result that does not depend on the data (e.g. "a*0+1" may come out as a scalar) is broadcast to the chunk
+        if numpy.shape(values) != (i1 - i0,):
+            values = numpy.ma.masked_array(numpy.broadcast_to(numpy.ma.getdata(values), (i1 - i0,)),
+                                           numpy.broadcast_to(numpy.ma.getmaskarray(values), (i1 - i0,)))
+        return values
+
+    # evaluate the first chunk up front, to find out the type of the result
+    first = evaluate(0, min(chunk_size, size))
+    converted = numpy.iscomplexobj(first)
+    dtype = abs(first[:0]).dtype if converted else first.dtype
+    result = _allocate(shape, dtype, order)
+    flat_result = numpy.ravel(result, order=order)
+    fill = numpy.nan if numpy.issubdtype(dtype, numpy.inexact) else 0
+    dprint(2, "evaluating", size, "elements into", dtype, "result")
+
+    def store(i0, i1, values):
+        if converted:
+            values = abs(values)
+        flat_result[i0:i1] = numpy.ma.filled(values, fill)
+
+    store(0, first.size, first)
+    reduceChunks(size - first.size, lambda i0, i1: store(first.size + i0, first.size + i1,
+                                                        evaluate(first.size + i0, first.size + i1)),
+                 lambda _: None, progress=progress, chunk_size=chunk_size, pool="compute")
+    return result, converted
+
+
+def evaluateExpression(func, expression, argnames, arrays):
+    """Evaluates an image expression (see ImageManager.computeImage()): func is the expression compiled into a function
+    of the arguments named by argnames, arrays are the arguments (trivial trailing dimensions are trimmed off, see
+    trimArray()). Elementwise expressions (see isElementwise()) are evaluated chunk by chunk, in parallel, without
+    whole-image temporaries (see evaluateElementwise()). For cubes, nothing is evaluated yet: the result is an
+    ExpressionArray, with planes computed as they are needed. Anything else (e.g. "a-a.mean()" or "fft.fft2(a)") is
+    evaluated on the whole arrays at once, with undefined (non-finite) pixels masked.
+    Returns tuple of (result, converted), where converted is True if a complex result has been converted into its
+    absolute value."""
+    elementwise, used = isElementwise(expression, argnames)
+    if elementwise:
+        args = [trimArray(array) if name in used else None for name, array in zip(argnames, arrays)]
+        shape = commonShape(args)
+        if shape is not None and numpy.prod(shape[2:]) > 1:
+            dprint(2, "making virtual cube for", expression)
+            result = ExpressionArray(func, args)
+            return result, result.converted
+        result, converted = evaluateElementwise(func, args)
+        if result is not None:
+            return result, converted
+    dprint(2, "evaluating", expression, "on whole arrays")
+    # images keep NaNs for undefined pixels, so mask these for the likes of "a-a.mean()"
+    return func(*[numpy.ma.masked_invalid(trimArray(array), copy=False) for array in arrays]), False
+
+
+class ExpressionArray:
+    """A virtual array holding the result of an elementwise expression (see isElementwise()) over arrays of the same
+    shape. Nothing is computed up front: indexing evaluates the expression over the same index into each argument,
+    so e.g. a plane of the result costs about as much as reading the corresponding planes of the arguments. This is
+    used as the datacube of computed cubes (see ImageManager.computeImage()), which are then accessed lazily (see
+    SkyCubePlotItem.isLazy()), so only planes that are actually displayed are ever computed.
+    Masked elements of the result come out as NaN. Complex results are converted into their absolute value.
+    Converting to a numpy array (e.g. numpy.asarray(), as happens when full-cube statistics are computed)
+    materializes the whole result (see evaluateElementwise()), which is then kept for subsequent use."""
+
+    def __init__(self, func, args):
+        """Func is an elementwise function, args is a list of arrays of the same shape (or None for arguments that are
+        not used)"""
+        self._func = func
+        self._args = list(args)
+        self.shape = commonShape(self._args)
+        if self.shape is None:
+            raise ValueError("arguments of an ExpressionArray must have the same shape")
+        self.ndim = len(self.shape)
+        self.size = int(numpy.prod(self.shape))
+        self._array = None
+        self._lock = threading.Lock()
+        # evaluate a single element to find out the type of the result
+        sample = self._func(*[None if array is None else array[(slice(0, 1),) * self.ndim] for array in self._args])
+        self.converted = numpy.iscomplexobj(sample)
+        self.dtype = numpy.asarray(abs(sample) if self.converted else sample).dtype
+        self.itemsize = self.dtype.itemsize
+        self.nbytes = self.size * self.itemsize
+
+    def isMaterialized(self):
+        return self._array is not None
+
+    def __getitem__(self, index):
+        if self._array is not None:
+            return self._array[index]
+        values = self._func(*[None if array is None else array[index] for array in self._args])
+        if self.converted:
+            values = abs(values)
+        values = numpy.ma.filled(values, numpy.nan if numpy.issubdtype(self.dtype, numpy.inexact) else 0)
+        return numpy.asarray(values, self.dtype)
+
+    def materialize(self, progress=None):
+        """Computes the whole result (if not already done), and returns it as a numpy array. Progress is as for
+        evaluateElementwise(). Safe to call from a background thread."""
+        with self._lock:
+            if self._array is None:
+                dprint(2, "materializing", "x".join(map(str, self.shape)), "expression result")
+                array, converted = evaluateElementwise(self._func, self._args, progress=progress)
+                if array is None:
+                    array = self[(slice(None),) * self.ndim]
+                self._array = array
+            return self._array
+
+    def __array__(self, dtype=None, copy=None):
+        array = self.materialize()
+        return array if dtype is None else array.astype(dtype)
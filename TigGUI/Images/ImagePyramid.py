@@ -0,0 +1,133 @@
+# Copyright (C) 2002-2022
+# The MeqTree Foundation &
+# ASTRON (Netherlands Foundation for Research in Astronomy)
+# P.O.Box 2, 7990 AA Dwingeloo, The Netherlands
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>,
+# or write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+import math
+import threading
+
+import numpy
+import numpy.ma
+
+import TigGUI.kitties.utils
+
+_verbosity = TigGUI.kitties.utils.verbosity(name="pyramid")
+dprint = _verbosity.dprint
+dprintf = _verbosity.dprintf
+
+
+def downsample2(image, dtype=None):
+    """Downsamples a 2D image by a factor of 2 along each axis, by averaging each 2x2 block of pixels.
+    Masked and non-finite pixels are excluded from the average. If the input has odd dimensions, the last row/column
+    of output pixels averages over the available pixels only. Output pixels that have no valid input pixels are
+    NaN, as elsewhere in Tigger. The result is of the given (floating-point) type, default is the image type, promoted
+    to at least float32.
+    """
+    data = numpy.ma.getdata(image)
+    valid = numpy.isfinite(data)
+    mask = numpy.ma.getmask(image)
+    if mask is not numpy.ma.nomask:
+        valid &= ~mask
+    if dtype is None:
+        dtype = numpy.result_type(data.dtype, numpy.float32)
+    n0, n1 = data.shape
+    m0, m1 = (n0 + 1) // 2, (n1 + 1) // 2
+    # fast path: even dimensions and no invalid pixels, so simply average the four pixels of each block
+    if not n0 % 2 and not n1 % 2 and valid.all():
+        result = data[0::2, 0::2].astype(dtype)
+        result += data[1::2, 0::2]
+        result += data[0::2, 1::2]
+        result += data[1::2, 1::2]
+        result *= .25
+        return result
+    # general case: pad to even dimensions (padding is marked as invalid), zero invalid pixels so that they don't
+    # contribute to the sums, and count the valid pixels in each block
+    values = numpy.zeros((m0 * 2, m1 * 2), dtype)
+    weights = numpy.zeros((m0 * 2, m1 * 2), numpy.uint8)
+    numpy.copyto(values[:n0, :n1], data, where=valid)
+    weights[:n0, :n1] = valid
+    sums = values[0::2, 0::2] + values[1::2, 0::2]
+    sums += values[0::2, 1::2]
+    sums += values[1::2, 1::2]
+    counts = weights[0::2, 0::2] + weights[1::2, 0::2]
+    counts += weights[0::2, 1::2]
+    counts += weights[1::2, 1::2]
+    empty = counts == 0
+    if empty.any():
+        counts[empty] = 1
+        sums /= counts
+        sums[empty] = numpy.nan
+        return sums
+    sums /= counts
+    return sums
+
+
+class ImagePyramid:
+    """An ImagePyramid is a stack of successively 2x-downsampled (area-averaged) versions of a 2D image.
+    Level 0 is the image itself, level n is downsampled by 2**n. Levels are generated lazily, on first request.
+    Pixel i of level n covers pixels i*2**n to (i+1)*2**n-1 of level 0, so its center is at level-0 coordinate
+    i*2**n + (2**n-1)/2, see toLevelCoordinates().
+    """
+    # levels are not generated beyond this size
+    MinSize = 4
+
+    def __init__(self, image, dtype=None):
+        """Dtype is the type of the downsampled levels, see downsample2()"""
+        self._levels = [image]
+        self._dtype = dtype
+        self._lock = threading.Lock()
+        # max level is the one where the smallest dimension drops to MinSize
+        nmin = min(image.shape)
+        self.max_level = max(0, int(math.floor(math.log2(nmin / self.MinSize)))) if nmin > self.MinSize else 0
+
+    def level(self, n):
+        """Returns level n of the pyramid (clipped to max_level), generating it if needed"""
+        n = min(n, self.max_level)
+        with self._lock:
+            while len(self._levels) <= n:
+                dprint(3, "generating pyramid level", len(self._levels))
+                self._levels.append(downsample2(self._levels[-1], self._dtype))
+            return self._levels[n]
+
+    @property
+    def nbytes(self):
+        """Size of the pyramid in bytes (for cache accounting, see RenderCache.sizeOf()), i.e. of all levels generated
+        so far. This includes level 0, since the pyramid keeps the image alive (e.g. after its plane has been evicted
+        from the plane cache)."""
+        with self._lock:
+            levels = list(self._levels)
+        nbytes = 0
+        for level in levels:
+            nbytes += numpy.ma.getdata(level).nbytes
+            if numpy.ma.getmask(level) is not numpy.ma.nomask:
+                nbytes += numpy.ma.getmask(level).nbytes
+        return nbytes
+
+    def levelForSampling(self, sampling):
+        """Returns the pyramid level appropriate for the given sampling factor (i.e. the number of image pixels
+        per screen pixel). This is the coarsest level that is still not coarser than the screen."""
+        if sampling < 2:
+            return 0
+        return min(int(math.floor(math.log2(sampling))), self.max_level)
+
+    @staticmethod
+    def toLevelCoordinates(n, coords):
+        """Converts (fractional) level-0 pixel coordinates into level-n coordinates"""
+        factor = 2 ** n
+        return (coords - (factor - 1) / 2.) / factor
@@ -26,8 +26,9 @@ import time
 import traceback
 
 import numpy
-from PyQt5.Qt import (QWidget, QFileDialog, QVBoxLayout, QApplication, QMenu, QClipboard, QInputDialog, QActionGroup, QTextOption, QFont)
-from PyQt5.QtCore import pyqtSignal
+from PyQt5.Qt import (QWidget, QFileDialog, QVBoxLayout, QHBoxLayout, QApplication, QMenu, QClipboard, QInputDialog,
+                      QActionGroup, QTextOption, QFont, QFrame, QProgressBar, QToolButton)
+from PyQt5.QtCore import pyqtSignal, QTimer
 from PyQt5.QtCore import Qt
 from PyQt5.QtWidgets import QDockWidget, QLabel, QPlainTextEdit
 from astropy.io import fits as pyfits
@@ -38,12 +39,78 @@ from TigGUI.Images import FITS_ExtensionList
 from TigGUI.Images import SkyImage
 from TigGUI.Images.SkyImage import FITSImagePlotItem
 from TigGUI.Images.Controller import ImageController, dprint
+from TigGUI.Images.CubePlayer import CubePlayer, DefaultFrameRate
+from TigGUI.Images.Expressions import ExpressionArray, evaluateExpression, trimShape
+from TigGUI.Images.RenderCache import getCacheManager
+from TigGUI.Images.Workers import BackgroundJob, getThreadPool
+from TigGUI.init import Config
 from TigGUI.kitties.utils import PersistentCurrier
 from TigGUI.kitties.widgets import BusyIndicator
 
 QStringList = list
 
 
+def _readImageJob(job, image, filename, lazy):
+    """Reads a FITS image and computes its initial statistics. This runs in a worker thread, so it must not touch the GUI."""
+    job.setProgress(0, "reading")
+    image.read(filename, lazy=lazy)
+    job.setProgress(.5, "computing statistics")
+    # the full-cube min/max of a lazily-loaded cube is computed on demand, so only do the current plane.
+    # (Cancelling the job interrupts this via job.setProgress().)
+    if not image.isLazy():
+        image.dataMinMax(progress=lambda fraction: job.setProgress(.5 + .45 * fraction, "computing statistics"))
+    image.imageMinMax()
+    job.setProgress(1, "done")
+    return image
+
+
+class ImageLoadIndicator(QFrame):
+    """Shows the progress of a background image load (or other action on an image file, such as an export), with a
+    button to cancel it"""
+
+    def __init__(self, filename, parent=None, action="Loading"):
+        QFrame.__init__(self, parent)
+        self.setFrameStyle(QFrame.StyledPanel | QFrame.Raised)
+        lo = QHBoxLayout(self)
+        lo.setContentsMargins(4, 2, 4, 2)
+        self._label = QLabel("%s %s" % (action, os.path.basename(filename)), self)
+        self._label.setToolTip(filename)
+        lo.addWidget(self._label, 1)
+        self._progress = QProgressBar(self)
+        self._progress.setRange(0, 100)
+        self._progress.setMaximumWidth(160)
+        lo.addWidget(self._progress)
+        self.cancel_button = QToolButton(self)
+        self.cancel_button.setText("Cancel")
+        self.cancel_button.setToolTip("Cancel %s this image" % action.lower())
+        lo.addWidget(self.cancel_button)
+
+    def setProgress(self, fraction, message):
+        self._progress.setValue(int(round(fraction * 100)))
+        self._progress.setFormat("%s %%p%%" % message if message else "%p%")
+
+
+class CacheUsageIndicator(QLabel):
+    """Shows the memory used by the image caches (see RenderCache.CacheManager), relative to the cache budget"""
+
+    UpdateInterval = 2000
+
+    def __init__(self, parent=None):
+        QLabel.__init__(self, parent)
+        self._timer = QTimer(self)
+        self._timer.timeout.connect(self.updateUsage)
+        self._timer.start(self.UpdateInterval)
+        self.updateUsage()
+
+    def updateUsage(self):
+        manager = getCacheManager()
+        self.setText("Image cache: %d/%d MB" % (manager.usage() // 2 ** 20, manager.budget() // 2 ** 20))
+        tiers = sorted(manager.usageByTier().items())
+        self.setToolTip("<P>Memory used by cached image data (the budget is set by the cache-budget-mb option "
+                        "in the [Tigger] section of ~/.tigger.conf)</P>" +
+                        "".join(["<P>%s: %.1f MB</P>" % (tier, nbytes / 2 ** 20) for tier, nbytes in tiers]))
+
+
 class ImageManager(QWidget):
     """An ImageManager manages a stack of images (and associated ImageControllers)"""
     showErrorMessage = pyqtSignal(str, int)
@@ -73,6 +140,14 @@ class ImageManager(QWidget):
         self._label_color = None
         self._label_bg_brush = None
         self._model_imagecons = set()
+        # background image loads (and other jobs, see showJobProgress()) in progress: dict of job -> ImageLoadIndicator
+        self._loading_jobs = {}
+        # cube playback of the topmost image
+        self._player = CubePlayer(self)
+        self._player.setFrameRate(Config.getfloat("playback-fps", DefaultFrameRate))
+        self._player.statusChanged.connect(self._showPlaybackStatus)
+        self._player.stopped.connect(self._playbackStopped)
+        self._qa_play = None
         # init menu and standard actions
         self._menu = QMenu("&Image", self)
         qag = QActionGroup(self)
@@ -98,6 +173,9 @@ class ImageManager(QWidget):
     def close(self):
         dprint(1, "closing Manager")
         self._closing = True
+        self._player.stop()
+        for job in list(self._loading_jobs.keys()):
+            job.cancel()
         for ic in self._imagecons:
             ic.close()
 
@@ -129,12 +207,14 @@ class ImageManager(QWidget):
         else:
             self.fits_info.clear()
 
-    def loadImage(self, filename=None, duplicate=True, to_top=True, model=None):
+    def loadImage(self, filename=None, duplicate=True, to_top=True, model=None, background=False):
         """Loads image. Returns ImageControlBar object.
         If image is already loaded: returns old ICB if duplicate=False (raises to top if to_top=True),
         or else makes a new control bar.
         If model is set to a source name, marks the image as associated with a model source. These can be unloaded en masse by calling
         unloadModelImages().
+        If background=True, the image is read in a worker thread (see loadImages()), and None is returned. The ImageController
+        is then created once the data is ready.
         """
         if filename is None:
             if not self._load_image_dialog:
@@ -142,9 +222,9 @@ class ImageManager(QWidget):
                                                                "FITS images (%s);;All files (*)" % (" ".join(
                                                                    ["*" + ext for ext in FITS_ExtensionList])),
                                                                options=QFileDialog.DontUseNativeDialog)
-                dialog.setFileMode(QFileDialog.ExistingFile)
+                dialog.setFileMode(QFileDialog.ExistingFiles)
                 dialog.setModal(True)
-                dialog.filesSelected['QStringList'].connect(self.loadImage)
+                dialog.filesSelected['QStringList'].connect(self.loadImages)
                 layout = dialog.layout()
                 if layout:
                     # FITS header preview pane
@@ -183,33 +263,101 @@ class ImageManager(QWidget):
                     if model:
                         self._model_imagecons.add(id(ic))
                     return ic
+        # large files are memory-mapped and read in one plane at a time
+        lazy_threshold = Config.getint("lazy-load-threshold-mb", FITSImagePlotItem.LazyLoadThreshold // 2 ** 20)
+        lazy = os.path.getsize(filename) >= lazy_threshold * 2 ** 20
+        if background:
+            self._startBackgroundLoad(filename, lazy, model)
+            return None
         # load the FITS image
         busy = BusyIndicator()
         dprint(2, "reading FITS image", filename)
         self.signalShowMessage.emit("""Reading FITS image %s""" % filename, 3000)
         QApplication.flush()
         try:
-            image = SkyImage.FITSImagePlotItem(str(filename))
+            image = SkyImage.FITSImagePlotItem(str(filename), lazy=lazy)
         except KeyboardInterrupt:
             raise
         except:
             busy.reset_cursor()
             traceback.print_exc()
-            print("""Error loading FITS image %s: %s. This may be due to a bug in Tigger; if the FITS file loads fine in another viewer,
-          please send the FITS file, along with a copy of any error messages from the text console, to osmirnov@gmail.com.""" % (
-                filename, str(sys.exc_info()[1])))
-            self.signalShowErrorMessage.emit("""<P>Error loading FITS image %s: %s. This may be due to a bug in Tigger; if the FITS file loads fine in another viewer,
-          please send the FITS file, along with a copy of any error messages from the text console, to osmirnov@gmail.com.</P>""" % (
-                filename, str(sys.exc_info()[1])))
+            self._reportLoadError(filename, str(sys.exc_info()[1]))
             return None
         # create control bar, add to widget stack
+        ic = self._attachLoadedImage(image, filename, model)
+        busy.reset_cursor()
+        return ic
+
+    def loadImages(self, filenames):
+        """Loads several images in parallel, in background threads. The ImageController for each image is attached
+        as soon as its data is ready."""
+        for filename in filenames:
+            self.loadImage(filename, background=True)
+
+    def _reportLoadError(self, filename, message):
+        print("""Error loading FITS image %s: %s. This may be due to a bug in Tigger; if the FITS file loads fine in another viewer,
+          please send the FITS file, along with a copy of any error messages from the text console, to osmirnov@gmail.com.""" % (
+            filename, message))
+        self.signalShowErrorMessage.emit("""<P>Error loading FITS image %s: %s. This may be due to a bug in Tigger; if the FITS file loads fine in another viewer,
+          please send the FITS file, along with a copy of any error messages from the text console, to osmirnov@gmail.com.</P>""" % (
+            filename, message))
+
+    def _attachLoadedImage(self, image, filename, model=None):
         ic = self._createImageController(image, "model source '%s'" % model if model else filename, model or image.name,
                                          model=model)
         print("""Loaded FITS image %s""" % filename)
         self.signalShowMessage.emit("""Loaded FITS image %s""" % filename, 3000)
-        busy.reset_cursor()
         return ic
 
+    def _startBackgroundLoad(self, filename, lazy, model=None):
+        """Starts reading a FITS image in the image loader thread pool, and shows a progress indicator for it"""
+        dprint(2, "reading FITS image", filename, "in background")
+        self.signalShowMessage.emit("""Reading FITS image %s""" % filename, 3000)
+        # the plot item is created here, in the GUI thread, so that its QObjects live in the right thread
+        image = SkyImage.FITSImagePlotItem()
+        job = BackgroundJob(_readImageJob, image, filename, lazy, description="load %s" % filename)
+        indicator = ImageLoadIndicator(filename, self)
+        self._lo.addWidget(indicator)
+        self._loading_jobs[job] = indicator
+        job.progress.connect(indicator.setProgress)
+        job.finished.connect(self._currier.curry(self._backgroundLoadFinished, job, filename, model))
+        job.failed.connect(self._currier.curry(self._backgroundLoadFailed, job, filename))
+        job.cancelled.connect(self._currier.curry(self._backgroundLoadCancelled, job, filename))
+        indicator.cancel_button.clicked.connect(lambda: job.cancel())
+        job.start(getThreadPool("loader", Config.getint("image-loader-threads", 4)))
+
+    def showJobProgress(self, job, filename, action):
+        """Shows the progress of a background job other than an image load (e.g. an export, see
+        ImageController._exportImage()), working on the given file, with a button to cancel it. The indicator is
+        removed when the job ends. Action describes the job, e.g. "Exporting"."""
+        indicator = ImageLoadIndicator(filename, self, action=action)
+        self._lo.addWidget(indicator)
+        self._loading_jobs[job] = indicator
+        job.progress.connect(indicator.setProgress)
+        indicator.cancel_button.clicked.connect(lambda: job.cancel())
+        for signal in job.finished, job.failed, job.cancelled:
+            signal.connect(lambda *args: self._endBackgroundLoad(job))
+
+    def _endBackgroundLoad(self, job):
+        indicator = self._loading_jobs.pop(job, None)
+        if indicator is not None:
+            self._lo.removeWidget(indicator)
+            indicator.setParent(None)
+            indicator.deleteLater()
+        return indicator is not None
+
+    def _backgroundLoadFinished(self, job, filename, model, image):
+        if self._endBackgroundLoad(job) and not self._closing:
+            self._attachLoadedImage(image, filename, model)
+
+    def _backgroundLoadFailed(self, job, filename, message):
+        if self._endBackgroundLoad(job) and not self._closing:
+            self._reportLoadError(filename, message)
+
+    def _backgroundLoadCancelled(self, job, filename):
+        if self._endBackgroundLoad(job) and not self._closing:
+            self.signalShowMessage.emit("""Cancelled loading FITS image %s""" % filename, 3000)
+
     def setZ0(self, z0):
         self._z0 = z0
         if self._imagecons:
@@ -289,6 +437,29 @@ class ImageManager(QWidget):
             if extra_axis < len(sliced_axes):
                 rc.incrementSlice(sliced_axes[extra_axis][0], incr)
 
+    def togglePlayback(self, *dum):
+        """Starts or stops playback of the topmost image along its first sliced axis"""
+        if self._player.isPlaying():
+            self._player.stop()
+        elif self._imagecons:
+            rc = self._imagecons[0].renderControl()
+            if rc.slicedAxes():
+                self._player.start(rc, rc.slicedAxes()[0][0])
+        if self._qa_play:
+            self._qa_play.setChecked(self._player.isPlaying())
+
+    def _setPlaybackRate(self, fps):
+        self._player.setFrameRate(fps)
+        Config.set("playback-fps", fps)
+
+    def _showPlaybackStatus(self, message):
+        if self.signalShowMessage:
+            self.signalShowMessage.emit(message, 2000)
+
+    def _playbackStopped(self):
+        if self._qa_play:
+            self._qa_play.setChecked(False)
+
     def setLMRectSubset(self, rect):
         if self._imagecons:
             self._imagecons[0].setLMRectSubset(rect)
@@ -306,6 +477,8 @@ class ImageManager(QWidget):
         """Unloads the given imagecon object."""
         if imagecon not in self._imagecons:
             return
+        if self._player.renderControl() is imagecon.renderControl():
+            self._player.stop()
         # recenter if needed
         self._imagecons.remove(imagecon)
         self._imagecon_loadorder.remove(imagecon)
@@ -368,9 +541,16 @@ class ImageManager(QWidget):
         else:
             self._imagecons[0].setZ(self._z0, top=True, depthlabel=None, can_raise=False)
             self._imagecons[0].setImageVisible(True)
+        # playback is of the topmost image only
+        if self._player.isPlaying() and self._player.renderControl() is not imagecon.renderControl():
+            self._player.stop()
         # update slice menus
         img = imagecon.image
         axes = imagecon.renderControl().slicedAxes()
+        if self._qa_play:
+            self._qa_play.setVisible(bool(axes))
+            if axes:
+                self._qa_play.setText("Play slices along %s axis" % axes[0][1])
         for i, (_next, _prev) in enumerate(self._qa_slices):
             _next.setVisible(False)
             _prev.setVisible(False)
@@ -451,10 +631,11 @@ class ImageManager(QWidget):
             path = QApplication.clipboard().text(self._clipboard_mode)
         except:
             return
-        self.loadImage(path)
+        self.loadImage(path, background=True)
 
     def _repopulateMenu(self):
         self._menu.clear()
+        self._qa_play = None
         self._menu.addAction("&Load image...", self.loadImage, Qt.CTRL + Qt.Key_L)
         self._menu.addAction("&Compute image...", self.computeImage, Qt.CTRL + Qt.Key_M)
         self._qa_load_clipboard = self._menu.addAction("Load from clipboard &path", self._loadClipboardPath,
@@ -478,6 +659,16 @@ class ImageManager(QWidget):
                                       Qt.Key_F8),
                  self._menu.addAction("Previous slice along axis 2", self._currier.curry(self.incrementSlice, 1, -1),
                                       Qt.SHIFT + Qt.Key_F8)))
+            self._qa_play = self._menu.addAction("Play slices along axis 1", self.togglePlayback, Qt.CTRL + Qt.Key_F7)
+            self._qa_play.setCheckable(True)
+            self._qa_play.setChecked(self._player.isPlaying())
+            rate_menu = self._menu.addMenu("Playback rate")
+            qag = QActionGroup(rate_menu)
+            for fps in (1, 2, 5, 10, 25, 50):
+                qa = rate_menu.addAction("%d frames/s" % fps, self._currier.curry(self._setPlaybackRate, fps))
+                qa.setCheckable(True)
+                qa.setChecked(fps == self._player.frameRate())
+                qag.addAction(qa)
             self._menu.addSeparator()
             self._menu.addAction(self._qa_plot_top)
             self._menu.addAction(self._qa_plot_all)
@@ -513,38 +704,33 @@ class ImageManager(QWidget):
         busy = BusyIndicator()
         QApplication.flush()
 
-        # trim trivial trailing dimensions. This avoids the problem of when an NxMx1 and an NxMx1x1 arrays are added,
-        # the result is promoted to NxMxMx1 following the numpy rules.
-        def trimshape(shape):
-            out = shape
-            while out and out[-1] == 1:
-                out = out[:-1]
-            return out
-
-        def trimarray(array):
-            return array.reshape(trimshape(array.shape))
-
+        # elementwise expressions are evaluated chunk by chunk, and for cubes, not until planes are displayed.
+        # Scaled integer data (see SkyImage.ScaledData) is only converted chunk by chunk, or plane by plane.
         try:
-            result = exprfunc(*[trimarray(x[1].data()) for x in arglist])
+            result, converted = evaluateExpression(exprfunc, expression, [x[0] for x in arglist],
+                                                   [x[1].data() for x in arglist])
         except Exception as exc:
             busy.reset_cursor()
             traceback.print_exc()
             self.signalShowErrorMessage.emit("""Error evaluating "%s": %s.""" % (expression, str(exc)))
             return None
         busy.reset_cursor()
-        if type(result) != numpy.ma.masked_array and type(result) != numpy.ndarray:
+        if type(result) not in (numpy.ma.masked_array, numpy.ndarray, numpy.memmap, ExpressionArray):
             self.signalShowErrorMessage.emit(
                 """Result of "%s" is of invalid type "%s" (array expected).""" % (expression, type(result).__name__))
             return None
+        if numpy.ma.isMA(result) and numpy.issubdtype(result.dtype, numpy.inexact):
+            result = result.filled(numpy.nan)
         # convert coomplex results to real
-        if numpy.iscomplexobj(result):
+        if converted or numpy.iscomplexobj(result):
             self.signalShowErrorMessage.emit("""Result of "%s" is complex. Complex images are currently
       not fully supported, so we'll implicitly use the absolute value instead.""" % (expression))
             expression = "abs(%s)" % expression
-            result = abs(result)
+            if not converted:
+                result = abs(result)
         # determine which image this expression can be associated with
-        res_shape = trimshape(result.shape)
-        arglist = [x for x in arglist if hasattr(x[1], 'fits_header') and trimshape(x[1].data().shape) == res_shape]
+        res_shape = trimShape(result.shape)
+        arglist = [x for x in arglist if hasattr(x[1], 'fits_header') and trimShape(x[1].data().shape) == res_shape]
         if not arglist:
             self.signalShowErrorMessage.emit("""Result of "%s" has shape %s, which does not match any loaded FITS image.""" % (
                 expression, "x".join(map(str, result.shape))))
@@ -675,11 +861,20 @@ class ImageManager(QWidget):
                 template.fits_header = _header
 
             # create new FITS file
-            hdu = pyfits.PrimaryHDU(result.transpose(), template.fits_header)
-            hdu.verify('fix')
-            skyimage = SkyImage.FITSImagePlotItem(name=expression,
-                                                  filename=None,
-                                                  hdu=hdu)
+            if isinstance(result, ExpressionArray):
+                # the HDU only supplies the header here: give it a placeholder (taking no memory) of the right shape
+                placeholder = numpy.broadcast_to(numpy.zeros((), result.dtype), result.shape[::-1])
+                hdu = pyfits.PrimaryHDU(placeholder, template.fits_header)
+                hdu.verify('fix')
+                skyimage = SkyImage.FITSImagePlotItem(name=expression,
+                                                      filename=None,
+                                                      hdu=hdu, virtual=result)
+            else:
+                hdu = pyfits.PrimaryHDU(result.transpose(), template.fits_header)
+                hdu.verify('fix')
+                skyimage = SkyImage.FITSImagePlotItem(name=expression,
+                                                      filename=None,
+                                                      hdu=hdu)
         except:
             busy.reset_cursor()
             traceback.print_exc()
@@ -0,0 +1,162 @@
+# Copyright (C) 2002-2022
+# The MeqTree Foundation &
+# ASTRON (Netherlands Foundation for Research in Astronomy)
+# P.O.Box 2, 7990 AA Dwingeloo, The Netherlands
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>,
+# or write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+import collections
+import threading
+
+import numpy
+import numpy.ma
+from PyQt5.Qt import QImage
+
+import TigGUI.kitties.utils
+from TigGUI.init import Config
+
+_verbosity = TigGUI.kitties.utils.verbosity(name="rendercache")
+dprint = _verbosity.dprint
+dprintf = _verbosity.dprintf
+
+# default memory budget for all image caches, in megabytes. Can be changed via the cache-budget-mb config option.
+DefaultBudgetMB = 1024
+
+
+def sizeOf(value):
+    """Returns the (approximate) size of a cached value in bytes"""
+    if value is None or value is False:
+        return 0
+    if isinstance(value, numpy.ma.MaskedArray):
+        mask = numpy.ma.getmask(value)
+        return value.data.nbytes + (0 if mask is numpy.ma.nomask else mask.nbytes)
+    if isinstance(value, QImage):
+        return value.byteCount()
+    # numpy arrays, and anything else that reports its size (see e.g. ImagePyramid)
+    return getattr(value, 'nbytes', 0)
+
+
+class CacheManager:
+    """The CacheManager holds the contents of all ManagedCaches (across all images and cache tiers) in a single
+    least-recently-used list, and evicts the oldest entries whenever their total size exceeds the memory budget."""
+
+    def __init__(self, budget):
+        self._budget = budget
+        # dict of (cache,key) -> (value,nbytes), in LRU order
+        self._entries = collections.OrderedDict()
+        self._lock = threading.RLock()
+        self._usage = 0
+        self._tier_usage = collections.defaultdict(int)
+
+    def budget(self):
+        return self._budget
+
+    def setBudget(self, budget):
+        with self._lock:
+            self._budget = budget
+            self._evict()
+
+    def usage(self):
+        """Returns total size of cached data, in bytes"""
+        return self._usage
+
+    def usageByTier(self):
+        """Returns dict of tier name -> size of cached data in that tier, in bytes"""
+        with self._lock:
+            return dict([(tier, nbytes) for tier, nbytes in self._tier_usage.items() if nbytes])
+
+    def _get(self, cache, key, default):
+        with self._lock:
+            entry = self._entries.get((cache, key))
+            if entry is None:
+                return default
+            self._entries.move_to_end((cache, key))
+            return entry[0]
+
+    def _put(self, cache, key, value, nbytes):
+        with self._lock:
+            self._remove(cache, key)
+            self._entries[cache, key] = value, nbytes
+            cache._keys.add(key)
+            self._usage += nbytes
+            self._tier_usage[cache.tier] += nbytes
+            self._evict()
+
+    def _remove(self, cache, key):
+        entry = self._entries.pop((cache, key), None)
+        if entry is not None:
+            cache._keys.discard(key)
+            self._usage -= entry[1]
+            self._tier_usage[cache.tier] -= entry[1]
+
+    def _clear(self, cache):
+        with self._lock:
+            for key in list(cache._keys):
+                self._remove(cache, key)
+
+    def _evict(self):
+        # the most recently used entry is never evicted, even if it exceeds the budget on its own
+        while self._usage > self._budget and len(self._entries) > 1:
+            (cache, key), (value, nbytes) = next(iter(self._entries.items()))
+            dprint(3, "evicting", cache.tier, key, nbytes, "bytes")
+            self._remove(cache, key)
+
+
+_cache_manager = None
+
+
+def getCacheManager():
+    """Returns the global CacheManager, creating it if needed"""
+    global _cache_manager
+    if _cache_manager is None:
+        _cache_manager = CacheManager(Config.getint("cache-budget-mb", DefaultBudgetMB) * 2 ** 20)
+    return _cache_manager
+
+
+class ManagedCache:
+    """A ManagedCache is a key-value cache whose contents are held by the global CacheManager, and are subject to
+    its memory budget and LRU eviction. Each ManagedCache belongs to a cache tier (e.g. "tiles"), which is
+    used to report memory usage. Since the manager refers to its ManagedCaches, these should be explicitly
+    cleared when no longer needed."""
+
+    def __init__(self, tier, manager=None):
+        self.tier = tier
+        self._manager = manager or getCacheManager()
+        self._keys = set()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __hash__(self):
+        return id(self)
+
+    def __eq__(self, other):
+        return self is other
+
+    def get(self, key, default=None):
+        return self._manager._get(self, key, default)
+
+    def put(self, key, value, nbytes=None):
+        """Puts value into cache. Size is determined by sizeOf() unless supplied. Putting a value under an existing
+        key replaces it, which can also be used to update the size of an entry."""
+        self._manager._put(self, key, value, sizeOf(value) if nbytes is None else nbytes)
+
+    def clear(self):
+        self._manager._clear(self)
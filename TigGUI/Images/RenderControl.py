@@ -25,11 +25,14 @@ import os.path
 import time
 from PyQt5.Qt import QObject
 from PyQt5.QtCore import pyqtSignal
-from scipy.ndimage import measurements
 import numpy as np
 
 import TigGUI.kitties.utils
 from TigGUI.Images.Colormaps import HistEqIntensityMap, LogIntensityMap, CubeHelixColormap
+from TigGUI.Images.SlicePrefetcher import SlicePrefetcher
+from TigGUI.Images.Statistics import computeStats
+from TigGUI.Images.StatsCache import StatsCache
+from TigGUI.Images.Workers import BackgroundJob
 from TigGUI.kitties.widgets import BusyIndicator
 
 _verbosity = TigGUI.kitties.utils.verbosity(name="rc")
@@ -44,6 +47,11 @@ import TigGUI.kitties.config
 ImageConfigFile = TigGUI.kitties.config.DualConfigParser("tigger.images.conf")
 
 
+def _fullRangeJob(job, image):
+    """Background job function for RenderControl: computes the min/max of the full datacube"""
+    return tuple(image.dataMinMax(progress=lambda fraction: job.setProgress(fraction, "computing cube min/max"))[:2])
+
+
 class RenderControl(QObject):
     """RenderControl represents all the options (slices, color and intensity policy data) associated with an image. This object is shared by various GUI elements
     that control the rendering of images.
@@ -53,6 +61,8 @@ class RenderControl(QObject):
     dataSubsetChanged = pyqtSignal(np.ndarray, tuple, str, str)
     displayRangeChanged = pyqtSignal([float, float], [np.float32, np.float32], [HistEqIntensityMap, float])  # on file save np.float32's become float's on reload?
     displayRangeLocked = pyqtSignal(bool)
+    # progress(fraction, message) of the full-cube min/max, when this is computed in the background (see setFullSubset())
+    fullRangeProgress = pyqtSignal(float, str)
 
     SUBSET_FULL = "full"
     SUBSET_SLICE = "slice"
@@ -76,9 +86,17 @@ class RenderControl(QObject):
             if len(labels) > 1:
                 self._sliced_axes.append((i, axisname, labels))
         # set the full image range (i.e. mix/max) and current slice range
-        dprint(2, "getting data min/max")
-        self._fullrange = self._slicerange = image.dataMinMax()[:2]
-        dprint(2, "done")
+        # for lazily-loaded cubes, the full range is taken from the statistics cache if it is there, else it is
+        # only computed on demand (see setFullSubset()), since it needs a pass over the whole cube
+        if image.isLazy():
+            cache = image.statsCache()
+            fullrange = cache and cache.getMinMax(StatsCache.FULL)
+            self._fullrange = tuple(fullrange[:2]) if fullrange else None
+            self._slicerange = None
+        else:
+            dprint(2, "getting data min/max")
+            self._fullrange = self._slicerange = image.dataMinMax()[:2]
+            dprint(2, "done")
         # create dict of intensity maps
         log_cycles = self._config.getfloat("intensity-log-cycles", 6) if self._config else 6
         self._imap_list = (
@@ -108,6 +126,11 @@ class RenderControl(QObject):
 
         # cache of min/max values for each slice, as these can be slowish to recompute when flipping slices
         self._sliceranges = {}
+        # background prefetcher of planes adjacent to the current slice, which also fills in _sliceranges
+        self._prefetcher = None
+        if self.hasSlicing():
+            self._prefetcher = SlicePrefetcher(image, self._slice_dims, self)
+            self._prefetcher.sliceRangeReady.connect(self._setSliceRange)
         # This is the data subset corresponding to the current display range. When the display range is set to
         # _fullrange, this is the image cube. When it is set to _slicerange, this is the current image slice. When
         # setLMRectDisplayRange() or setWindowDisplayRange() is used to set the range to the specified window,
@@ -124,9 +147,14 @@ class RenderControl(QObject):
             display_range = self._config.getfloat("range-min"), self._config.getfloat("range-max")
         else:
             display_range = None
-        self.setFullSubset(display_range, write_config=False)
+        # background job computing the full range (see setFullSubset()), and the (display_range, write_config)
+        # arguments of a setFullSubset() call waiting for it
+        self._fullrange_job = None
+        self._fullrange_request = None
+        if not image.isLazy():
+            self.setFullSubset(display_range, write_config=False)
         # setup initial slice
-        if self.hasSlicing():
+        if self.hasSlicing() or image.isLazy():
             if self._config and self._config.has_option("slice"):
                 try:
                     curslice = list(map(int, self._config.get("slice").split()))
@@ -138,6 +166,9 @@ class RenderControl(QObject):
                         i = min(naxis - 1, max(0, i))
                         self._current_slice[iaxis] = i
             self.selectSlice(self._current_slice, write_config=False)
+            # in lazy mode, the display range has not been set yet, so initialize it from the slice
+            if self._displayrange is None:
+                self.setDisplayRange(write_config=False, *(display_range or self._slicerange))
         # lock display range if so configured
         self._lock_display_range = self._config.getbool("lock-range", 0) if self._config else False
         if self._lock_display_range:
@@ -198,8 +229,23 @@ class RenderControl(QObject):
         self.setSliceSubset(set_display_range=False)
         if write_config and self._config:
             self._config.set("slice", " ".join(map(str, indices)))
+        if self._prefetcher:
+            self._prefetcher.sliceChanged(indices)
         busy.reset_cursor()
 
+    def _setSliceRange(self, indices, minmax):
+        """Called when the prefetcher has computed the min/max of a slice"""
+        self._sliceranges.setdefault(tuple(indices), tuple(minmax[:2]))
+
+    def setPrefetchEnabled(self, enabled):
+        if self._prefetcher:
+            self._prefetcher.setEnabled(enabled)
+
+    def cancelPrefetch(self):
+        """Stops background prefetching of slices. Called when the image is unloaded."""
+        if self._prefetcher:
+            self._prefetcher.cancel()
+
     def displayRange(self):
         return self._displayrange
 
@@ -273,9 +319,11 @@ class RenderControl(QObject):
     def _resetDisplaySubset(self, subset, desc, range=None, set_display_range=True, write_config=True,
                             subset_type=None):
         dprint(4, "setting display subset")
+        # a full subset still waiting for the full range is superseded by this one
+        self._fullrange_request = None
         self._displaydata = subset
         self._displaydata_desc = desc
-        self._displaydata_minmax = range = range or measurements.extrema(subset)[:2]
+        self._displaydata_minmax = range = range or computeStats(*self.image.optimalRavel(subset)).minMax()
         self._displaydata_type = subset_type
         dprint(4, "range set")
         self.image.intensityMap().setDataSubset(self._displaydata, minmax=range)
@@ -290,10 +338,44 @@ class RenderControl(QObject):
                                     list(self.image.imageDims()) + [len(labels) for iaxis, name, labels in
                                                                     self._sliced_axes]])
         desc = "full cube" if self._sliced_axes else "full image"
+        if self._fullrange is None:
+            # this needs a pass over a lazily-loaded cube, so is done in the background, and the subset is set
+            # once the range is known (see _fullRangeReady())
+            self._fullrange_request = display_range, write_config
+            if self._fullrange_job is None:
+                dprint(2, "computing data min/max in the background")
+                job = self._fullrange_job = BackgroundJob(_fullRangeJob, self.image,
+                                                          description="min/max of %s" % self.image.name)
+                job.progress.connect(self.fullRangeProgress.emit)
+                job.finished.connect(self._fullRangeReady)
+                job.failed.connect(self._fullRangeFailed)
+                job.start()
+            return
         self._resetDisplaySubset(self.image.data(), desc, range=self._fullrange, subset_type=self.SUBSET_FULL,
                                  write_config=write_config, set_display_range=False)
         self.setDisplayRange(write_config=write_config, *(display_range or self._fullrange))
 
+    def isComputingFullRange(self):
+        """Returns True if setFullSubset() is waiting for the full range to be computed"""
+        return self._fullrange_request is not None
+
+    def cancelFullRange(self):
+        """Stops any computation of the full range. Called when the image is unloaded."""
+        if self._fullrange_job is not None:
+            self._fullrange_job.cancel()
+            self._fullrange_job = self._fullrange_request = None
+
+    def _fullRangeReady(self, fullrange):
+        self._fullrange_job = None
+        self._fullrange = fullrange
+        if self._fullrange_request is not None:
+            display_range, write_config = self._fullrange_request
+            self.setFullSubset(display_range, write_config)
+
+    def _fullRangeFailed(self, message):
+        self._fullrange_job = self._fullrange_request = None
+        print("Error computing min/max of %s: %s" % (self.image.name, message))
+
     def _makeSliceDesc(self):
         """Makes a description of the current slice"""
         if not self._sliced_axes:
@@ -355,11 +437,8 @@ class RenderControl(QObject):
         if xx1 is not None:
             subset = self.image.image()[xx1:xx2, yy1:yy2]
             subset, mask = self.image.optimalRavel(subset)
-            mmin, mmax = measurements.extrema(subset, labels=mask, index=None if mask is None else False)[:2]
-            mean = measurements.mean(subset, labels=mask, index=None if mask is None else False)
-            std = measurements.standard_deviation(subset, labels=mask, index=None if mask is None else False)
-            ssum = measurements.sum(subset, labels=mask, index=None if mask is None else False)
-            return xx1, xx2, yy1, yy2, mmin, mmax, mean, std, ssum, subset.size
+            stats = computeStats(subset, mask)
+            return xx1, xx2, yy1, yy2, stats.min, stats.max, stats.mean, stats.std, stats.sum, subset.size
         return None
 
     def setWindowSubset(self, rect=None):
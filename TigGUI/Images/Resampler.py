@@ -0,0 +1,124 @@
+# Copyright (C) 2002-2022
+# The MeqTree Foundation &
+# ASTRON (Netherlands Foundation for Research in Astronomy)
+# P.O.Box 2, 7990 AA Dwingeloo, The Netherlands
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>,
+# or write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""Separable resampling of images onto screen grids, as a faster alternative to scipy.ndimage.map_coordinates().
+Since the image x coordinate of a screen pixel depends only on its column, and the y coordinate only on its row,
+resampling is done in two 1D passes using per-axis tables of pixel indices and kernel weights. Points outside
+the image come out as NaN, as with map_coordinates(mode="constant", cval=NaN)."""
+
+import numpy
+import numpy.ma
+import scipy.sparse
+
+# number of kernel taps for each interpolation order
+_NumTaps = {0: 1, 1: 2, 2: 3, 3: 4}
+
+
+def axisKernel(coords, n, order):
+    """Makes the interpolation table for one axis of length n. Coords is a 1D array of (fractional) pixel coordinates,
+    order is 0 for nearest-neighbour, 1 for linear, 2 or 3 for quadratic or cubic B-splines.
+    Returns tuple of (index, weights, valid), where index and weights are [len(coords),ntaps] arrays of
+    pixel indices and their weights, and valid is a boolean array which is False for coordinates outside the axis."""
+    if order not in _NumTaps:
+        raise ValueError("unsupported interpolation order %s" % order)
+    coords = numpy.asarray(coords, float)
+    valid = (coords >= 0) & (coords <= n - 1)
+    if order == 0:
+        base = numpy.floor(coords + .5)
+        weights = numpy.ones((len(coords), 1))
+    elif order == 1:
+        base = numpy.floor(coords)
+        t = coords - base
+        weights = numpy.stack([1 - t, t], axis=1)
+    elif order == 2:
+        base = numpy.floor(coords + .5)
+        t = coords - base
+        weights = numpy.stack([.5 * (.5 - t) ** 2, .75 - t ** 2, .5 * (.5 + t) ** 2], axis=1)
+        base -= 1
+    else:
+        base = numpy.floor(coords)
+        t = coords - base
+        t2, t3 = t ** 2, t ** 3
+        weights = numpy.stack([(1 - t) ** 3 / 6, (4 - 6 * t2 + 3 * t3) / 6, (1 + 3 * t + 3 * t2 - 3 * t3) / 6, t3 / 6],
+                              axis=1)
+        base -= 1
+    # out-of-range coordinates are not used, so simply clip them to keep the indices sane
+    base = numpy.where(valid, base, 0).astype(int)
+    index = base[:, numpy.newaxis] + numpy.arange(_NumTaps[order])
+    # taps beyond the edges of the axis are mirrored back in (as does map_coordinates())
+    index = numpy.abs(index)
+    index = numpy.where(index > n - 1, 2 * (n - 1) - index, index).clip(0, n - 1)
+    return index, weights, valid
+
+
+def zeroNonFinite(data):
+    """Returns data (a plain or masked array) as a plain array with undefined (masked or non-finite) values set to 0,
+    which is how undefined pixels are rendered. Data is only copied if it has undefined values."""
+    mask = numpy.ma.getmask(data)
+    data = numpy.ma.getdata(data)
+    undefined = ~numpy.isfinite(data)
+    if mask is not numpy.ma.nomask:
+        undefined |= mask
+    if undefined.any():
+        data = data.copy()
+        data[undefined] = 0
+    return data
+
+
+def _kernelMatrix(index, weights, n, dtype):
+    """Converts an interpolation table (see axisKernel()) into a sparse [len(index),n] matrix"""
+    npoints, ntaps = index.shape
+    return scipy.sparse.csr_matrix((weights.astype(dtype).ravel(), index.ravel(), numpy.arange(0, npoints * ntaps + 1, ntaps)),
+                                   shape=(npoints, n))
+
+
+def resample(image, coords0, coords1, order=1, dtype=None):
+    """Resamples a 2D image at the grid of points given by 1D coordinate arrays coords0 and coords1
+    (fractional pixel coordinates along the first and second axis of the image). Order is the interpolation order
+    (see axisKernel()), or a tuple of orders for each axis. Returns a [len(coords0),len(coords1)] array, with NaNs at
+    points outside the image. Undefined pixels of the image are treated as 0, see zeroNonFinite().
+    The result is of the given (floating-point) type, default is the image type, promoted to at least float32."""
+    order0, order1 = order if isinstance(order, tuple) else (order, order)
+    data = numpy.ma.getdata(image)
+    if dtype is None:
+        dtype = numpy.result_type(data.dtype, numpy.float32)
+    index0, weights0, valid0 = axisKernel(coords0, data.shape[0], order0)
+    index1, weights1, valid1 = axisKernel(coords1, data.shape[1], order1)
+    result = numpy.full((len(valid0), len(valid1)), numpy.nan, dtype)
+    if not valid0.any() or not valid1.any():
+        return result
+    # only the part of the image that is referenced by valid points needs to be resampled
+    rows0, rows1 = valid0.nonzero()[0], valid1.nonzero()[0]
+    index0, weights0 = index0[rows0], weights0[rows0]
+    index1, weights1 = index1[rows1], weights1[rows1]
+    lo0, lo1 = index0.min(), index1.min()
+    block = zeroNonFinite(image[lo0:index0.max() + 1, lo1:index1.max() + 1])
+    # each pass is a product with a sparse [npoints,npixels] matrix of kernel weights (duplicate indices, as
+    # produced by mirroring at the edges, are summed by the product)
+    matrix0 = _kernelMatrix(index0 - lo0, weights0, block.shape[0], dtype)
+    matrix1 = _kernelMatrix(index1 - lo1, weights1, block.shape[1], dtype)
+    out = matrix0 @ (matrix1 @ block.T).T
+    # for monotonic coordinates (the usual case) the valid points form a contiguous block
+    if rows0[-1] - rows0[0] == len(rows0) - 1 and rows1[-1] - rows1[0] == len(rows1) - 1:
+        result[rows0[0]:rows0[-1] + 1, rows1[0]:rows1[-1] + 1] = out
+    else:
+        result[numpy.ix_(rows0, rows1)] = out
+    return result
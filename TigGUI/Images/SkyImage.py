@@ -19,10 +19,13 @@
 # 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 #
 
+import concurrent.futures
+import itertools
 import math
 
 import numpy
 import numpy.ma
+import os
 import os.path
 import time
 
@@ -30,7 +33,7 @@ from PyQt5 import QtCore
 from PyQt5.Qt import QObject, QRect, QRectF, QPointF, QPoint, QSizeF
 from PyQt5.Qwt import QwtPlotItem
 from PyQt5.QtCore import pyqtSignal
-from scipy.ndimage import interpolation, measurements
+from scipy.ndimage import interpolation
 
 import TigGUI.kitties.utils
 
@@ -38,6 +41,13 @@ from astropy.io import fits as pyfits
 
 from Tigger.Coordinates import Projection
 from TigGUI.Images import Colormaps
+from TigGUI.Images import StatsCache
+from TigGUI.Images.ImagePyramid import ImagePyramid
+from TigGUI.Images.RenderCache import ManagedCache
+from TigGUI.Images.Resampler import resample, zeroNonFinite
+from TigGUI.Images.Statistics import computeStats
+from TigGUI.Images.Workers import getThreadPool
+from TigGUI.init import Config
 from Tigger.Tools import FITSHeaders
 
 
@@ -58,14 +68,28 @@ class SkyImagePlotItem(QwtPlotItem, QObject):
         # internal init
         self.RenderAntialiased
         self._qo = QObject()
-        self.qimg = None
         self._image = self._imgminmax = None
+        # ScaledData of the raw image, if the image holds raw integer values that are scaled (see dataScaling())
+        self._scaled = None
         self._nvaluecalls = 0
         self._value_time = self._value_time0 = None
         self._lminmax = (0, 0)
         self._mminmax = (0, 0)
-        self._cache_qimage = {}
-        self._cache_mapping = self._cache_imap = self._cache_interp = None
+        # rendered tiles (QImages), interpolated and quantized tiles (see _renderTile()), spline-prefiltered blocks
+        # of each plane (see _prefilteredRegion()), and per-plane image pyramids. These are all subject to the global
+        # cache memory budget (see RenderCache).
+        self._cache_tiles = ManagedCache("tiles")
+        self._cache_interp_tiles = ManagedCache("interpolated tiles")
+        self._cache_quant_tiles = ManagedCache("quantized tiles")
+        self._cache_prefilter = ManagedCache("prefilters")
+        self._cache_pyramid = ManagedCache("pyramids")
+        # render tables by (render version, image key, quantization range), see _renderTable()
+        self._render_tables = {}
+        # view (zoom and tile range) of the last draw(), used by prerenderPlane()
+        self._last_view = None
+        # number of render threads, see renderThreads(), and render precision, see renderDtype()
+        self._render_threads = None
+        self._render_precision = None
         self._psfsize = 0, 0, 0
         #self.projection = None
         self._nx, self._ny = 0, 0
@@ -77,7 +101,6 @@ class SkyImagePlotItem(QwtPlotItem, QObject):
         self._bounding_rect = None
         self._bounding_rect_pix = None
         self._image_key = None
-        self._prefilter = None
         self._current_rect = None
         self._current_rect_pix = None
         # set image, if specified
@@ -90,6 +113,11 @@ class SkyImagePlotItem(QwtPlotItem, QObject):
         # set default colormap and intensity map
         self.colormap = Colormaps.GreyscaleColormap
         self.imap = Colormaps.LinearIntensityMap()
+        # state used for rendering: tuple of (render_version, imap_version, imap, colormap), where imap is a frozen
+        # copy of the intensity map. The render version changes whenever the colormap or the mapping done by the
+        # intensity map changes, as this invalidates rendered tiles, and the imap version whenever the latter
+        # changes, as this invalidates quantized tiles of non-linear maps. See _publishRenderState().
+        self._render_state = 0, 0, self.imap.copy().freeze(), self.colormap
         self.signalRepaint = None
         self.signalSlice = None
         self.signalRaise = None
@@ -121,30 +149,56 @@ class SkyImagePlotItem(QwtPlotItem, QObject):
 
     def clearDisplayCache(self):
         """Clears all display caches."""
-        self._cache_qimage = {}
-        self._cache_interp = self._cache_imap = None
+        self._cache_tiles.clear()
+        self._cache_interp_tiles.clear()
+        self._cache_quant_tiles.clear()
+        self._cache_prefilter.clear()
+        self._cache_pyramid.clear()
+
+    def releaseCaches(self):
+        """Releases all cached data held on behalf of this image. Called when the image is unloaded."""
+        self.clearDisplayCache()
 
     def setColorMap(self, cmap=None, emit=True):
         """Changes the colormap. If called with no arguments, clears colormap-dependent caches"""
-        self._cache_qimage = {}
         if cmap:
             self.colormap = cmap
+        self._publishRenderState(new_colors=True)
         if emit:
             self.signalRepaint.emit()
 
     def updateCurrentColorMap(self):
-        self._cache_qimage = {}
+        self._publishRenderState(new_colors=True)
         self.signalRepaint.emit()
 
     def setIntensityMap(self, imap=None, emit=True):
-        """Changes the intensity map. If called with no arguments, clears intensity map-dependent caches"""
-        self._cache_qimage = {}
-        self._cache_imap = None
+        """Changes the intensity map. If called with no arguments, clears intensity map-dependent caches.
+        The GUI modifies the intensity map in place, so rendering (which also happens in worker threads, see
+        prerenderPlane() and renderRows()) uses a frozen copy of it, which is taken here. Changes to the map take
+        effect when this is called. Rendered tiles are only invalidated if the mapping has actually changed (e.g.
+        selecting another slice of a cube resets the map's data subset, but leaves the mapping alone if the display
+        range is unchanged), so that planes rendered ahead by prerenderPlane() stay valid."""
         if imap:
             self.imap = imap
+        self._publishRenderState(self.imap.copy().freeze())
         if emit:
             self.signalRepaint.emit()
 
+    def _publishRenderState(self, imap=None, new_colors=False):
+        """Sets up a new render state (see __init__) with the given frozen intensity map (default keeps the current
+        one) and the current colormap. The render version is changed if new_colors is True, or if the mapping done by
+        the intensity map has changed. The state is published as a single tuple, so rendering threads
+        (see prerenderPlane()) always see a consistent version and intensity map."""
+        render_version, imap_version, render_imap, _ = self._render_state
+        if imap is not None:
+            if imap.renderState() != render_imap.renderState():
+                imap_version += 1
+                new_colors = True
+            render_imap = imap
+        if new_colors:
+            render_version += 1
+        self._render_state = render_version, imap_version, render_imap, self.colormap
+
     def colorMap(self):
         return self.colormap
 
@@ -206,35 +260,76 @@ class SkyImagePlotItem(QwtPlotItem, QObject):
         self._imgminmax = minmax
         self._image_key = key
         # clear intermediate caches
-        self._prefilter = self._cache_interp = self._cache_imap = None
-        # if key is None, also clear QImage cache -- it only works when we have images identified by keys
+        # if key is None, clear display caches -- they only work when we have images identified by keys
         if key is None:
-            self._cache_qimage = {}
+            self.clearDisplayCache()
 
     def image(self):
-        """Returns image array."""
-        return self._image
+        """Returns image array, in physical units (see dataScaling())."""
+        return self._image if self._scaled is None else ScaledData(self._image, *self.dataScaling())
+
+    def dataScaling(self):
+        """Returns (bscale, bzero) if the image holds raw integer values that are converted into physical values as
+        raw*bscale+bzero (see ScaledData), else None. The image is rendered in raw form: the intensity map and
+        render tables work in physical units, and the quantization range is converted (see _quantizeTile())."""
+        return None if self._scaled is None else (self._scaled.bscale, self._scaled.bzero)
 
     def imagePixel(self, x, y):
+        """Returns tuple of (value, undefined) for pixel x,y of the image. Undefined pixels are masked or non-finite."""
         if numpy.ma.isMA(self._image):
             return self._image.data[x, y], self._image.mask[x, y]
         else:
-            return self._image[x, y], False
+            value = self._image[x, y] if self._scaled is None else self._scaled.scale(self._image[x, y])
+            return value, not numpy.isfinite(value)
+
+    def _computeStats(self, array, progress=None):
+        """Computes Stats of an image or datacube array (in raw form, see dataScaling()), in physical units"""
+        stats = computeStats(*self.optimalRavel(array), progress=progress)
+        return stats if self._scaled is None else stats.scaled(*self.dataScaling())
 
     def imageMinMax(self):
         if not self._imgminmax:
             dprint(3, "computing image min/max")
-            rdata, rmask = self.optimalRavel(self._image)
-            try:
-                self._imgminmax = measurements.extrema(rdata, labels=rmask, index=None if rmask is None else False)[:2]
-            except:
-                # when all data is masked, some versions of extrema() throw an exception
-                self._imgminmax = numpy.nan, numpy.nan
+            self._imgminmax = self._computeStats(self._image).minMax()
             dprint(3, self._imgminmax)
         return self._imgminmax
 
+    # size of render tiles, in screen pixels
+    TileSize = 256
+
+    def setRenderThreads(self, nthreads):
+        """Sets the number of threads used to render tiles. If 0 or None, the render-threads config option is used."""
+        self._render_threads = nthreads
+
+    def renderThreads(self):
+        """Returns the number of threads used to render tiles. This is set by setRenderThreads(), or else by the
+        render-threads config option, with 0 meaning one thread per CPU."""
+        return self._render_threads or Config.getint("render-threads", 0) or os.cpu_count() or 1
+
+    def setRenderPrecision(self, precision):
+        """Sets the precision of the render pipeline, "single" or "double" (see renderDtype()). If None, the
+        render-precision config option is used."""
+        self._render_precision = precision
+        # intermediate caches hold data of the render type
+        self.clearDisplayCache()
+
+    def renderDtype(self, dtype):
+        """Returns the floating-point type in which data of the given type is rendered, i.e. the type of the
+        interpolated tiles, spline prefilters and image pyramids. In single precision (the default), this is float32
+        for float32 data (the usual FITS images) and integers of up to 16 bits, which halves the memory traffic and
+        cache footprint of rendering compared to double precision. Float64 data is always rendered in double precision,
+        as a narrow display range within a wide data range could otherwise come out posterized."""
+        precision = self._render_precision or Config.get("render-precision", "single")
+        return numpy.result_type(dtype, numpy.float64 if precision == "double" else numpy.float32)
+
     def draw(self, painter, xmap, ymap, rect, use_cache=True):
-        """Implements QwtPlotItem.draw(), to render the image on the given painter."""
+        """Implements QwtPlotItem.draw(), to render the image on the given painter.
+        The image is rendered in square tiles of TileSize screen pixels. The tile grid (global pixels gx,gy, centered
+        on l0 - xscale*(gx+phase+.5), m0 - yscale*(gy+phase+.5)) is anchored to the image reference pixel rather than
+        to the screen, so when the plot is panned, previously rendered tiles remain valid, and only newly exposed
+        tiles need to be rendered. Rendered tiles are cached by zoom level, image key, render version
+        (which changes with the colormap or intensity map) and tile index. Tiles that are not in the cache are rendered
+        in parallel, using renderThreads() threads."""
         xp1, xp2, xdp, xs1, xs2, xds = xinfo = xmap.p1(), xmap.p2(), xmap.pDist(), xmap.s1(), xmap.s2(), xmap.sDist()
         yp1, yp2, ydp, ys1, ys2, yds = yinfo = ymap.p1(), ymap.p2(), ymap.pDist(), ymap.s1(), ymap.s2(), ymap.sDist()
         dprint(5, "draw:", rect, xinfo, yinfo)
@@ -242,107 +337,382 @@ class SkyImagePlotItem(QwtPlotItem, QObject):
         self._current_rect_pix = QRectF(QPointF(*self.lmToPix(xs1, ys1)), QPointF(*self.lmToPix(xs2, ys2))).toRect().intersected(
             self._bounding_rect_pix)
         dprint(5, "draw:", self._current_rect_pix)
-        # put together tuple describing current mapping
-        mapping = xinfo, yinfo
-        # if mapping has changed w.r.t. cache (i.e. zoom has changed), discard all cached QImages
-        if mapping != self._cache_mapping:
-            dprint(2, "does not match cached mapping, cache is:", self._cache_mapping)
-            dprint(2, "and we have:", mapping)
-            self.clearDisplayCache()
-            self._cache_mapping = mapping
+        grid = self._tileGrid(xmap, ymap)
+        if grid is None:
+            return
+        t0 = time.time()
+        zoom_key, xscale, yscale, xphase, yphase, ox0, oy0, irange, jrange = grid
+        tsize = self.TileSize
+        self._last_view = zoom_key, xscale, yscale, xphase, yphase, irange, jrange
+        state = self._render_state
+        render_version = state[0]
+        tiles = []
+        missing = []
+        for j in jrange:
+            for i in irange:
+                tile_key = zoom_key, self._image_key, i, j
+                qimg = self._cache_tiles.get(tile_key + (render_version,)) if use_cache else None
+                if qimg is None:
+                    missing.append(len(tiles))
+                tiles.append([i, j, tile_key, qimg])
+        # render missing tiles. Interpolation setup is done once up front, then the tiles are rendered in parallel
+        # (numpy and scipy release the GIL for most of the work)
+        if missing:
+            render = self._getRenderParameters(xscale, yscale, state=state)
+
+            def renderTile(num):
+                i, j, tile_key, _ = tiles[num]
+                return self._renderTile(i, j, xscale, yscale, xphase, yphase, render, tile_key if use_cache else None)
+
+            nthreads = min(self.renderThreads(), len(missing))
+            if nthreads > 1:
+                qimgs = getThreadPool("render-%d" % nthreads, nthreads).map(renderTile, missing)
+            else:
+                qimgs = map(renderTile, missing)
+            for num, qimg in zip(missing, qimgs):
+                tiles[num][3] = qimg
+                if use_cache:
+                    self._cache_tiles.put(tiles[num][2] + (render_version,), qimg)
+        for i, j, _, qimg in tiles:
+            # empty tiles (i.e. entirely outside the image) are cached as False
+            if qimg is not False:
+                painter.drawImage(QPointF(xp1 + i * tsize - ox0, yp2 + j * tsize - oy0), qimg)
+        ntiles, nrendered = len(tiles), len(missing)
+        dprint(2, "drew", ntiles, "tiles, of which", nrendered, "were rendered, in", time.time() - t0, "secs")
+
+    def _tileGrid(self, xmap, ymap):
+        """Works out the tile grid (see draw()) for the given scale maps. Returns tuple of (zoom_key, xscale, yscale,
+        xphase, yphase, ox0, oy0, irange, jrange), or None if the paint area is empty."""
+        xs1, xdp, xds = xmap.s1(), xmap.pDist(), xmap.sDist()
+        ys2, ydp, yds = ymap.s2(), ymap.pDist(), ymap.sDist()
+        if not int(xdp) or not int(ydp) or not xds or not yds:
+            return None
+        # plot units per screen pixel. This determines the zoom level (rounded, so that
+        # roundoff errors in the scale maps do not invalidate the cache when panning). Tiles are rendered at the
+        # rounded scale too, so that a cached tile is the same whichever view it was first rendered for.
+        xscale, yscale = float("%.12g" % (xds / xdp)), float("%.12g" % (yds / ydp))
+        # ox,oy is the global pixel position of the top left corner of the plot. This is split into an integer
+        # offset, and a sub-pixel phase which becomes part of the zoom level. Since panning normally moves the plot
+        # by whole screen pixels, this keeps the phase (and the tiles) the same, while sampling the image at
+        # exactly the same points as an unpanned view.
+        ox, oy = (self._l0 - xs1) / xscale, (self._m0 - ys2) / yscale
+        ox0, oy0 = int(math.floor(ox)), int(math.floor(oy))
+        xphase, yphase = round(ox - ox0, 6), round(oy - oy0, 6)
+        zoom_key = xscale, yscale, xphase, yphase
+        tsize = self.TileSize
+        irange = range(ox0 // tsize, (ox0 + int(xdp) - 1) // tsize + 1)
+        jrange = range(oy0 // tsize, (oy0 + int(ydp) - 1) // tsize + 1)
+        return zoom_key, xscale, yscale, xphase, yphase, ox0, oy0, irange, jrange
+
+    def renderRows(self, xmap, ymap):
+        """Renders the image over the paint area of the given scale maps, as draw() would, but returns pixels instead of
+        painting them, and neither uses nor fills the tile cache. This is meant for exporting images too large to render
+        in one go (see Export.exportImage()): the image is rendered one row of tiles at a time (with the tiles of a row
+        rendered in parallel, using renderThreads() threads), so memory use is bounded by a row of tiles.
+        Yields a tuple of (y, argb) per row of tiles, from the top down, where argb is a [rows, width] array of ARGB32
+        pixels covering paint rows y, y+1, etc. (relative to the top of the paint area). Pixels outside the image are
+        fully transparent."""
+        grid = self._tileGrid(xmap, ymap)
+        if grid is None:
+            return
+        zoom_key, xscale, yscale, xphase, yphase, ox0, oy0, irange, jrange = grid
+        width, height = int(xmap.pDist()), int(ymap.pDist())
+        tsize = self.TileSize
+        render = self._getRenderParameters(xscale, yscale)
+        nthreads = min(self.renderThreads(), len(irange))
+        pool = getThreadPool("render-%d" % nthreads, nthreads) if nthreads > 1 else None
+        for j in jrange:
+            # paint rows covered by this row of tiles
+            y0, y1 = max(j * tsize - oy0, 0), min((j + 1) * tsize - oy0, height)
+            argb = numpy.zeros((y1 - y0, width), numpy.uint32)
+            tiles = (pool.map if pool else map)(
+                lambda i: self._renderTileData(i, j, xscale, yscale, xphase, yphase, render), irange)
+            for i, tile in zip(irange, tiles):
+                if tile is not False:
+                    x0 = i * tsize - ox0
+                    x1 = min(x0 + tsize, width)
+                    ty0 = y0 - (j * tsize - oy0)
+                    argb[:, max(x0, 0):x1] = tile[ty0:ty0 + y1 - y0, max(-x0, 0):x1 - x0]
+            yield y0, argb
+
+    def lastViewNumTiles(self):
+        """Returns the number of tiles in the last drawn view (0 if not drawn yet)"""
+        return len(self._last_view[5]) * len(self._last_view[6]) if self._last_view else 0
+
+    def prerenderPlane(self, plane, check=None):
+        """Renders the tiles of the last drawn view for some other plane of the image into the tile cache, so that
+        a subsequent draw() of that plane comes straight from the cache. Plane is a tuple of (image, key, minmax),
+        see _getRenderParameters(). Meant to be called from a background thread. If check is given, it is called
+        before each tile is rendered, and may raise an exception to abandon rendering.
+        Returns the number of tiles rendered."""
+        if self._last_view is None:
+            return 0
+        zoom_key, xscale, yscale, xphase, yphase, irange, jrange = self._last_view
+        state = self._render_state
+        render_version = state[0]
+        render = None
+        nrendered = 0
+        for j in jrange:
+            for i in irange:
+                tile_key = zoom_key, plane[1], i, j
+                if tile_key + (render_version,) in self._cache_tiles:
+                    continue
+                if check:
+                    check()
+                if render is None:
+                    render = self._getRenderParameters(xscale, yscale, plane, state)
+                qimg = self._renderTile(i, j, xscale, yscale, xphase, yphase, render, tile_key)
+                self._cache_tiles.put(tile_key + (render_version,), qimg)
+                nrendered += 1
+        dprint(3, "prerendered", nrendered, "tiles of plane", plane[1])
+        return nrendered
+
+    def _getRenderParameters(self, xscale, yscale, plane=None, state=None):
+        """Works out how the image is to be interpolated at the given zoom level. Returns tuple of
+        (image, spline_order, pyramid_level, xsamp, ysamp, qrange, table, image_key, dtype, imap, imap_version), where
+        image is in array order (see resample()), and is already downsampled (for pyramid_level>0). For spline_order>1,
+        the image still needs to be prefiltered, which _renderTile() does on demand for the region being rendered.
+        qrange and table are the quantization range and render table, see _renderTile(). dtype is the render type, see
+        renderDtype(). imap is the intensity map, which non-linear maps apply before quantization (qrange is then None,
+        see _quantizeTile()), and imap_version identifies its state for the caching of quantized tiles.
+        Plane is a tuple of (image, key, minmax) giving the plane to be rendered, default is the current image.
+        State is the render state (see __init__) to use, default is the current one."""
+        if plane is None:
+            plane = self._image, self._image_key, self.imageMinMax()[:2]
+        image, image_key, minmax = plane
+        dtype = self.renderDtype(image.dtype)
+        if self._data_fortran_order:
+            image = image.transpose()
+        spline_order = 2
+        xsamp = abs(xscale / self._dl)
+        ysamp = abs(yscale / self._dm)
+        if max(xsamp, ysamp) < .33 or min(xsamp, ysamp) > 2:
+            spline_order = 1
+        # when zoomed out, interpolate from a downsampled (area-averaged) version of the image instead,
+        # which is both faster and avoids aliasing
+        level = 0
+        if spline_order == 1 and min(xsamp, ysamp) > 2:
+            pyramid = self._cache_pyramid.get(image_key)
+            if pyramid is None:
+                pyramid = ImagePyramid(image, dtype)
+            level = pyramid.levelForSampling(min(xsamp, ysamp))
+            image = pyramid.level(level)
+            # (re)insert into cache, as the pyramid may have grown
+            self._cache_pyramid.put(image_key, pyramid, pyramid.nbytes)
+        dprint(3, "sampling factors are", xsamp, ysamp, "spline order is", spline_order, "pyramid level is", level)
+        # an intensity map without an explicit range normalizes to whatever data it is given, which would make
+        # every tile different, so give it the image min/max instead
+        render_version, imap_version, imap, colormap = state or self._render_state
+        if not getattr(imap, 'range', None):
+            imap = imap.copy()
+            imap.setDataRange(*minmax[:2])
+            imap.freeze()
+        qrange = self._quantizationRange(imap, minmax) if imap.linear else None
+        table = self._renderTable(imap, qrange, image_key, colormap, render_version)
+        return image, spline_order, level, xsamp, ysamp, qrange, table, image_key, dtype, imap, imap_version
+
+    # number of levels of quantized tiles, the top level is used for transparent (i.e. undefined) pixels
+    QuantLevels = 65536
+    # the display range must cover at least 1/QuantMinFraction of the quantization range, else a narrower
+    # quantization range is used, see _quantizationRange()
+    QuantMinFraction = 256
+
+    def _quantizationRange(self, imap, minmax):
+        """Returns the range of data values over which tiles are quantized (see _quantizeTile()), for the given
+        intensity map and image min/max. This is normally the image min/max, so that changing the display range only requires a new
+        render table (see _renderTable()). If the display range is a small part of the data range (as is usual with
+        high-dynamic-range images), this would leave too few levels within the display range, so a narrower range
+        around the display range is used. This is snapped to a grid, so that moving the display range around a bit
+        does not change it."""
+        dmin, dmax = minmax[:2]
+        lo, hi = imap.range
+        if not numpy.isfinite([dmin, dmax, lo, hi]).all() or hi <= lo:
+            return (float(dmin), float(dmax)) if numpy.isfinite([dmin, dmax]).all() else (0., 1.)
+        if (hi - lo) * self.QuantMinFraction >= dmax - dmin:
+            return float(dmin), float(dmax)
+        width = 2. ** math.ceil(math.log2((hi - lo) * 16))
+        step = width / 4
+        qlo = math.floor(((lo + hi) / 2 - width / 2) / step) * step
+        return max(qlo, float(dmin)), min(qlo + width, float(dmax))
+
+    # max number of render tables kept around (one per plane, for planes rendered ahead by prerenderPlane())
+    MaxRenderTables = 16
+
+    def _renderTable(self, imap, qrange, image_key, colormap, render_version):
+        """Returns the render table for the given intensity map and quantization range: an array of QuantLevels
+        packed ARGB values, giving the colour of each level of a quantized tile. This composes the intensity map
+        and the colormap, so changes to either only require a new table, rather than re-processing the tiles.
+        If qrange is None, the tiles are quantized after the intensity map is applied, so the table is just the
+        colormap. Render_version is the version of the render state that imap and colormap come from."""
+        key = render_version, image_key, qrange
+        table = self._render_tables.get(key)
+        if table is not None:
+            return table
         t0 = time.time()
-        # check cached QImage for current image key.
-        self.qimg = self._cache_qimage.get(self._image_key)
-        if self.qimg:
-            dprint(5, "QImage found in cache, reusing")
-        # else regenerate image
+        levels = numpy.arange(self.QuantLevels - 1) / (self.QuantLevels - 2.)
+        table = numpy.zeros(self.QuantLevels, numpy.uint32)
+        if qrange is None:
+            table[:-1] = colormap.lookup(levels)
         else:
-            # check for cached intensity-mapped data
-            if self._cache_imap is not None:
-                dprint(5, "intensity-mapped data found in cache, reusing")
+            lo, hi = qrange
+            table[:-1] = colormap.lookup(numpy.ma.filled(imap.remap(lo + (hi - lo) * levels), 0))
+        if len(self._render_tables) >= self.MaxRenderTables:
+            self._render_tables.clear()
+        self._render_tables[key] = table
+        dprint(3, "computing render table took", time.time() - t0, "secs")
+        return table
+
+    def _quantizeTile(self, data, qrange, imap=None):
+        """Quantizes an array of data values into QuantLevels-1 levels evenly covering qrange (values outside the
+        range are clipped). Non-finite values are set to the top level (QuantLevels-1). If the image holds raw
+        values (see dataScaling()), qrange (which is in physical units) is converted into raw units, so that the
+        scaling comes for free.
+        If qrange is None, the data are remapped by the (non-linear) intensity map imap first, and its 0...1 output
+        is quantized instead: quantizing e.g. a log map in data space would lump all the values at its low end into a
+        handful of levels."""
+        if qrange is None:
+            if self._scaled is not None:
+                bscale, bzero = self.dataScaling()
+                data = data * bscale + bzero
+            data = numpy.ma.filled(imap.remap(data), numpy.nan)
+            lo, hi = 0., 1.
+        else:
+            lo, hi = qrange
+            if self._scaled is not None:
+                bscale, bzero = self.dataScaling()
+                lo, hi = (lo - bzero) / bscale, (hi - bzero) / bscale
+        top = self.QuantLevels - 2
+        values = numpy.subtract(data, lo, order='C')
+        # (with a negative BSCALE, hi < lo, and the raw values run the other way)
+        values *= top / (hi - lo) if hi != lo else 0.
+        values += 0.5
+        undefined = ~numpy.isfinite(values)
+        numpy.clip(values, 0, top, out=values)
+        with numpy.errstate(invalid='ignore'):
+            index = values.astype(numpy.uint16)
+        index[undefined] = top + 1
+        return index
+
+    def _renderTile(self, i, j, xscale, yscale, xphase, yphase, render, tile_key=None):
+        """Renders tile i,j of the tile grid (see draw()) into a QImage. Returns False if the tile is entirely outside the image.
+        See _renderTileData()."""
+        argb = self._renderTileData(i, j, xscale, yscale, xphase, yphase, render, tile_key)
+        return False if argb is False else self.colormap.QARGBImage(argb)
+
+    def _renderTileData(self, i, j, xscale, yscale, xphase, yphase, render, tile_key=None):
+        """Renders tile i,j of the tile grid (see draw()) into a [ny,nx] array of ARGB32 values. Returns False if the
+        tile is entirely outside the image.
+        The tile is interpolated, quantized (see _quantizeTile()), and converted into colours via the render table.
+        If tile_key is given, the interpolated and quantized tile data are cached under that key, so that changes to the
+        colormap or intensity map only require a new render table."""
+        qrange, table = render[5:7]
+        # (quantized tiles of non-linear maps depend on the intensity map, rather than on the quantization range)
+        qkey = (tile_key, qrange if qrange is not None else ("imap", render[10])) if tile_key is not None else None
+        index = self._cache_quant_tiles.get(qkey) if qkey is not None else None
+        if index is None:
+            interp_image = self._interpolateTile(i, j, xscale, yscale, xphase, yphase, render, tile_key)
+            # quantize the transposed tile, since QImages are in row-major order
+            index = False if interp_image is False else self._quantizeTile(interp_image.T, qrange, render[9])
+            if qkey is not None:
+                self._cache_quant_tiles.put(qkey, index)
+        if index is False:
+            return False
+        return table[index]
+
+    def _interpolateTile(self, i, j, xscale, yscale, xphase, yphase, render, interp_key=None):
+        """Interpolates tile i,j of the tile grid (see draw()), returning an [nx,ny] array, with NaNs for undefined
+        pixels, or False if the tile is entirely outside the image. If interp_key is given, the result is cached under
+        that key."""
+        image, spline_order, level, xsamp, ysamp = render[:5]
+        tsize = self.TileSize
+        interp_image = self._cache_interp_tiles.get(interp_key) if interp_key is not None else None
+        if interp_image is None:
+            # plot coordinates of tile pixel centers, converted into fractional image pixel coordinates
+            xi = self._x0 - xscale * (i * tsize + xphase + 0.5 + numpy.arange(tsize)) / self._dl
+            yi = self._y0 - yscale * (j * tsize + yphase + 0.5 + numpy.arange(tsize)) / self._dm
+            if max(xi[0], xi[-1]) < -.5 or min(xi[0], xi[-1]) > self._nx - .5 or \
+                    max(yi[0], yi[-1]) < -.5 or min(yi[0], yi[-1]) > self._ny - .5:
+                interp_image = False
             else:
-                if self._cache_interp is not None:
-                    dprint(5, "interpolated data found in cache, reusing")
+                if level:
+                    xi = ImagePyramid.toLevelCoordinates(level, xi)
+                    yi = ImagePyramid.toLevelCoordinates(level, yi)
+                # if either axis is oversampled by a factor of 3 or more, switch to nearest-neighbour interpolation by
+                # rounding pixel values. (For a linear kernel, that's the same as using a nearest-neighbour kernel, which
+                # is cheaper. A spline kernel at whole pixels gives the pixel values, since the image is prefiltered.)
+                xorder = yorder = spline_order
+                if xsamp < .33:
+                    xi = xi.round()
+                    xorder = 0 if spline_order == 1 else spline_order
+                if ysamp < .33:
+                    yi = yi.round()
+                    yorder = 0 if spline_order == 1 else spline_order
+                # the array axes of the image are y,x for fortran order (since it has been transposed), else x,y
+                if self._data_fortran_order:
+                    coords, orders = [yi, xi], (yorder, xorder)
                 else:
-                    image = self._image.transpose() if self._data_fortran_order else self._image
-                    spline_order = 2
-                    xsamp = abs(xmap.sDist() / xmap.pDist()) / abs(self._dl)
-                    ysamp = abs(ymap.sDist() / ymap.pDist()) / abs(self._dm)
-                    if max(xsamp, ysamp) < .33 or min(xsamp, ysamp) > 2:
-                        spline_order = 1
-                    dprint(2, "regenerating drawing cache, sampling factors are", xsamp, ysamp, "spline order is",
-                           spline_order)
-                    self._cache_imap = None
-                    if self._prefilter is None and spline_order > 1:
-                        self._prefilter = interpolation.spline_filter(image, order=spline_order)
-                        dprint(2, "spline prefiltering took", time.time() - t0, "secs")
-                        t0 = time.time()
-                    # make arrays of plot coordinates
-                    # xp[0],yp[0] corresponds to pixel 0,0, where 0,0 is the upper-left corner of the plot
-                    # the maps are in a funny order (w.r.t. meaning of p1/p2/s1/s2), so the indices here are determined empirically
-                    # We also adjust by half-pixel, to get the world coordinate of the pixel _center_
-                    xp = xmap.s1() - (xmap.sDist() / xmap.pDist()) * (0.5 + numpy.arange(int(xmap.pDist())))
-                    yp = ymap.s2() - (ymap.sDist() / ymap.pDist()) * (0.5 + numpy.arange(int(ymap.pDist())))
-                    # now convert plot coordinates into fractional image pixel coordinates
-                    xi = self._x0 + (xp - self._l0) / self._dl
-                    yi = self._y0 + (yp - self._m0) / self._dm
-                    # interpolate image data
-                    ###        # old code for nearest-neighbour interpolation
-                    ###        # superceded by interpolation below (we simply round pixel coordinates to go to NN when oversampling)
-                    ###        xi = xi.round().astype(int)
-                    ###        oob_x = (xi<0)|(xi>=self._nx)
-                    ###        xi[oob_x] = 0
-                    ###        yi = yi.round().astype(int)
-                    ###        oob_y = (yi<0)|(yi>=self._ny)
-                    ###        yi[oob_y] = 0
-                    ###        idx = (xi[:,numpy.newaxis]*self._ny + yi[numpy.newaxis,:]).ravel()
-                    ###        interp_image = self._image.ravel()[idx].reshape((len(xi),len(yi)))
-                    ###        interp_image[oob_x,:] = 0
-                    ###        interp_image[:,oob_y] = 0
-                    ###        self._qimage_cache = self.colormap.colorize(interp_image,self._img_range)
-                    ###        self._qimage_cache_attrs = (rect,xinfo,yinfo)
-
-                    # if either axis is oversampled by a factor of 3 or more, switch to nearest-neighbour interpolation by rounding pixel values
-                    if xsamp < .33:
-                        xi = xi.round()
-                    if ysamp < .33:
-                        yi = yi.round()
-                    # make [2,nx,ny] array of interpolation coordinates
-                    xy = numpy.zeros((2, len(xi), len(yi)))
-                    xy[0, :, :] = xi[:, numpy.newaxis]
-                    xy[1, :, :] = yi[numpy.newaxis, :]
-                    # interpolate. Use NAN for out of range pixels...
-                    # for fortran order, tranpose axes for extra speed (flip XY around then)
-                    if self._data_fortran_order:
-                        xy = xy[-1::-1, ...]
-                    if spline_order > 1:
-                        interp_image = interpolation.map_coordinates(self._prefilter, xy, order=spline_order,
-                                                                     cval=numpy.nan, prefilter=False)
-                    else:
-                        interp_image = interpolation.map_coordinates(image, xy, order=spline_order, cval=numpy.nan)
-                    # ...and put a mask on them (Colormap.colorize() will make these transparent).
-                    mask = ~numpy.isfinite(interp_image)
-                    self._cache_interp = numpy.ma.masked_array(interp_image, mask)
-                    dprint(2, "interpolation took", time.time() - t0, "secs")
-                    t0 = time.time()
-                # ok, we have interpolated data in _cache_interp
-                self._cache_imap = self.imap.remap(self._cache_interp)
-                dprint(2, "intensity mapping took", time.time() - t0, "secs")
-                t0 = time.time()
-            # ok, we have intensity-mapped data in _cache_imap
-            self.qimg = self.colormap.colorize(self._cache_imap)
-            dprint(2, "colorizing took", time.time() - t0, "secs")
-            t0 = time.time()
-            if use_cache:
-                # cache the qimage
-                self._cache_qimage[self._image_key] = self.qimg.copy()
-        # now draw the image
+                    coords, orders = [xi, yi], (xorder, yorder)
+                if spline_order > 1:
+                    # only prefilter the region of the image that the tile actually samples
+                    image, offset = self._prefilteredRegion(image, spline_order, coords, render[7], render[8])
+                    coords = [coords[0] - offset[0], coords[1] - offset[1]]
+                # interpolate. This uses NAN for out of range pixels, which are made transparent when rendering
+                interp_image = resample(image, coords[0], coords[1], orders, dtype=render[8])
+                if self._data_fortran_order:
+                    interp_image = interp_image.T
+            if interp_key is not None:
+                self._cache_interp_tiles.put(interp_key, interp_image)
+        return interp_image
+
+    # size of spline prefilter blocks, in image pixels
+    PrefilterBlockSize = 256
+    # width of guard band around each prefilter block, in image pixels. The spline prefilter is a recursive filter
+    # whose response decays by a factor of ~6 per pixel (for order 2), so a block prefiltered with this much
+    # surrounding data is indistinguishable from the same area of a prefiltered full plane.
+    PrefilterGuard = 16
+    # margin around the sampled area of a region, in image pixels. This keeps the (differently treated) region
+    # edges outside the support of the spline.
+    PrefilterMargin = 3
+
+    def _prefilterBlock(self, image, spline_order, b0, b1, image_key, dtype):
+        """Returns block b0,b1 of the spline-prefiltered image (of the given type), computing and caching it if needed"""
+        key = image_key, spline_order, b0, b1
+        block = self._cache_prefilter.get(key)
+        if block is None:
+            bsize, guard = self.PrefilterBlockSize, self.PrefilterGuard
+            n0, n1 = image.shape
+            s0, s1 = b0 * bsize, b1 * bsize
+            e0, e1 = min(s0 + bsize, n0), min(s1 + bsize, n1)
+            g0, g1 = max(s0 - guard, 0), max(s1 - guard, 0)
+            filtered = interpolation.spline_filter(zeroNonFinite(image[g0:min(e0 + guard, n0), g1:min(e1 + guard, n1)]),
+                                                   order=spline_order, output=dtype)
+            block = filtered[s0 - g0:e0 - g0, s1 - g1:e1 - g1].copy()
+            self._cache_prefilter.put(key, block)
+        return block
+
+    def _prefilteredRegion(self, image, spline_order, coords, image_key, dtype):
+        """Returns the spline-prefiltered region of the image needed to interpolate at the given coordinates
+        (a pair of arrays of indices along the first and second array axis), as a tuple of (region, (offset0, offset1)).
+        The region is assembled from prefiltered blocks of PrefilterBlockSize pixels, so only the blocks overlapping
+        the region are ever prefiltered, and these are cached for subsequent renders of the same plane."""
+        bsize, margin = self.PrefilterBlockSize, self.PrefilterMargin
+        n0, n1 = image.shape
+        lo0 = min(max(int(math.floor(coords[0].min())) - margin, 0), n0 - 1)
+        lo1 = min(max(int(math.floor(coords[1].min())) - margin, 0), n1 - 1)
+        hi0 = max(min(int(math.ceil(coords[0].max())) + margin + 1, n0), lo0 + 1)
+        hi1 = max(min(int(math.ceil(coords[1].max())) + margin + 1, n1), lo1 + 1)
         t0 = time.time()
-        painter.drawImage(QPointF(xp1, yp2), self.qimg)
-        dprint(2, "drawing took", time.time() - t0, "secs")
-        # when exporting images to PNG cache needs to be cleared
-        if not use_cache:
-            self.clearDisplayCache()
+        region = numpy.empty((hi0 - lo0, hi1 - lo1), dtype)
+        for b0 in range(lo0 // bsize, (hi0 - 1) // bsize + 1):
+            for b1 in range(lo1 // bsize, (hi1 - 1) // bsize + 1):
+                block = self._prefilterBlock(image, spline_order, b0, b1, image_key, dtype)
+                # intersection of block with region, in image coordinates
+                s0, s1 = max(b0 * bsize, lo0), max(b1 * bsize, lo1)
+                e0, e1 = min((b0 + 1) * bsize, hi0), min((b1 + 1) * bsize, hi1)
+                region[s0 - lo0:e0 - lo0, s1 - lo1:e1 - lo1] = block[s0 - b0 * bsize:e0 - b0 * bsize,
+                                                                     s1 - b1 * bsize:e1 - b1 * bsize]
+        dprint(3, "prefiltered region", lo0, hi0, lo1, hi1, "took", time.time() - t0, "secs")
+        return region, (lo0, lo1)
 
     def setPsfSize(self, _maj, _min, _pa):
         self._psfsize = _maj, _min, _pa
@@ -368,15 +738,89 @@ def getScalePrefix(*values):
     return 10 ** ((m - 4) * 3), ScalePrefixes[m]
 
 
+_prefetch_executor = None
+
+
+def _getPrefetchExecutor():
+    """Returns the (single-threaded) executor used to page in planes of lazily-loaded cubes in the background"""
+    global _prefetch_executor
+    if _prefetch_executor is None:
+        _prefetch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    return _prefetch_executor
+
+
+class ScaledData:
+    """A virtual array holding the physical values (raw*bscale+bzero) of integer FITS data with BSCALE/BZERO. This
+    wraps the raw integer array, which is what is kept in memory (or memory-mapped) and rendered: scaling is linear,
+    so statistics and quantization are done on raw values and converted (see SkyCubePlotItem.setData()).
+    Indexing returns physical values for just that index (e.g. a plane or a pixel), in single precision for 8- and
+    16-bit data. Reshaping, transposing and raveling return ScaledData views of the raw array (raveling only copies
+    raw values, if the raw array is not contiguous in the requested order), so a flattened ScaledData can be walked
+    chunk by chunk (see e.g. Statistics.computeStats()), scaling one chunk at a time. Converting to a numpy array
+    (e.g. numpy.asarray()) scales the whole array, without keeping the result."""
+
+    def __init__(self, raw, bscale, bzero):
+        self.raw = raw
+        self.bscale, self.bzero = bscale, bzero
+        self.shape, self.ndim, self.size = raw.shape, raw.ndim, raw.size
+        self.dtype = numpy.result_type(raw.dtype, numpy.float32)
+        self.itemsize = self.dtype.itemsize
+        self.nbytes = self.size * self.itemsize
+
+    def scale(self, values):
+        """Converts raw values into physical values"""
+        values = numpy.multiply(values, self.dtype.type(self.bscale), dtype=self.dtype)
+        values += self.dtype.type(self.bzero)
+        return values
+
+    @property
+    def flags(self):
+        return self.raw.flags
+
+    @property
+    def T(self):
+        return self.transpose()
+
+    def reshape(self, *shape, order='C'):
+        return ScaledData(self.raw.reshape(*shape, order=order), self.bscale, self.bzero)
+
+    def transpose(self, *axes):
+        return ScaledData(self.raw.transpose(*axes), self.bscale, self.bzero)
+
+    def ravel(self, order='C'):
+        return ScaledData(numpy.ravel(self.raw, order=order), self.bscale, self.bzero)
+
+    def __getitem__(self, index):
+        return self.scale(self.raw[index])
+
+    def __array__(self, dtype=None, copy=None):
+        array = self.scale(self.raw)
+        return array if dtype is None else array.astype(dtype)
+
+
 class SkyCubePlotItem(SkyImagePlotItem):
     """Extends SkyImagePlotItem with a hypercube containing extra slices."""
 
+    # in lazy mode, number of planes on either side of the current one (along each extra axis) that are
+    # paged in ahead of time
+    PrefetchWindow = 1
+
     def __init__(self, data=None, ndim=None):
         SkyImagePlotItem.__init__(self)
         self.RenderAntialiased
-        # datacube (array of any rank)
+        # datacube (array of any rank), and the raw datacube which this holds the physical values of, if scaled
+        # (see setData())
         self._data_fortran_order = None
-        self._data = self._dataminmax = None
+        self._data = self._raw = self._dataminmax = None
+        # lazy mode: datacube is (typically) memory-mapped, and planes are paged in on demand. This is also done
+        # (converting to native byte order) for non-native data, see hasPlaneCache(). Paged-in planes are kept subject
+        # to the global cache memory budget.
+        self._lazy = False
+        self._native = True
+        self._plane_cache = ManagedCache("planes")
+        self._plane_minmax = {}
+        # persistent cache of statistics, if any (see setStatsCache())
+        self._stats_cache = None
         # current image slice (a list of indices) applied to data to make an image
         self.imgslice = None
         # info about sky axes
@@ -391,84 +835,178 @@ class SkyCubePlotItem(SkyImagePlotItem):
         elif ndim:
             self.setNumAxes(ndim)
 
-    def setData(self, data, fortran_order=False):
+    def setData(self, data, fortran_order=False, lazy=False):
         """Sets the datacube. fortran_order is a hint, which makes iteration over
-        fortran-order arrays faster when computing min/max and such."""
+        fortran-order arrays faster when computing min/max and such.
+        NaNs (and other non-finite values) in the datacube mark undefined pixels. These are left as they are: there is
+        no need for a mask, since statistics skip non-finite values (see Statistics.computeStats()), and rendering
+        treats them as 0 (see Resampler.zeroNonFinite()). Masked arrays are still accepted, and work as before.
+        If lazy is True, the datacube is not scanned up front (this is meant for memory-mapped cubes). Instead, each
+        plane is paged in when it is selected, see _setupSlice().
+        The datacube may be a ScaledData (for integer FITS data with BSCALE/BZERO), in which case planes, statistics
+        and rendering all work on the raw datacube, and physical values are only made as they are needed, for
+        readouts (see imagePixel()), data subsets, expressions and saving."""
         # Note that iteration order is absolutely critical for large cubes -- if data is in fortran
         # order in memory, then that's the way we should iterate over it, period. Transposing is too
         # slow. We therefore create 1D "views" of the data using numpy.ravel(x,order='F'), and use
-        # thse to iterate over the data for things like min/max, masking, etc.
-        if fortran_order:
-            dprint(3, "setData: computing mask (fortran order)")
-            rav = numpy.ravel(data, order='F')
-            rfin = numpy.isfinite(rav)
-            if rfin.all():
-                dprint(3, "setData: phew, all finite, nothing to be masked")
-                self._data = data
-            else:
-                dprint(3, "setData: setting masked elements to 0")
-                rmask = ~rfin
-                rav[rmask] = 0
-                dprint(3, "setData: creating masked array")
-                mask = rmask.reshape(data.shape[-1::-1]).transpose()
-                self._data = numpy.ma.masked_array(data, mask)
-        else:
-            dprint(3, "setData: computing mask (C order)")
-            fin = numpy.isfinite(data)
-            if fin.all():
-                dprint(3, "setData: phew, all finite, nothing to be masked")
-                self._data = data
-            else:
-                dprint(3, "setData: setting masked elements to 0")
-                mask = ~fin
-                data[mask] = 0
-                dprint(3, "setData: creating masked array")
-                self._data = numpy.ma.masked_array(data, mask)
-        dprint(3, "setData: wrapping up")
+        # thse to iterate over the data for things like min/max, etc.
+        self._plane_cache.clear()
+        self._plane_minmax = self._stats_cache.planeMinMaxes() if self._stats_cache else {}
+        self._lazy = lazy
+        self._data = data
+        self._scaled = data if isinstance(data, ScaledData) else None
+        self._raw = data if self._scaled is None else data.raw
+        # planes of non-native (i.e. big-endian FITS) data are converted to native byte order as they are selected
+        self._native = self._raw.dtype.isnative
         self._data_fortran_order = fortran_order
         self._dataminmax = None
         self.setNumAxes(data.ndim)
-        ### old slow code
-        # dprint(3,"setData: computing mask")
-        # fin = numpy.isfinite(data)
-        # mask = ~fin
-        # dprint(3,"setData: setting masked elements to 0")
-        # data[mask] = 0
-        # dprint(3,"setData: creating masked array")
-        # self._data = numpy.ma.masked_array(data,mask)
-        # dprint(3,"setData: wrapping up")
-        # self._data_fortran_order = fortran_order
-        # self._dataminmax = None
-        # self.setNumAxes(data.ndim)
 
     def data(self):
-        """Returns datacube"""
+        """Returns datacube, in physical units (see setData())"""
         return self._data
 
     def isDataInFortranOrder(self):
         return self._data_fortran_order
 
+    def isLazy(self):
+        """Returns True if the datacube is accessed lazily, i.e. planes are only read in when selected.
+        Whole-cube operations (such as dataMinMax()) are expensive in this mode, and should only be done on demand."""
+        return self._lazy
+
+    def hasPlaneCache(self):
+        """Returns True if planes are paged into the plane cache as they are selected (see _loadPlane()), rather than
+        used in place. This is the case in lazy mode, and for data not in native byte order."""
+        return self._lazy or not self._native
+
     def optimalRavel(self, array):
         """Returns the "optimal ravel" corresponding to the given array, which is either FORTRAN
         or C order. The optimal ravel is that over which iteration is fastest.
         Returns tuple of ravarray,ravmask. If input array is not masked, then ravmask=None."""
         order = 'F' if self._data_fortran_order else 'C'
-        rarr = numpy.ravel(array, order=order)
+        # (scaled data is raveled as such, see ScaledData)
+        rarr = array.ravel(order=order) if isinstance(array, ScaledData) else numpy.ravel(array, order=order)
         rmask = numpy.ravel(array.mask, order=order) if numpy.ma.isMA(array) else None
         return rarr, rmask
 
-    def dataMinMax(self):
+    def setStatsCache(self, cache):
+        """Sets a persistent statistics cache (see StatsCache). This should be done before setData(), since
+        the cache is keyed by file, not by content."""
+        self._stats_cache = cache
+        if cache:
+            self._plane_minmax.update(cache.planeMinMaxes())
+
+    def statsCache(self):
+        return self._stats_cache
+
+    def dataMinMax(self, progress=None):
+        """Returns min/max of the full datacube. If this needs to be computed, progress (if given) is called
+        as progress(fraction) along the way, see Statistics.computeStats()."""
         if not self._dataminmax:
-            rdata, rmask = self.optimalRavel(self._data)
-            dprint(3, "computing data min/max")
-            try:
-                self._dataminmax = measurements.extrema(rdata, labels=rmask, index=None if rmask is None else False)
-            except:
-                # when all data is masked, some versions of extrema() throw an exception
-                self._dataminmax = numpy.nan, numpy.nan
+            cached = self._stats_cache and self._stats_cache.getMinMax(StatsCache.StatsCache.FULL)
+            if cached:
+                dprint(3, "using cached data min/max")
+                self._dataminmax = cached
+            elif self._lazy:
+                self._dataminmax = self._planewiseMinMax(progress)
+            else:
+                dprint(3, "computing data min/max")
+                self._dataminmax = self._computeStats(self._raw, progress=progress).extrema()
+            if self._stats_cache and not cached:
+                self._stats_cache.setMinMax(StatsCache.StatsCache.FULL, self._dataminmax)
             dprint(3, self._dataminmax)
         return self._dataminmax
 
+    def imageMinMax(self):
+        # remember per-plane min/max, so that flipping back to a plane (or a plane whose stats were
+        # computed by a background loader) does not require a rescan
+        computed = not self._imgminmax
+        minmax = SkyImagePlotItem.imageMinMax(self)
+        self._plane_minmax[self._image_key] = minmax
+        if computed and self._stats_cache and self._image_key is not None:
+            # this happens for every plane visited, so rather than rewriting the cache file each time, save later
+            self._stats_cache.setMinMax(self._image_key, minmax, save=False)
+            self._stats_cache.saveLater()
+        return minmax
+
+    def _planeKeys(self):
+        """Iterates over the keys (tuples of extra axis indices) of all planes in the cube. The last axis is
+        iterated over slowest, since that is the outermost axis of a FITS file."""
+        dims = [len(labels) for iaxis, name, labels, values, units, scale in self._extra_axes]
+        for key in itertools.product(*[range(n) for n in dims[::-1]]):
+            yield key[::-1]
+
+    def _planeIndex(self, key):
+        """Converts a plane key (tuple of extra axis indices) into an index into the datacube"""
+        index = list(self.imgslice)
+        for i, (iaxis, name, labels, values, units, scale) in enumerate(self._extra_axes):
+            index[iaxis] = key[i]
+        return tuple(index)
+
+    def _planewiseMinMax(self, progress=None):
+        """Computes min/max of a lazy datacube one plane at a time, using (and filling) the per-plane
+        min/max cache along the way. Progress is as for dataMinMax()."""
+        dprint(3, "computing data min/max plane by plane")
+        dmin = dmax = None
+        keys = list(self._planeKeys())
+        for num, key in enumerate(keys):
+            minmax = self._plane_minmax.get(key)
+            if minmax is None:
+                plane = numpy.asarray(self._raw[self._planeIndex(key)])
+                stats = computeStats(numpy.ravel(plane, order='K'))
+                minmax = (stats if self._scaled is None else stats.scaled(*self.dataScaling())).minMax()
+                self._plane_minmax[key] = minmax
+                if self._stats_cache:
+                    self._stats_cache.setMinMax(key, minmax, save=False)
+            if not numpy.isnan(minmax[0]):
+                dmin = minmax[0] if dmin is None else min(dmin, minmax[0])
+                dmax = minmax[1] if dmax is None else max(dmax, minmax[1])
+            if progress:
+                progress((num + 1) / len(keys))
+        if dmin is None:
+            return numpy.nan, numpy.nan
+        return dmin, dmax
+
+    def _loadPlane(self, key):
+        """Returns the plane given by key, paging it in from the datacube if it is not already in the plane
+        cache. Only used if hasPlaneCache() is True. Safe to call from the prefetch thread."""
+        plane = self._plane_cache.get(key)
+        if plane is not None:
+            return plane
+        dprint(3, "paging in plane", key)
+        # this makes an in-memory copy of the plane (in its original memory order), in native byte order, since
+        # numpy and scipy are much faster with that. The byte swap comes for free with the copy.
+        plane = self._raw[self._planeIndex(key)]
+        plane = numpy.array(plane, dtype=plane.dtype.newbyteorder('='))
+        self._plane_cache.put(key, plane)
+        return plane
+
+    def _prefetchPlanes(self, key):
+        """Schedules the planes adjacent to the given one to be paged in in the background. Only used if
+        hasPlaneCache() is True."""
+        executor = _getPrefetchExecutor()
+        for i, (iaxis, name, labels, values, units, scale) in enumerate(self._extra_axes):
+            for offset in range(1, self.PrefetchWindow + 1):
+                for index in key[i] + offset, key[i] - offset:
+                    if 0 <= index < len(labels):
+                        key1 = key[:i] + (index,) + key[i + 1:]
+                        if key1 not in self._plane_cache:
+                            executor.submit(self._loadPlane, key1)
+
+    def plane(self, key):
+        """Returns the plane given by key (a tuple of extra axis indices) as a tuple of (image, key, minmax), without
+        selecting it (see SkyImagePlotItem.prerenderPlane()). The plane's min/max is computed if not already known.
+        Safe to call from a background thread."""
+        image = self._loadPlane(key) if self.hasPlaneCache() else self._raw[self._planeIndex(key)]
+        minmax = self._plane_minmax.get(key)
+        if minmax is None:
+            minmax = self._plane_minmax[key] = self._computeStats(image).minMax()
+        return image, key, minmax
+
+    def releaseCaches(self):
+        SkyImagePlotItem.releaseCaches(self)
+        self._plane_cache.clear()
+
     def setNumAxes(self, ndim):
         self.imgslice = [0] * ndim
 
@@ -555,8 +1093,11 @@ class SkyCubePlotItem(SkyImagePlotItem):
     def _setupSlice(self):
         index = tuple(self.imgslice)
         key = tuple([index[iaxis] for iaxis, name, labels, values, units, scale in self._extra_axes])
-        image = self._data[index]
-        self.setImage(self._data[index], key=key)
+        if self.hasPlaneCache():
+            self.setImage(self._loadPlane(key), key=key, minmax=self._plane_minmax.get(key))
+            self._prefetchPlanes(key)
+        else:
+            self.setImage(self._raw[index], key=key, minmax=self._plane_minmax.get(key))
 
     def selectSlice(self, *indices):
         if len(indices) != len(self._extra_axes):
@@ -579,6 +1120,19 @@ class FITSImagePlotItem(SkyCubePlotItem):
         nax = hdr['NAXIS']
         return nax if hdr['CTYPE%d' % nax].strip() == "COMPLEX" else 0
 
+    @staticmethod
+    def rawScaling(hdr):
+        """Returns (bscale, bzero) if the data of a FITS file with the given header should be kept in raw integer form
+        and scaled on demand (see ScaledData), else None (data is not scaled, or is left to astropy to scale).
+        This is the case for integer data with BSCALE/BZERO, unless it has BLANK values (which astropy turns into
+        NaNs), or BZERO is only there to make unsigned integers (which astropy reads as such)."""
+        bitpix, bscale, bzero = hdr['BITPIX'], hdr.get('BSCALE', 1), hdr.get('BZERO', 0)
+        if bitpix < 0 or 'BLANK' in hdr or (bscale, bzero) == (1, 0):
+            return None
+        if bitpix > 8 and (bscale, bzero) == (1, 2 ** (bitpix - 1)):
+            return None
+        return bscale, bzero
+
     @staticmethod
     def addComplexAxis(header):
         """Adds a complex axis to the given FITS header, returns new copy of header"""
@@ -605,37 +1159,61 @@ class FITSImagePlotItem(SkyCubePlotItem):
                     del header[key]
         return header
 
-    def __init__(self, filename=None, name=None, hdu=None):
+    # files of this size (in bytes) or larger are loaded lazily (i.e. memory-mapped, with planes paged in on demand)
+    LazyLoadThreshold = 2 ** 31
+
+    def __init__(self, filename=None, name=None, hdu=None, lazy=None, virtual=None):
         SkyCubePlotItem.__init__(self)
         self.RenderAntialiased
         self.name = name
         if filename or hdu:
-            self.read(filename, hdu)
+            self.read(filename, hdu, lazy=lazy, virtual=virtual)
 
     StokesNames = FITSHeaders.StokesNames
     ComplexNames = FITSHeaders.ComplexNames
 
-    def read(self, filename, hdu=None):
+    def read(self, filename, hdu=None, lazy=None, virtual=None):
+        """Reads image from FITS file, or from the given HDU.
+        If lazy is True, the file is memory-mapped and only the currently selected plane is read in.
+        If lazy is None, this is decided based on file size (see LazyLoadThreshold). Integer data with BSCALE/BZERO
+        is kept in raw form (see rawScaling()), so it takes no more memory than in the file. HDUs are never loaded lazily,
+        unless virtual is given: this is a virtual datacube (see Expressions.ExpressionArray, already in the
+        transposed axis order of data()) that is used instead of the HDU's data, with planes computed as they are
+        selected. In this case the HDU only supplies the header."""
         self.filename = filename
         self.name = self.name or os.path.basename(filename)
         # read FITS file
+        hdu_given = bool(hdu)
+        scaling = None
         if not hdu:
-            dprint(3, "opening", filename)
-            hdu = pyfits.open(filename)[0]
+            if lazy is None:
+                lazy = os.path.getsize(filename) >= self.LazyLoadThreshold
+            scaling = self.rawScaling(pyfits.getheader(filename))
+            dprint(3, "opening", filename, "(lazy mode)" if lazy else "", "(raw data, scaling %s)" % (scaling,)
+                   if scaling else "")
+            kw = dict(do_not_scale_image_data=bool(scaling))
+            hdu = pyfits.open(filename, memmap=True, **kw)[0] if lazy else pyfits.open(filename, **kw)[0]
             hdu.verify('silentfix')
             if os.path.getsize(filename) < hdu._file.tell():
                 raise RuntimeError(
                     f"FITS file may have been truncated: file length ({os.path.getsize(filename)}) "
                     f"is smaller than expected ({hdu._file.tell()})")
         hdr = self.fits_header = hdu.header
+        # statistics of files (but not of in-memory HDUs) are cached across sessions
+        self.setStatsCache(StatsCache.forFile(filename) if filename and not hdu_given else None)
         dprint(3, "reading data")
-        data = hdu.data
-        # NB: all-data operations (such as getting global min/max or computing of histograms) are much faster
-        # (almost x2) when data is iterated
-        # over in the proper order. After a transpose(), data is in fortran order. Tell this to setData().
-        data = numpy.transpose(data)  # .copy()
+        if virtual is not None:
+            data, lazy = virtual, True
+        else:
+            data = hdu.data
+            # NB: all-data operations (such as getting global min/max or computing of histograms) are much faster
+            # (almost x2) when data is iterated
+            # over in the proper order. After a transpose(), data is in fortran order. Tell this to setData().
+            data = numpy.transpose(data)  # .copy()
+            if scaling:
+                data = ScaledData(data, *scaling)
         dprint(3, "setting data")
-        self.setData(data, fortran_order=True)
+        self.setData(data, fortran_order=True, lazy=bool(lazy))
         dprint(3, "reading header")
         ndim = hdr['NAXIS']
         if ndim < 2:
@@ -702,14 +1280,34 @@ class FITSImagePlotItem(SkyCubePlotItem):
         self._setupSlice()
 
     def save(self, filename):
-        data = data1 = self.data().transpose()
-        if numpy.ma.isMA(data):
-            data1 = data.data.copy()
-            data1[data.mask] = numpy.NAN
-        hdu = pyfits.PrimaryHDU(data1, self.fits_header)
+        """Saves the image to a FITS file. The data is streamed out one plane at a time, with masked values filled
+        in with NaNs on the fly, so at most a plane is copied (and virtual datacubes, see read(), are computed
+        plane by plane too)."""
+        data = self.data()
+        # make a header consistent with the data (BITPIX, NAXISn, etc.), by way of an HDU with a placeholder
+        # of the right shape and type, which takes no memory
+        hdu = pyfits.PrimaryHDU(numpy.broadcast_to(numpy.zeros((), data.dtype), data.shape[::-1]), self.fits_header)
         hdu.verify('silentfix')
+        # unsigned integers (other than bytes) are stored as signed integers offset by BZERO
+        bzero = hdu.header.get('BZERO') if data.dtype.kind == 'u' else None
         if os.path.exists(filename):
             os.remove(filename)
-        hdu.writeto(filename, overwrite=True)
+        dprint(2, "writing", filename)
+        try:
+            with pyfits.StreamingHDU(filename, hdu.header) as stream:
+                # the first FITS axis varies fastest, so go through the planes (i.e. the first two axes of data())
+                # with the last axis varying slowest
+                for index in itertools.product(*[range(n) for n in data.shape[:1:-1]]):
+                    plane = data[(slice(None), slice(None)) + index[::-1]]
+                    if numpy.ma.isMA(plane):
+                        plane = plane.filled(numpy.nan)
+                    if bzero:
+                        plane = (plane - numpy.array(bzero, plane.dtype)).astype(plane.dtype.str.replace('u', 'i'))
+                    stream.write(numpy.ascontiguousarray(numpy.transpose(plane)))
+        except:
+            # do not leave a truncated file behind
+            if os.path.exists(filename):
+                os.remove(filename)
+            raise
         self.filename = filename
         self.name = os.path.basename(filename)
@@ -0,0 +1,182 @@
+# Copyright (C) 2002-2022
+# The MeqTree Foundation &
+# ASTRON (Netherlands Foundation for Research in Astronomy)
+# P.O.Box 2, 7990 AA Dwingeloo, The Netherlands
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>,
+# or write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""Background prefetching of cube planes adjacent to the current slice, for fast slice navigation."""
+
+import numpy
+from PyQt5.Qt import QObject, QTimer
+from PyQt5.QtCore import pyqtSignal
+
+import TigGUI.kitties.utils
+from TigGUI.Images.RenderCache import getCacheManager
+from TigGUI.Images.Workers import BackgroundJob, getThreadPool
+from TigGUI.init import Config
+
+_verbosity = TigGUI.kitties.utils.verbosity(name="prefetch")
+dprint = _verbosity.dprint
+dprintf = _verbosity.dprintf
+
+# default number of planes prefetched along the slice axis. Can be changed via the prefetch-planes config option.
+DefaultNumPlanes = 4
+# default memory budget for prefetched planes, in megabytes. Can be changed via the prefetch-budget-mb config option.
+# This is further limited to a quarter of the global cache budget (see RenderCache), so that prefetching does not
+# evict what is currently on display.
+DefaultBudgetMB = 256
+
+
+def _prefetchJob(job, prefetcher, image, keys):
+    """Background job function for SlicePrefetcher: computes the min/max of each plane in keys (in order), and
+    renders it for the current view. Min/max results are posted back via the prefetcher's sliceRangeReady signal."""
+    for key in keys:
+        job.checkCancelled()
+        plane = image.plane(key)
+        prefetcher.sliceRangeReady.emit(key, plane[2])
+        image.prerenderPlane(plane, check=job.checkCancelled)
+
+
+class SlicePrefetcher(QObject):
+    """A SlicePrefetcher works ahead of slice navigation of a cube (see RenderControl): whenever the slice changes,
+    it computes the min/max of the next few planes along the axis being navigated, and renders them for the current
+    view into the image's tile cache, so that flipping to them is instant. This is done in a (cancellable)
+    background job, which is restarted on every slice change.
+    The prefetch window adapts to navigation: when stepping repeatedly in one direction, planes are prefetched mostly
+    ahead in that direction, otherwise on both sides of the current plane. The number of planes is limited by a
+    memory budget, based on the estimated size of a prefetched plane.
+    Emits sliceRangeReady(key, minmax) as plane min/max values become available."""
+    sliceRangeReady = pyqtSignal(tuple, tuple)
+
+    def __init__(self, image, dims, parent=None):
+        """Image is a SkyCubePlotItem, dims is the list of sizes of its extra axes"""
+        QObject.__init__(self, parent)
+        self.image = image
+        self._dims = list(dims)
+        self._num_planes = Config.getint("prefetch-planes", DefaultNumPlanes)
+        self._budget = min(Config.getint("prefetch-budget-mb", DefaultBudgetMB) * 2 ** 20,
+                           getCacheManager().budget() // 4)
+        # last slice seen, the axis being navigated, and the current direction of navigation along it
+        # (+1/-1, or 0 if not known). Streak counts consecutive steps in that direction.
+        self._last_key = None
+        self._axis = None
+        self._direction = 0
+        self._streak = 0
+        self._job = None
+        self._enabled = True
+        # prefetching is started once the event loop is idle, so that it does not hold up drawing of the new slice
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(0)
+        self._timer.timeout.connect(self._startPrefetch)
+
+    def isEnabled(self):
+        return self._enabled and self._num_planes > 0
+
+    def setEnabled(self, enabled):
+        """Enables or disables prefetching (e.g. while something else is rendering ahead, see CubePlayer)"""
+        self._enabled = enabled
+        if not enabled:
+            self.cancel()
+
+    def cancel(self):
+        """Cancels any prefetching in progress"""
+        self._timer.stop()
+        if self._job is not None:
+            self._job.cancel()
+            self._job = None
+
+    def sliceChanged(self, key):
+        """Called when the current slice has changed to key (a tuple of extra axis indices)"""
+        key = tuple(key)
+        self.cancel()
+        if not self.isEnabled():
+            return
+        self._updateDirection(key)
+        self._last_key = key
+        if self._axis is not None:
+            self._timer.start()
+
+    def _updateDirection(self, key):
+        """Works out which axis is being navigated, and in which direction, from the previous and current slice"""
+        if self._last_key is None or len(self._last_key) != len(key):
+            changed = []
+        else:
+            changed = [i for i, (i0, i1) in enumerate(zip(self._last_key, key)) if i0 != i1]
+        if len(changed) != 1:
+            # first slice, or several axes changed at once: pick the first non-trivial axis, direction unknown
+            if self._axis is None:
+                self._axis = next((i for i, n in enumerate(self._dims) if n > 1), None)
+            self._direction = self._streak = 0
+            return
+        axis = changed[0]
+        delta = key[axis] - self._last_key[axis]
+        # stepping across the end of the axis (see RenderControl.incrementSlice()) wraps around
+        if abs(delta) == self._dims[axis] - 1:
+            delta = -numpy.sign(delta)
+        direction = int(numpy.sign(delta)) if abs(delta) == 1 else 0
+        if axis == self._axis and direction and direction == self._direction:
+            self._streak += 1
+        else:
+            self._streak = 1 if direction else 0
+        self._axis, self._direction = axis, direction
+
+    def _planeBytes(self):
+        """Estimates memory used by one prefetched plane"""
+        tsize = self.image.TileSize
+        # rendered tile (ARGB), quantized tile (16 bits) and interpolated tile (float32 or float64)
+        itemsize = numpy.result_type(self.image.data().dtype, numpy.float32).itemsize
+        nbytes = self.image.lastViewNumTiles() * tsize * tsize * (4 + 2 + itemsize)
+        if self.image.hasPlaneCache():
+            nx, ny = self.image.imageDims()
+            nbytes += nx * ny * self.image.data().dtype.itemsize
+        return max(nbytes, 1)
+
+    def prefetchKeys(self, key):
+        """Returns the list of keys of planes to be prefetched around the plane given by key, in order of priority"""
+        axis = self._axis
+        n = self._dims[axis]
+        num_planes = min(self._num_planes, self._budget // self._planeBytes(), n - 1)
+        if self._direction and self._streak > 1:
+            # navigating steadily in one direction: prefetch mostly ahead, keeping one plane behind
+            behind = 1 if num_planes >= 4 else 0
+            ahead = num_planes - behind
+            offsets = [self._direction * i for i in range(1, ahead + 1)] + \
+                      [-self._direction * i for i in range(1, behind + 1)]
+        else:
+            # otherwise, alternate either side of the current plane, favouring the last direction of travel
+            first = self._direction or 1
+            offsets = [sign * i for i in range(1, num_planes + 1) for sign in (first, -first)][:num_planes]
+        keys = []
+        for offset in offsets:
+            # wrap around, as RenderControl.incrementSlice() does
+            key1 = key[:axis] + ((key[axis] + offset) % n,) + key[axis + 1:]
+            if key1 != key and key1 not in keys:
+                keys.append(key1)
+        return keys
+
+    def _startPrefetch(self):
+        key = self._last_key
+        if key is None or self._axis is None:
+            return
+        keys = self.prefetchKeys(key)
+        if not keys:
+            return
+        dprint(2, "prefetching", len(keys), "planes around", key, "direction", self._direction)
+        self._job = BackgroundJob(_prefetchJob, self, self.image, keys, description="prefetch around %s" % (key,))
+        self._job.start(getThreadPool("prefetch", 1))
@@ -0,0 +1,397 @@
+# Copyright (C) 2002-2022
+# The MeqTree Foundation &
+# ASTRON (Netherlands Foundation for Research in Astronomy)
+# P.O.Box 2, 7990 AA Dwingeloo, The Netherlands
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>,
+# or write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""Single-pass statistics (min/max and their positions, count, sum, mean and variance, and optionally a quantile sketch)
+of large arrays."""
+
+import math
+
+import numpy
+
+import TigGUI.kitties.utils
+from TigGUI.Images.Workers import getThreadPool
+
+_verbosity = TigGUI.kitties.utils.verbosity(name="statistics")
+dprint = _verbosity.dprint
+dprintf = _verbosity.dprintf
+
+# number of elements per chunk. Chunks should fit into the CPU cache, so that the several reductions done on
+# each chunk only go to main memory once.
+ChunkSize = 2 ** 18
+
+
+class QuantileSketch:
+    """A QuantileSketch summarizes a distribution of values for quantile queries, as a t-digest (Dunning & Ertl 2019):
+    a sorted list of centroids (mean value and weight) of clusters of adjacent values. Clusters are small in the tails
+    of the distribution and large in the middle, so quantiles near 0 or 1 (as used for e.g. 99.9% display ranges) are
+    particularly accurate. Sketches of separate chunks of data can be combined with merge().
+    The compression parameter bounds the number of centroids (to about compression/2)."""
+    Compression = 2000
+
+    def __init__(self, means=(), weights=(), dmin=numpy.nan, dmax=numpy.nan, compression=None):
+        self.compression = compression or self.Compression
+        self.means = numpy.asarray(means, float)
+        self.weights = numpy.asarray(weights, float)
+        self.min, self.max = dmin, dmax
+
+    @property
+    def count(self):
+        return self.weights.sum()
+
+    @staticmethod
+    def fromValues(values, compression=None):
+        """Makes a sketch of an array of (finite) values"""
+        values = numpy.sort(numpy.ravel(values))
+        sketch = QuantileSketch(compression=compression)
+        if values.size:
+            sketch.means, sketch.weights = values.astype(float), numpy.ones(values.size)
+            sketch.min, sketch.max = float(values[0]), float(values[-1])
+            sketch._compress()
+        return sketch
+
+    def _compress(self):
+        """Merges adjacent centroids into clusters, such that each cluster spans at most one unit of the
+        k1 scale function k(q) = compression/(2*pi)*asin(2q-1). Centroids must be sorted by mean."""
+        total = self.weights.sum()
+        if not total:
+            return
+        # cluster number of each centroid, based on the quantile of its midpoint
+        q = (numpy.cumsum(self.weights) - self.weights / 2) / total
+        k = numpy.floor(self.compression / (2 * math.pi) * numpy.arcsin(2 * q - 1))
+        starts = numpy.concatenate([[0], numpy.flatnonzero(numpy.diff(k)) + 1])
+        weights = numpy.add.reduceat(self.weights, starts)
+        self.means = numpy.add.reduceat(self.means * self.weights, starts) / weights
+        self.weights = weights
+
+    def merge(self, other):
+        """Merges another sketch into this one. Returns self."""
+        if not other.weights.size:
+            return self
+        if not self.weights.size:
+            self.means, self.weights, self.min, self.max = other.means, other.weights, other.min, other.max
+            return self
+        means = numpy.concatenate([self.means, other.means])
+        order = numpy.argsort(means, kind='stable')
+        self.means = means[order]
+        self.weights = numpy.concatenate([self.weights, other.weights])[order]
+        self.min, self.max = min(self.min, other.min), max(self.max, other.max)
+        self._compress()
+        return self
+
+    def quantile(self, q):
+        """Returns the value at quantile q (0...1, or an array of these). Returns NaN for an empty sketch."""
+        if not self.weights.size:
+            return numpy.full(numpy.shape(q), numpy.nan) if numpy.ndim(q) else numpy.nan
+        # each centroid is taken to sit at the middle of its cluster, with the min and max at the ends
+        total = self.weights.sum()
+        positions = numpy.concatenate([[0], numpy.cumsum(self.weights) - self.weights / 2, [total]])
+        values = numpy.concatenate([[self.min], self.means, [self.max]])
+        return numpy.interp(numpy.asarray(q) * total, positions, values)
+
+    def scaled(self, scale, offset):
+        """Returns a new sketch of the values transformed as value*scale+offset"""
+        means, weights, dmin, dmax = self.means * scale + offset, self.weights, self.min * scale + offset, \
+                                     self.max * scale + offset
+        if scale < 0:
+            means, weights, dmin, dmax = means[::-1], weights[::-1], dmax, dmin
+        return QuantileSketch(means, weights, dmin, dmax, compression=self.compression)
+
+    def toArray(self):
+        """Returns the sketch packed into a 1D array, see fromArray()"""
+        return numpy.concatenate([[self.compression, self.min, self.max], self.means, self.weights])
+
+    @staticmethod
+    def fromArray(array):
+        """Makes a sketch from an array returned by toArray()"""
+        n = (len(array) - 3) // 2
+        return QuantileSketch(array[3:3 + n], array[3 + n:], array[1], array[2], compression=array[0])
+
+
+class Stats:
+    """Statistics of a set of values: count, sum, min, max, argmin, argmax (positions of the min and max in the
+    flattened array), mean, and the sum of squared deviations from the mean (m2), from which variance is derived.
+    If requested, a QuantileSketch of the values is also made (else sketch is None).
+    Stats of separate chunks of data can be combined with merge(). With no values, min/max/mean are NaN."""
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.
+        self.min = self.max = self.mean = numpy.nan
+        self.argmin = self.argmax = None
+        self.m2 = 0.
+        self.sketch = None
+
+    @property
+    def var(self):
+        """Population variance (as computed by e.g. numpy.var())"""
+        return self.m2 / self.count if self.count else numpy.nan
+
+    @property
+    def std(self):
+        """Population standard deviation"""
+        return math.sqrt(self.var) if self.count else numpy.nan
+
+    def minMax(self):
+        return self.min, self.max
+
+    def extrema(self):
+        """Returns (min, max, argmin, argmax), like scipy.ndimage.measurements.extrema()"""
+        return self.min, self.max, self.argmin, self.argmax
+
+    def scaled(self, scale, offset):
+        """Returns new Stats of the values transformed as value*scale+offset. This is used for integer FITS data, whose
+        stats are computed on the raw values, then converted into physical units using BSCALE and BZERO."""
+        stats = Stats()
+        stats.count = self.count
+        if not self.count:
+            return stats
+        stats.min, stats.max = self.min * scale + offset, self.max * scale + offset
+        stats.argmin, stats.argmax = self.argmin, self.argmax
+        if scale < 0:
+            stats.min, stats.max, stats.argmin, stats.argmax = stats.max, stats.min, stats.argmax, stats.argmin
+        stats.sum = self.sum * scale + offset * self.count
+        stats.mean = self.mean * scale + offset
+        stats.m2 = self.m2 * scale * scale
+        if self.sketch is not None:
+            stats.sketch = self.sketch.scaled(scale, offset)
+        return stats
+
+    def merge(self, other):
+        """Merges in the stats of another chunk of data, which is taken to follow this one (i.e. for equal values,
+        the argmin/argmax of this one takes precedence). Returns self."""
+        if not other.count:
+            return self
+        if not self.count:
+            self.__dict__.update(other.__dict__)
+            return self
+        if other.min < self.min:
+            self.min, self.argmin = other.min, other.argmin
+        if other.max > self.max:
+            self.max, self.argmax = other.max, other.argmax
+        # parallel form of Welford's update (Chan et al.)
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.sum += other.sum
+        if other.sketch is not None:
+            self.sketch = other.sketch if self.sketch is None else self.sketch.merge(other.sketch)
+        return self
+
+
+def nativeOrder(data):
+    """Returns data in native byte order, byte-swapping it (into a copy) if needed. FITS data is big-endian, and numpy
+    is much faster with native data, so chunks are converted before they are processed."""
+    if data.dtype.isnative:
+        return data
+    return data.astype(data.dtype.newbyteorder('='))
+
+
+def chunkStats(data, mask=None, offset=0, sketch=False):
+    """Computes Stats of a 1D array. Elements that are masked (mask is True) or not finite are ignored.
+    Offset is added to argmin/argmax. If sketch is True, a QuantileSketch is made as well."""
+    stats = Stats()
+    # (the mask of a masked array is given separately, so only its data is used, not its compressed view)
+    data = nativeOrder(numpy.ma.getdata(data))
+    valid = numpy.isfinite(data)
+    if mask is not None:
+        valid &= ~mask
+    if valid.all():
+        values, index = data, None
+    else:
+        index = numpy.flatnonzero(valid)
+        values = data[index]
+    if not values.size:
+        return stats
+    imin, imax = values.argmin(), values.argmax()
+    stats.min, stats.max = values[imin], values[imax]
+    if index is not None:
+        imin, imax = index[imin], index[imax]
+    stats.argmin, stats.argmax = offset + int(imin), offset + int(imax)
+    stats.count = values.size
+    stats.sum = float(values.sum(dtype=numpy.float64))
+    stats.mean = stats.sum / stats.count
+    # within a chunk, the two-pass formula is both accurate and cheap, since the chunk is in cache
+    stats.m2 = float(numpy.square(numpy.subtract(values, stats.mean, dtype=numpy.float64)).sum())
+    if sketch:
+        stats.sketch = QuantileSketch.fromValues(values)
+    return stats
+
+
+def _ravelWithMask(data, mask):
+    """Flattens data and mask. Returns (data, mask), with mask None if nothing is masked, or False if everything is.
+    Array-like objects with a ravel() method (such as SkyImage.ScaledData) are raveled via that, rather than being
+    converted into numpy arrays, since only chunks of them are needed."""
+    data = data.ravel() if hasattr(data, 'ravel') else numpy.ravel(data)
+    if mask is not None:
+        mask = numpy.ravel(mask)
+        # a mask of numpy.ma.nomask ravels into a single element
+        if mask.size != data.size:
+            mask = False if mask.any() else None
+    return data, mask
+
+
+def reduceChunks(size, func, merge, progress=None, chunk_size=None, threads=True, pool="stats"):
+    """Calls func(i0,i1) for consecutive chunks of [0,size), in parallel in the given thread pool (see
+    Workers.getThreadPool()) unless threads is False, and calls merge(result) on the results, in order.
+    If progress is given, it is called as progress(fraction) as chunks complete. It may raise an exception to abandon
+    the computation, in which case outstanding chunks are cancelled and the exception is propagated."""
+    chunk_size = chunk_size or ChunkSize
+    chunks = [(i0, min(i0 + chunk_size, size)) for i0 in range(0, size, chunk_size)]
+    if len(chunks) > 1 and threads:
+        futures = [getThreadPool(pool).submit(func, *chunk) for chunk in chunks]
+        try:
+            for num, future in enumerate(futures):
+                merge(future.result())
+                if progress:
+                    progress((num + 1) / len(chunks))
+        finally:
+            for future in futures:
+                future.cancel()
+    else:
+        for num, chunk in enumerate(chunks):
+            merge(func(*chunk))
+            if progress:
+                progress((num + 1) / len(chunks))
+
+
+def computeStats(data, mask=None, progress=None, chunk_size=None, threads=True, sketch=False):
+    """Computes Stats of a 1D array (see SkyImagePlotItem.optimalRavel() for how to flatten images efficiently),
+    walking it in chunks of chunk_size (default is ChunkSize) elements, which are processed in parallel in the
+    "stats" thread pool, unless threads is False. Elements that are masked (mask is True) or not finite are ignored.
+    If progress is given, it is called as progress(fraction) as chunks complete. It may raise an exception
+    (such as Workers.JobCancelled) to abandon the computation, in which case the exception is propagated.
+    If sketch is True, a QuantileSketch of the data is made along the way (this is more expensive, since each
+    chunk needs to be sorted)."""
+    data, mask = _ravelWithMask(data, mask)
+    stats = Stats()
+    if mask is False:
+        return stats
+    dprint(3, "computing stats of", data.size, "elements")
+    reduceChunks(data.size,
+                 lambda i0, i1: chunkStats(data[i0:i1], None if mask is None else mask[i0:i1], i0, sketch=sketch),
+                 stats.merge, progress=progress, chunk_size=chunk_size, threads=threads)
+    return stats
+
+
+def chunkHistogram(data, mask, hmin, hmax, nbins):
+    """Computes a histogram of a 1D array: counts of values in nbins equal bins between hmin and hmax, with values
+    equal to hmax going into the last bin (as numpy.histogram() does). Masked and non-finite elements are ignored.
+    A degenerate range (hmin == hmax, e.g. for a constant or blank plane) is widened to hmin...hmin+1."""
+    if hmax <= hmin:
+        hmax = hmin + 1
+    data = nativeOrder(data)
+    with numpy.errstate(invalid='ignore'):
+        valid = (data >= hmin) & (data <= hmax)
+    if mask is not None:
+        valid &= ~mask
+    index = ((data[valid] - hmin) * (nbins / (hmax - hmin))).astype(int)
+    index[index >= nbins] = nbins - 1
+    return numpy.bincount(index, minlength=nbins)
+
+
+def computeHistogram(data, mask, hmin, hmax, nbins, progress=None, chunk_size=None, threads=True):
+    """Computes a histogram (see chunkHistogram()) of a 1D array in chunks, in the same way as computeStats()"""
+    data, mask = _ravelWithMask(data, mask)
+    counts = numpy.zeros(nbins, int)
+    if mask is False:
+        return counts
+    dprint(3, "computing", nbins, "bin histogram of", data.size, "elements")
+
+    def merge(hist):
+        counts[...] += hist
+
+    reduceChunks(data.size,
+                 lambda i0, i1: chunkHistogram(data[i0:i1], None if mask is None else mask[i0:i1], hmin, hmax, nbins),
+                 merge, progress=progress, chunk_size=chunk_size, threads=threads)
+    return counts
+
+
+class HistogramCache:
+    """A HistogramCache provides histograms of a fixed data subset over arbitrary (zoomed-in) ranges, without going
+    over the data again for every zoom step. It holds a fine histogram of the full data range, plus finer histograms
+    of narrower ranges, which are computed on demand whenever a requested histogram would need bins narrower than
+    anything cached (e.g. when zooming into the noise peak of an image with a few bright sources). Each refinement is
+    made wider and finer than requested, so that subsequent zooming and panning around the same place is served from
+    cached counts. Requested histograms are rebinned from the cumulative counts of the best cached histogram,
+    taking values to be evenly spread within each cached bin."""
+    # number of bins of the full-range histogram
+    NumBins = 10000
+    # each requested bin spans at least this many cached bins, else a finer histogram is computed
+    MinOversample = 4
+    # refinements are made this much finer than needed for the requested histogram, to allow for further zooming...
+    RefineHeadroom = 16
+    # ...and cover this many times the requested range
+    RefineSpan = 3
+    # max number of refinements held, the oldest ones are dropped beyond this
+    MaxRefinements = 16
+
+    def __init__(self, data, mask, dmin, dmax, hist=None, progress=None):
+        """Data and mask are 1D arrays, as for computeStats(). Dmin, dmax is the data range. If hist is given, it is
+        taken to be a NumBins-bin histogram of the full range (e.g. one stored in a StatsCache), else it is computed,
+        reporting progress as for computeStats()."""
+        self._data, self._mask = data, mask
+        # (a degenerate range is widened as in chunkHistogram())
+        self.min, self.max = dmin, dmax if dmax > dmin else dmin + 1
+        if hist is None:
+            dprint(1, "computing histogram for full range", dmin, dmax)
+            hist = computeHistogram(data, mask, self.min, self.max, self.NumBins, progress=progress)
+        # list of (hmin, hmax, cumulative counts) for each cached histogram, the full-range histogram first
+        self._histograms = [self._cumulative(self.min, self.max, hist)]
+
+    @staticmethod
+    def _cumulative(hmin, hmax, hist):
+        return hmin, hmax, numpy.concatenate([[0], numpy.cumsum(hist)])
+
+    def fullHistogram(self):
+        """Returns the NumBins-bin histogram of the full range"""
+        return numpy.diff(self._histograms[0][2])
+
+    def histogram(self, hmin, hmax, nbins):
+        """Returns an nbins-bin histogram over hmin...hmax, which must be within the data range"""
+        binsize = (hmax - hmin) / nbins
+        best = None
+        for hist in self._histograms:
+            h0, h1, cumcounts = hist
+            cached_binsize = (h1 - h0) / (len(cumcounts) - 1)
+            # pick the coarsest cached histogram covering the range that has fine enough bins
+            if h0 <= hmin and h1 >= hmax and cached_binsize * self.MinOversample <= binsize and \
+                    (best is None or cached_binsize > best[0]):
+                best = cached_binsize, hist
+        if best is None:
+            best = None, self._refine(hmin, hmax, binsize)
+        h0, h1, cumcounts = best[1]
+        edges = numpy.linspace(hmin, hmax, nbins + 1)
+        cumulative = numpy.interp(edges, numpy.linspace(h0, h1, len(cumcounts)), cumcounts)
+        return numpy.diff(cumulative)
+
+    def _refine(self, hmin, hmax, binsize):
+        """Computes and caches a histogram covering hmin...hmax with a bin size of at most binsize/MinOversample"""
+        margin = (hmax - hmin) * (self.RefineSpan - 1) / 2
+        h0, h1 = max(hmin - margin, self.min), min(hmax + margin, self.max)
+        nbins = int(math.ceil((h1 - h0) / binsize * self.MinOversample * self.RefineHeadroom))
+        dprint(1, "computing refined", nbins, "bin histogram for range", h0, h1)
+        hist = self._cumulative(h0, h1, computeHistogram(self._data, self._mask, h0, h1, nbins))
+        self._histograms.append(hist)
+        if len(self._histograms) > self.MaxRefinements + 1:
+            del self._histograms[1]
+        return hist
@@ -0,0 +1,202 @@
+# Copyright (C) 2002-2022
+# The MeqTree Foundation &
+# ASTRON (Netherlands Foundation for Research in Astronomy)
+# P.O.Box 2, 7990 AA Dwingeloo, The Netherlands
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>,
+# or write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+import hashlib
+import os
+import os.path
+import tempfile
+import threading
+import traceback
+
+import numpy
+
+import TigGUI.kitties.utils
+from TigGUI.Images.Statistics import QuantileSketch
+from TigGUI.init import Config
+
+_verbosity = TigGUI.kitties.utils.verbosity(name="statscache")
+dprint = _verbosity.dprint
+dprintf = _verbosity.dprintf
+
+# bump this when the layout of the cache files changes, so that old files are ignored
+FormatVersion = 1
+
+
+def cacheDir():
+    """Returns the directory in which statistics caches are stored. This is given by the stats-cache-dir config option,
+    or defaults to $XDG_CACHE_HOME/tigger/stats."""
+    path = Config.get("stats-cache-dir", "")
+    if not path:
+        path = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "tigger", "stats")
+    return path
+
+
+def forFile(filename):
+    """Returns a StatsCache for the given FITS file, or None if caching is disabled (via the stats-cache config option)"""
+    if not filename or not Config.getbool("stats-cache", True):
+        return None
+    try:
+        return StatsCache(filename)
+    except Exception:
+        traceback.print_exc()
+        print("Error setting up statistics cache for %s, proceeding without it" % filename)
+        return None
+
+
+class StatsCache:
+    """A StatsCache holds statistics (min/max, mean/std, histograms, quantile sketches) of an image file, for the full datacube and
+    for individual planes, and keeps them in a compact binary (.npz) sidecar file in the cache directory.
+    The sidecar is keyed by the absolute pathname of the image, and is only used if the size and modification
+    time of the image still match, so reopening a cube does not need any full-data passes.
+    Statistics are stored under a subset key, which is either StatsCache.FULL for the full datacube, or a plane key
+    (i.e. a tuple of extra axis indices, see SkyCubePlotItem).
+    """
+    FULL = "full"
+
+    # delay (in seconds) before the cache file is written after changes that are not saved immediately, see saveLater()
+    SaveDelay = 5
+
+    def __init__(self, filename, cachedir=None):
+        self.filename = os.path.normpath(os.path.abspath(filename))
+        st = os.stat(self.filename)
+        self._signature = numpy.array([FormatVersion, st.st_size, st.st_mtime_ns], numpy.int64)
+        self.cachefile = os.path.join(cachedir or cacheDir(),
+                                      hashlib.sha1(self.filename.encode()).hexdigest() + ".npz")
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._save_timer = None
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.cachefile):
+            return
+        try:
+            with numpy.load(self.cachefile, allow_pickle=False) as npz:
+                if str(npz["_path"]) != self.filename or not numpy.array_equal(npz["_signature"], self._signature):
+                    dprint(1, "stats cache", self.cachefile, "is stale, ignoring")
+                    return
+                self._entries = dict([(name, npz[name]) for name in npz.files if not name.startswith("_")])
+            dprint(1, "loaded", len(self._entries), "entries from stats cache", self.cachefile)
+        except Exception:
+            traceback.print_exc()
+            print("Error reading statistics cache %s, ignoring it" % self.cachefile)
+            self._entries = {}
+
+    def save(self):
+        """Writes the cache file, if anything has changed"""
+        with self._lock:
+            if not self._dirty:
+                return
+            entries = dict(self._entries)
+            self._dirty = False
+        try:
+            dirname = os.path.dirname(self.cachefile)
+            os.makedirs(dirname, exist_ok=True)
+            # write to temporary file and rename, so that concurrent readers never see a partial file
+            fd, tmpname = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+            with os.fdopen(fd, "wb") as tmpfile:
+                numpy.savez_compressed(tmpfile, _path=numpy.array(self.filename), _signature=self._signature,
+                                       **entries)
+            os.replace(tmpname, self.cachefile)
+            dprint(2, "saved", len(entries), "entries to stats cache", self.cachefile)
+        except Exception:
+            traceback.print_exc()
+            print("Error writing statistics cache %s" % self.cachefile)
+
+    def saveLater(self):
+        """Schedules the cache file to be written (see save()) in the background after SaveDelay seconds, unless this
+        is already scheduled. This batches up frequent small changes (such as the min/max of each plane, as the planes
+        of a cube are stepped through) into a single write, rather than rewriting the file for each one."""
+        with self._lock:
+            if self._save_timer is not None:
+                return
+            self._save_timer = threading.Timer(self.SaveDelay, self._timedSave)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    def _timedSave(self):
+        with self._lock:
+            self._save_timer = None
+        self.save()
+
+    @staticmethod
+    def _entryName(what, key):
+        if key == StatsCache.FULL:
+            return "%s:full" % what
+        return "%s:%s" % (what, ",".join(map(str, key)))
+
+    def _get(self, what, key):
+        with self._lock:
+            return self._entries.get(self._entryName(what, key))
+
+    def _set(self, what, key, value, save=True):
+        with self._lock:
+            self._entries[self._entryName(what, key)] = numpy.asarray(value)
+            self._dirty = True
+        if save:
+            self.save()
+
+    def getMinMax(self, key):
+        """Returns cached (min,max) tuple for subset, or None"""
+        value = self._get("minmax", key)
+        return None if value is None else tuple(value)
+
+    def setMinMax(self, key, minmax, save=True):
+        self._set("minmax", key, numpy.array(minmax[:2], float), save=save)
+
+    def getMeanStd(self, key):
+        """Returns cached (mean,std) tuple for subset, or None"""
+        value = self._get("meanstd", key)
+        return None if value is None else tuple(value)
+
+    def setMeanStd(self, key, mean, std, save=True):
+        self._set("meanstd", key, numpy.array([mean, std], float), save=save)
+
+    def getHistogram(self, key, hmin, hmax, nbins):
+        """Returns cached histogram of subset, or None if one with the same range and number of bins is not available"""
+        hrange = self._get("histrange", key)
+        hist = self._get("hist", key)
+        if hist is None or hrange is None or len(hist) != nbins or tuple(hrange) != (hmin, hmax):
+            return None
+        return hist
+
+    def setHistogram(self, key, hmin, hmax, hist, save=True):
+        self._set("histrange", key, numpy.array([hmin, hmax], float), save=False)
+        self._set("hist", key, hist, save=save)
+
+    def getSketch(self, key):
+        """Returns cached quantile sketch (see Statistics.QuantileSketch) of subset, or None"""
+        value = self._get("sketch", key)
+        return None if value is None else QuantileSketch.fromArray(value)
+
+    def setSketch(self, key, sketch, save=True):
+        self._set("sketch", key, sketch.toArray(), save=save)
+
+    def planeMinMaxes(self):
+        """Returns dict of plane key -> (min,max) for all planes that have a cached min/max"""
+        result = {}
+        with self._lock:
+            for name, value in self._entries.items():
+                what, key = name.split(":", 1)
+                if what == "minmax" and key != "full":
+                    result[tuple(int(x) for x in key.split(",") if x)] = tuple(value)
+        return result
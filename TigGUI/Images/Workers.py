@@ -0,0 +1,131 @@
+# Copyright (C) 2002-2022
+# The MeqTree Foundation &
+# ASTRON (Netherlands Foundation for Research in Astronomy)
+# P.O.Box 2, 7990 AA Dwingeloo, The Netherlands
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>,
+# or write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+import concurrent.futures
+import os
+import threading
+import traceback
+
+from PyQt5.Qt import QObject
+from PyQt5.QtCore import pyqtSignal
+
+import TigGUI.kitties.utils
+
+_verbosity = TigGUI.kitties.utils.verbosity(name="workers")
+dprint = _verbosity.dprint
+dprintf = _verbosity.dprintf
+
+# named thread pools, created on demand by getThreadPool()
+_thread_pools = {}
+_thread_pools_lock = threading.Lock()
+
+
+def getThreadPool(name, num_threads=None):
+    """Returns the named thread pool (a concurrent.futures.ThreadPoolExecutor), creating it if needed.
+    num_threads is only used when the pool is created, and defaults to the number of CPUs."""
+    with _thread_pools_lock:
+        pool = _thread_pools.get(name)
+        if pool is None:
+            num_threads = num_threads or os.cpu_count() or 1
+            dprint(1, "creating thread pool", name, "with", num_threads, "threads")
+            pool = _thread_pools[name] = concurrent.futures.ThreadPoolExecutor(
+                max_workers=num_threads, thread_name_prefix="tigger-%s" % name)
+        return pool
+
+
+class JobCancelled(Exception):
+    """Raised inside a job's function (by BackgroundJob.setProgress() or checkCancelled()) when the job has been cancelled"""
+    pass
+
+
+class BackgroundJob(QObject):
+    """A BackgroundJob runs a function in a worker thread, and reports back via Qt signals. Since the job object
+    lives in the thread that created it (normally the GUI thread), the signals are delivered there.
+    The function is called as func(job, *args, **kw), and may call job.setProgress() to report progress.
+    Cancellation is cooperative: cancel() sets a flag, which the function can check via job.setProgress() or
+    job.checkCancelled(). The result of a job that is cancelled before it completes is discarded.
+    Emits the following signals:
+    progress(fraction, message)   job progress, fraction is 0...1
+    finished(result)              job has completed, result is the return value of the function
+    failed(message)               function has raised an exception
+    cancelled()                   job has been cancelled
+    """
+    progress = pyqtSignal(float, str)
+    finished = pyqtSignal(object)
+    failed = pyqtSignal(str)
+    cancelled = pyqtSignal()
+
+    def __init__(self, func, *args, description=None, **kw):
+        QObject.__init__(self)
+        self._func, self._args, self._kw = func, args, kw
+        self.description = description or getattr(func, '__name__', "job")
+        self._cancel = threading.Event()
+        self._future = None
+
+    def start(self, pool="jobs"):
+        """Starts the job in the given thread pool (a name for getThreadPool(), or an executor object)"""
+        if isinstance(pool, str):
+            pool = getThreadPool(pool)
+        self._future = pool.submit(self._run)
+        return self
+
+    def cancel(self):
+        """Cancels the job. If it has not started yet, it never will."""
+        dprint(2, "cancelling", self.description)
+        self._cancel.set()
+        if self._future is not None and self._future.cancel():
+            self.cancelled.emit()
+
+    def isCancelled(self):
+        return self._cancel.is_set()
+
+    def isDone(self):
+        return self._future is not None and self._future.done()
+
+    def checkCancelled(self):
+        """Raises JobCancelled if the job has been cancelled. Called from inside the job's function."""
+        if self._cancel.is_set():
+            raise JobCancelled()
+
+    def setProgress(self, fraction, message=""):
+        """Reports job progress. Called from inside the job's function. Raises JobCancelled if the job has been cancelled."""
+        self.checkCancelled()
+        self.progress.emit(fraction, message)
+
+    def _run(self):
+        try:
+            self.checkCancelled()
+            dprint(2, "starting", self.description)
+            result = self._func(self, *self._args, **self._kw)
+            self.checkCancelled()
+        except JobCancelled:
+            dprint(2, "cancelled", self.description)
+            self.cancelled.emit()
+            return
+        except Exception as exc:
+            traceback.print_exc()
+            self.failed.emit(str(exc))
+            return
+        finally:
+            # drop references to the arguments, since the job object itself may be held on to by signal curries
+            self._func = self._args = self._kw = None
+        dprint(2, "finished", self.description)
+        self.finished.emit(result)
@@ -37,7 +37,7 @@ from TigGUI import AboutDialog
 from TigGUI import Images
 from TigGUI import Widgets
 from TigGUI.Images.ControlDialog import ImageControlDialog
-from TigGUI.Images.Manager import ImageManager
+from TigGUI.Images.Manager import ImageManager, CacheUsageIndicator
 from TigGUI.Plot.SkyModelPlot import SkyModelPlotter, PersistentCurrier, LiveImageZoom
 from TigGUI.SkyModelTreeWidget import SkyModelTreeWidget, ModelGroupsTable
 from TigGUI.init import pixmaps, Config
@@ -132,6 +132,7 @@ class MainWindow(QMainWindow):
 
         # enable status line
         self.statusBar().show()
+        self.statusBar().addPermanentWidget(CacheUsageIndicator(self))
         # Create and populate main menu
         menubar = self.menuBar()
         # File menu
@@ -236,16 +237,12 @@ class MainWindow(QMainWindow):
             dprint(1, "drag-enter rejected")
 
     def dropEvent(self, event):
-        busy = None
         filenames = self._getFilenamesFromDropEvent(event)
         dprint(1, "dropping", filenames)
         if filenames:
             event.acceptProposedAction()
-            busy = BusyIndicator()
-            for name in filenames:
-                self.imgman.loadImage(name)
-        if busy is not None:
-            busy.reset_cursor()
+            # images are read in parallel in the background, and attached as they become ready
+            self.imgman.loadImages(filenames)
 
     def saveSizes(self):
         if self._current_layout is not None:
@@ -457,6 +454,9 @@ class MainWindow(QMainWindow):
     def loadImage(self, filename):
         return self.imgman.loadImage(filename)
 
+    def loadImages(self, filenames):
+        self.imgman.loadImages(filenames)
+
     def setModel(self, model):
         if model is not None:
             self.modelChanged.emit(model)
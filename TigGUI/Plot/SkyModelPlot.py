@@ -19,6 +19,7 @@
 # 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 #
 
+import collections
 import math
 import re
 import time
@@ -541,7 +542,7 @@ class LiveImageZoom(ToolDialog):
             if self._showcs.isChecked():
                 if iy >= 0 and iy < ny and ix1 > ix0:
                     # added fix for masked arrays and mosaic images
-                    xcs = [float(x) for x in numpy.ma.filled(image.image()[ix0:ix1, iy], fill_value=0.0)]
+                    xcs = [float(x) for x in numpy.nan_to_num(numpy.ma.filled(image.image()[ix0:ix1, iy], fill_value=0.0))]
                     self._xcs.setData(numpy.arange(ix0 - 1, ix1) + .5, [xcs[0]] + xcs)
                     self._xcs.setVisible(True)
                     self._zoomplot.setAxisAutoScale(QwtPlot.yRight)
@@ -551,7 +552,7 @@ class LiveImageZoom(ToolDialog):
                     self._zoomplot.setAxisScale(QwtPlot.yRight, 0, 1)
                 if ix >= 0 and ix < nx and iy1 > iy0:
                     # added fix for masked arrays and mosaic images
-                    ycs = [float(y) for y in numpy.ma.filled(image.image()[ix, iy0:iy1], fill_value=0.0)]
+                    ycs = [float(y) for y in numpy.nan_to_num(numpy.ma.filled(image.image()[ix, iy0:iy1], fill_value=0.0))]
                     self._ycs.setData([ycs[0]] + ycs, numpy.arange(iy0 - 1, iy1) + .5)
                     self._ycs.setVisible(True)
                     self._zoomplot.setAxisAutoScale(QwtPlot.xTop)
@@ -702,7 +703,7 @@ class LiveProfile(ToolDialog):
                 i1 = i0 + rect.height()
                 self._profplot.setAxisScale(QwtPlot.xBottom, xval[i0], xval[i1 - 1])
             # added fix for masked arrays and mosaic images
-            yval = numpy.ma.filled(yval[i0:i1], fill_value=0.0)
+            yval = numpy.nan_to_num(numpy.ma.filled(yval[i0:i1], fill_value=0.0))
             xval = numpy.ma.filled(xval[i0:i1], fill_value=0.0)
             self._profcurve.setData(xval, yval)
         self._profcurve.setVisible(inrange)
@@ -736,6 +737,10 @@ class SkyModelPlotter(QWidget):
         updateLayoutEvent = pyqtSignal()
         updateCurrentPlot = pyqtSignal()
 
+        # max number of canvas pixmaps kept in the draw cache (e.g. one per slice, when flipping or playing
+        # through a cube). The least recently drawn ones are dropped.
+        DrawCacheSize = 16
+
         def __init__(self, mainwin, skymodelplotter, parent):
             QwtPlot.__init__(self, parent)
             self._skymodelplotter = skymodelplotter
@@ -788,10 +793,13 @@ class SkyModelPlotter(QWidget):
                 pm = self._draw_cache.get(self._drawing_key)
                 if pm:
                     dprint(5, "drawCanvas: found pixmap in cache, drawing")
+                    self._draw_cache.move_to_end(self._drawing_key)
                 else:
                     width, height = painter.device().width(), painter.device().height()
                     dprint(5, "drawCanvas: not in cache, redrawing %dx%d pixmap" % (width, height))
                     self._draw_cache[self._drawing_key] = pm = QPixmap(width, height)
+                    while len(self._draw_cache) > self.DrawCacheSize:
+                        self._draw_cache.popitem(last=False)
                     pm.fill(self.canvasBackground().color())
                     QwtPlot.drawCanvas(self, QPainter(pm))
                 painter.drawPixmap(0, 0, pm)
@@ -824,10 +832,10 @@ class SkyModelPlotter(QWidget):
         def clearCaches(self):
             dprint(2, "clearing plot caches")
             self._coord_cache = {}
-            self._draw_cache = {}
+            self._draw_cache = collections.OrderedDict()
 
         def clearDrawCache(self):
-            self._draw_cache = {}
+            self._draw_cache = collections.OrderedDict()
 
         def updatePlot(self):
             self.replot()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2002-2022
+# The MeqTree Foundation &
+# ASTRON (Netherlands Foundation for Research in Astronomy)
+# P.O.Box 2, 7990 AA Dwingeloo, The Netherlands
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>,
+# or write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""Benchmarks image rendering (SkyImagePlotItem.draw()) of a synthetic or given FITS image onto an offscreen canvas,
+for a number of zoom levels, render precisions (see SkyImagePlotItem.renderDtype()) and render thread counts.
+All caches are cleared before each render, so the timings are those of a first render. The size of the intermediate
+caches (interpolated and quantized tiles, prefilters and pyramids) left by a render is reported as well."""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy
+
+# render offscreen unless told otherwise
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt5.Qt import QApplication, QImage, QPainter, QRect, QObject, pyqtSignal
+from PyQt5.Qwt import QwtScaleMap
+from astropy.io import fits as pyfits
+
+
+class _Signals(QObject):
+    slice = pyqtSignal(tuple)
+    repaint = pyqtSignal()
+
+
+def makeImage(nx, ny, dtype):
+    """Makes a synthetic image HDU: noise plus a few bright sources and a NaN stripe"""
+    rng = numpy.random.default_rng(1)
+    data = rng.normal(size=(1, 1, ny, nx)).astype(dtype)
+    for x, y in rng.uniform(0, 1, (20, 2)):
+        data[0, 0, int(y * (ny - 10)):int(y * (ny - 10)) + 10, int(x * (nx - 10)):int(x * (nx - 10)) + 10] += 100
+    data[0, 0, :ny // 100, :] = numpy.nan
+    header = pyfits.Header()
+    for i, (ctype, n, cdelt, crval) in enumerate([("RA---SIN", nx, -1e-4, 10.), ("DEC--SIN", ny, 1e-4, -30.),
+                                                  ("FREQ", 1, 1e6, 1.4e9), ("STOKES", 1, 1, 1)]):
+        header["CTYPE%d" % (i + 1)] = ctype
+        header["CRPIX%d" % (i + 1)] = n // 2 + 1
+        header["CDELT%d" % (i + 1)] = cdelt
+        header["CRVAL%d" % (i + 1)] = crval
+    return pyfits.PrimaryHDU(data, header)
+
+
+def render(item, width, height, zoom):
+    """Renders the central part of the image at the given zoom level (screen pixels per image pixel).
+    Returns the time taken."""
+    (l0, l1), (m0, m1) = item.getExtents()
+    lc, mc = (l0 + l1) / 2, (m0 + m1) / 2
+    dl, dm = abs(l1 - l0) / item.imageDims()[0], abs(m1 - m0) / item.imageDims()[1]
+    hl, hm = width * dl / zoom / 2, height * dm / zoom / 2
+    xmap = QwtScaleMap()
+    xmap.setPaintInterval(0, width)
+    xmap.setScaleInterval(lc + hl, lc - hl)
+    ymap = QwtScaleMap()
+    ymap.setPaintInterval(height, 0)
+    ymap.setScaleInterval(mc - hm, mc + hm)
+    canvas = QImage(width, height, QImage.Format_ARGB32)
+    canvas.fill(0)
+    painter = QPainter(canvas)
+    item.clearDisplayCache()
+    t0 = time.time()
+    item.draw(painter, xmap, ymap, QRect(0, 0, width, height))
+    dt = time.time() - t0
+    painter.end()
+    return dt
+
+
+def cacheUsage():
+    """Returns the size of the intermediate render caches, in bytes"""
+    from TigGUI.Images.RenderCache import getCacheManager
+    usage = getCacheManager().usageByTier()
+    return sum([usage.get(tier, 0) for tier in ("interpolated tiles", "quantized tiles", "prefilters", "pyramids")])
+
+
+def main():
+    ncpu = os.cpu_count() or 1
+    default_threads = sorted(set([1] + [2 ** i for i in range(1, 8) if 2 ** i <= ncpu] + [ncpu]))
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("fits", nargs="?", help="FITS image to render (default is a synthetic image)")
+    parser.add_argument("--size", type=int, default=8192, help="size of synthetic image (default %(default)s)")
+    parser.add_argument("--dtype", default="float32", help="data type of synthetic image (default %(default)s)")
+    parser.add_argument("--canvas", default="3840x2160", help="canvas size, WxH (default %(default)s)")
+    parser.add_argument("--zoom", type=float, nargs="+", default=[4, 1, .25],
+                        help="zoom levels, in screen pixels per image pixel (default %(default)s)")
+    parser.add_argument("--precision", nargs="+", default=["double", "single"], choices=["single", "double"],
+                        help="render precisions (default %(default)s)")
+    parser.add_argument("--threads", type=int, nargs="+", default=default_threads,
+                        help="render thread counts (default %(default)s)")
+    parser.add_argument("--repeat", type=int, default=3, help="renders per measurement, best is reported "
+                                                                  "(default %(default)s)")
+    options = parser.parse_args()
+
+    app = QApplication(sys.argv)
+    # imported here, since it needs a QApplication
+    from TigGUI.Images.SkyImage import FITSImagePlotItem
+
+    width, height = map(int, options.canvas.lower().split("x"))
+    if options.fits:
+        item = FITSImagePlotItem(options.fits, lazy=False)
+    else:
+        item = FITSImagePlotItem(name="synthetic", hdu=makeImage(options.size, options.size, options.dtype))
+    signals = _Signals()
+    item.connectSlice(signals.slice)
+    item.connectRepaint(signals.repaint)
+    print("image %s, %dx%d, canvas %dx%d, %d CPUs" % (options.fits or "synthetic", item.imageDims()[0],
+                                                       item.imageDims()[1], width, height, ncpu))
+    print("%8s %10s %8s %10s %8s %11s" % ("zoom", "precision", "threads", "time (s)", "speedup", "cache (MB)"))
+    for zoom in options.zoom:
+        t1 = None
+        for precision in options.precision:
+            item.setRenderPrecision(precision)
+            for nthreads in options.threads:
+                item.setRenderThreads(nthreads)
+                dt = min([render(item, width, height, zoom) for _ in range(options.repeat)])
+                t1 = t1 or dt
+                print("%8g %10s %8d %10.3f %8.2f %11.1f" % (zoom, precision, nthreads, dt, t1 / dt,
+                                                             cacheUsage() / 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
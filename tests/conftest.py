@@ -0,0 +1,163 @@
+# Copyright (C) 2002-2022
+# The MeqTree Foundation &
+# ASTRON (Netherlands Foundation for Research in Astronomy)
+# P.O.Box 2, 7990 AA Dwingeloo, The Netherlands
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>,
+# or write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""Fixtures for tests that load FITS images into image items"""
+
+import os
+import threading
+import time
+
+import numpy
+import pytest
+
+
+@pytest.fixture(scope="session")
+def qapp():
+    """The QApplication, needed for signals, timers and busy cursors"""
+    from PyQt5.Qt import QApplication
+    # tests do not need a display
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    return QApplication.instance() or QApplication([])
+
+
+@pytest.fixture
+def wait_for(qapp):
+    """Returns a function that processes Qt events (such as signals from worker threads) until condition() is
+    true, failing after timeout seconds"""
+
+    def waitFor(condition, timeout=10):
+        t0 = time.time()
+        while not condition():
+            assert time.time() - t0 < timeout, "timed out"
+            qapp.processEvents()
+            time.sleep(.01)
+
+    return waitFor
+
+
+@pytest.fixture
+def fits_cube(tmp_path, monkeypatch):
+    """Returns a function that writes a FITS cube (RA, DEC, FREQ, STOKES axes) with the given [nfreq, ny, nx] data,
+    and returns its filename. Any keyword arguments are added to the header. Statistics caches of the cubes
+    are kept in a temporary directory."""
+    from astropy.io import fits
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+
+    def writeCube(data, name="cube.fits", **header):
+        nf, ny, nx = data.shape
+        hdr = fits.Header()
+        for i, (ctype, n, crval, cdelt) in enumerate([("RA---SIN", nx, 10., -1e-3), ("DEC--SIN", ny, -30., 1e-3),
+                                                      ("FREQ", nf, 1.4e9, 1e6), ("STOKES", 1, 1, 1)]):
+            hdr["CTYPE%d" % (i + 1)] = ctype
+            hdr["CRPIX%d" % (i + 1)] = n // 2 + 1 if i < 2 else 1
+            hdr["CRVAL%d" % (i + 1)] = crval
+            hdr["CDELT%d" % (i + 1)] = cdelt
+        hdr.update(header)
+        filename = str(tmp_path / name)
+        fits.writeto(filename, data[numpy.newaxis], hdr, overwrite=True)
+        return filename
+
+    return writeCube
+
+
+@pytest.fixture
+def load_image(qapp):
+    """Returns a function that loads a FITSImagePlotItem from a file, with its signals connected"""
+    from PyQt5.Qt import QObject
+    from PyQt5.QtCore import pyqtSignal
+    from TigGUI.Images.SkyImage import FITSImagePlotItem
+
+    class Signals(QObject):
+        slice = pyqtSignal(tuple)
+        repaint = pyqtSignal()
+
+    def loadImage(filename, **kw):
+        item = FITSImagePlotItem(filename, **kw)
+        item._test_signals = signals = Signals()
+        item.connectSlice(signals.slice)
+        item.connectRepaint(signals.repaint)
+        return item
+
+    return loadImage
+
+
+@pytest.fixture
+def render_control(tmp_path, monkeypatch):
+    """Returns a function that makes a RenderControl for an image item, keeping per-image settings in a
+    temporary directory"""
+    from TigGUI.Images import RenderControl
+    from TigGUI.kitties.config import DualConfigParser
+    monkeypatch.setattr(RenderControl, "ImageConfigFile",
+                        DualConfigParser("tigger.images.conf", system_paths=[], user_path=str(tmp_path)))
+    return lambda image: RenderControl.RenderControl(image, None)
+
+
+@pytest.fixture
+def draw_view():
+    """Returns a function that draws an image item into a width x height view, zoomed in by the given factor, and
+    with its centre panned by the given number of view pixels. Returns the [height, width] array of ARGB32 pixels."""
+    from PyQt5.Qt import QImage, QPainter, QRect
+    from PyQt5.Qwt import QwtScaleMap
+
+    def drawView(item, width, height, zoom=1, pan=(0, 0), use_cache=True):
+        (l0, l1), (m0, m1) = item.getExtents()
+        # view pixel size, which is the image pixel size over the zoom factor
+        dl, dm = (l1 - l0) / item.imageDims()[0] / zoom, (m1 - m0) / item.imageDims()[1] / zoom
+        lc, mc = (l0 + l1) / 2 - pan[0] * dl, (m0 + m1) / 2 + pan[1] * dm
+        xmap = QwtScaleMap()
+        xmap.setPaintInterval(0, width)
+        xmap.setScaleInterval(lc + width * dl / 2, lc - width * dl / 2)
+        ymap = QwtScaleMap()
+        ymap.setPaintInterval(height, 0)
+        ymap.setScaleInterval(mc - height * dm / 2, mc + height * dm / 2)
+        qimg = QImage(width, height, QImage.Format_ARGB32)
+        qimg.fill(0)
+        painter = QPainter(qimg)
+        item.draw(painter, xmap, ymap, QRect(0, 0, width, height), use_cache=use_cache)
+        painter.end()
+        ptr = qimg.constBits()
+        ptr.setsize(width * height * 4)
+        return numpy.frombuffer(ptr, numpy.uint32).reshape(height, width).copy()
+
+    return drawView
+
+
+@pytest.fixture
+def count_renders(monkeypatch):
+    """Returns a function that starts counting the tiles an image item renders in the calling thread (i.e. not
+    tiles rendered ahead in the background). The item is switched to rendering on the calling thread for this.
+    Returns the list of (i, j) indices of rendered tiles."""
+
+    def countRenders(item):
+        item.setRenderThreads(1)
+        rendered = []
+        thread = threading.current_thread()
+        renderTile = item._renderTile
+
+        def countingRenderTile(i, j, *args, **kw):
+            if threading.current_thread() is thread:
+                rendered.append((i, j))
+            return renderTile(i, j, *args, **kw)
+
+        monkeypatch.setattr(item, "_renderTile", countingRenderTile)
+        return rendered
+
+    return countRenders
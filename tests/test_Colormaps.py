@@ -0,0 +1,93 @@
+# Copyright (C) 2002-2022
+# The MeqTree Foundation &
+# ASTRON (Netherlands Foundation for Research in Astronomy)
+# P.O.Box 2, 7990 AA Dwingeloo, The Netherlands
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>,
+# or write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""Tests for TigGUI.Images.Colormaps"""
+
+import numpy
+import pytest
+
+pytest.importorskip("PyQt5.Qwt")
+
+from TigGUI.Images.Colormaps import CubeHelixColormap, GreyscaleColormap, HistEqIntensityMap, \
+    LinearIntensityMap, LogIntensityMap, TransparentFuchsiaColormap
+
+
+def test_linearity():
+    assert LinearIntensityMap.linear
+    assert not LogIntensityMap.linear and not HistEqIntensityMap.linear
+
+
+def test_frozen_histeq_map_is_not_modified_by_remap():
+    data = numpy.random.default_rng(1).normal(size=1000)
+    imap = HistEqIntensityMap()
+    imap.setDataSubset(data)
+    imap.setDataRange(-3, 3)
+    frozen = imap.copy().freeze()
+    cdf, bins = frozen._cdf, frozen._bins
+    assert bins is not None
+    values = frozen.remap(numpy.linspace(-3, 3, 7))
+    assert frozen._cdf is cdf and frozen._bins is bins
+    assert numpy.all(numpy.diff(values) > 0) and values[0] == 0 and values[-1] == 1
+    # changes to the original map leave the frozen copy alone
+    imap.setDataSubset(data + 2)
+    imap.remap(data)
+    assert numpy.array_equal(frozen.remap(numpy.linspace(-3, 3, 7)), values)
+
+
+@pytest.mark.parametrize("cmap", [GreyscaleColormap, TransparentFuchsiaColormap, CubeHelixColormap()],
+                         ids=lambda cmap: cmap.name)
+def test_lookup_matches_colormap(cmap):
+    # at the lookup table sample points, the lookup is exact
+    values = numpy.arange(cmap.LUTSize) / (cmap.LUTSize - 1.0)
+    assert numpy.array_equal(cmap.lookup(values[::-1]), cmap.makeLUT(values[::-1]))
+    # elsewhere, it picks the nearest sample point
+    values = numpy.random.default_rng(1).uniform(size=1000)
+    nearest = numpy.round(values * (cmap.LUTSize - 1)) / (cmap.LUTSize - 1.0)
+    assert numpy.array_equal(cmap.lookup(values), cmap.makeLUT(nearest))
+    # out-of-range values and NaNs are clipped
+    assert numpy.array_equal(cmap.lookup(numpy.array([-1, 2, numpy.nan])), cmap.makeLUT(numpy.array([0., 1, 0])))
+
+
+def test_lut_rebuilt_when_parameters_change():
+    cmap = CubeHelixColormap()
+    lut = cmap.lut()
+    assert cmap.lut() is lut
+    cmap.gamma.setValue(2, notify=False)
+    assert not numpy.array_equal(cmap.lut(), lut)
+    assert numpy.array_equal(cmap.lut(), cmap.makeLUT(numpy.arange(cmap.LUTSize) / (cmap.LUTSize - 1.0)))
+
+
+def test_colorize(qapp):
+    # [nx,ny] data, as images are stored
+    data = numpy.ma.masked_array(numpy.random.default_rng(1).uniform(size=(30, 20)))
+    data[3, 5] = numpy.ma.masked
+    qimg = GreyscaleColormap.colorize(data)
+    assert (qimg.width(), qimg.height()) == (30, 20)
+    # the QImage uses the memory of the lookup result, rather than a copy of it
+    assert numpy.shares_memory(numpy.frombuffer(qimg.constBits().asarray(30 * 20 * 4), numpy.uint32), qimg._buffer)
+    argb = GreyscaleColormap.lookup(data.T)
+    argb[5, 3] = 0
+    assert numpy.array_equal(qimg._buffer, argb)
+    assert qimg.pixel(3, 5) == 0 and qimg.pixel(4, 5) == argb[5, 4] and qimg.pixel(7, 2) == argb[2, 7]
+    # alpha replaces the alpha channel of the colormap
+    qimg = GreyscaleColormap.colorize(data, alpha=numpy.full(data.shape, .5))
+    assert qimg.pixel(3, 5) == 0 and qimg.pixel(4, 5) >> 24 == 128
+    assert qimg.pixel(4, 5) & 0xFFFFFF == argb[5, 4] & 0xFFFFFF
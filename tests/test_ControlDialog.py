@@ -0,0 +1,107 @@
+# Copyright (C) 2002-2022
+# The MeqTree Foundation &
+# ASTRON (Netherlands Foundation for Research in Astronomy)
+# P.O.Box 2, 7990 AA Dwingeloo, The Netherlands
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>,
+# or write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""Tests for TigGUI.Images.ControlDialog"""
+
+import numpy
+import pytest
+
+pytest.importorskip("PyQt5.Qwt")
+
+from PyQt5.QtCore import Qt
+
+from TigGUI.Images import Statistics
+from TigGUI.Images.ControlDialog import _subsetSketchJob, _subsetStatsJob
+from TigGUI.Images.Statistics import HistogramCache
+from TigGUI.Images.Workers import BackgroundJob
+
+
+def _cube(nf=3, ny=150, nx=200):
+    data = numpy.random.default_rng(1).normal(size=(nf, ny, nx)).astype(numpy.float32)
+    data[:, 50:60, 70:90] += 50
+    data[1, :10, :] = numpy.nan
+    return data
+
+
+def _runJob(job, wait_for):
+    """Runs a job, returning the list of (signal name, args) tuples it has emitted"""
+    events = []
+    job.progress.connect(lambda fraction, message: events.append(("progress", fraction, message)))
+    job.finished.connect(lambda result: events.append(("finished", result)))
+    job.failed.connect(lambda message: events.append(("failed", message)))
+    job.cancelled.connect(lambda: events.append(("cancelled",)))
+    job.start()
+    wait_for(lambda: events and events[-1][0] in ("finished", "failed", "cancelled"))
+    return events
+
+
+def test_subset_stats_job(fits_cube, load_image, render_control, wait_for, monkeypatch):
+    monkeypatch.setattr(Statistics, "ChunkSize", 4096)
+    data = _cube()
+    item = load_image(fits_cube(data))
+    rc = render_control(item)
+    rc.incrementSlice(0, 1)
+    subset, (dmin, dmax), desc, subset_type = rc.currentSubset()
+    events = _runJob(BackgroundJob(_subsetStatsJob, item, subset, dmin, dmax, None, True), wait_for)
+    assert events[-1][0] == "finished"
+    # progress goes from histogram to statistics
+    progress = [event[1:] for event in events[:-1]]
+    assert progress[0][1] == "computing histogram" and progress[-1][1] == "computing statistics"
+    assert numpy.all(numpy.diff([fraction for fraction, message in progress]) >= 0) and progress[-1][0] == 1
+    hist_cache, stats = events[-1][1]
+    plane = data[1][numpy.isfinite(data[1])]
+    # (values right at bin edges may be binned differently by numpy)
+    reference = numpy.histogram(plane, HistogramCache.NumBins, (dmin, dmax))[0]
+    assert hist_cache.fullHistogram().sum() == plane.size
+    assert numpy.abs(hist_cache.fullHistogram() - reference).sum() <= 10
+    assert numpy.isclose(stats.mean, plane.mean(), rtol=1e-4) and numpy.isclose(stats.std, plane.std(), rtol=1e-4)
+    assert abs(stats.sketch.quantile(.5) - numpy.median(plane)) < .01
+    # with a full-range histogram supplied (from the stats cache), and stats not wanted, nothing else is computed
+    monkeypatch.setattr(Statistics, "computeHistogram", None)
+    hist = hist_cache.fullHistogram()
+    events = _runJob(BackgroundJob(_subsetStatsJob, item, subset, dmin, dmax, hist, False), wait_for)
+    assert [event[0] for event in events] == ["finished"]
+    hist_cache, stats = events[-1][1]
+    assert stats is None and numpy.array_equal(hist_cache.fullHistogram(), hist)
+
+
+def test_subset_sketch_job(fits_cube, load_image, render_control, wait_for):
+    data = _cube()
+    item = load_image(fits_cube(data))
+    rc = render_control(item)
+    subset = rc.currentSubset()[0]
+    events = _runJob(BackgroundJob(_subsetSketchJob, item, subset), wait_for)
+    assert events[-2][1:] == (1, "computing percentiles")
+    stats = events[-1][1]
+    assert numpy.isclose(stats.mean, data[0].mean(), rtol=1e-4)
+    assert abs(stats.sketch.quantile(.9) - numpy.quantile(data[0], .9)) < .01
+
+
+def test_subset_stats_job_cancelled(fits_cube, load_image, render_control, wait_for, monkeypatch):
+    monkeypatch.setattr(Statistics, "ChunkSize", 4096)
+    item = load_image(fits_cube(_cube()))
+    rc = render_control(item)
+    subset, (dmin, dmax), desc, subset_type = rc.currentSubset()
+    job = BackgroundJob(_subsetStatsJob, item, subset, dmin, dmax, None, True)
+    # cancel as soon as the first chunk is done, from the job's own thread
+    job.progress.connect(job.cancel, Qt.DirectConnection)
+    events = _runJob(job, wait_for)
+    assert [event[0] for event in events] == ["progress", "cancelled"]
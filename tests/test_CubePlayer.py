@@ -0,0 +1,62 @@
+# Copyright (C) 2002-2022
+# The MeqTree Foundation &
+# ASTRON (Netherlands Foundation for Research in Astronomy)
+# P.O.Box 2, 7990 AA Dwingeloo, The Netherlands
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>,
+# or write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+
+"""Tests for TigGUI.Images.CubePlayer"""
+
+import concurrent.futures
+import time
+
+import numpy
+import pytest
+
+pytest.importorskip("PyQt5.Qwt")
+
+from TigGUI.Images.CubePlayer import CubePlayer
+
+
+def test_playback_frames_come_from_tile_cache(fits_cube, load_image, render_control, draw_view, count_renders,
+                                              monkeypatch):
+    data = numpy.random.default_rng(1).normal(size=(6, 150, 200)).astype(numpy.float32)
+    item = load_image(fits_cube(data), lazy=True)
+    rc = render_control(item)
+    draw_view(item, 300, 200, zoom=1.5)
+    rendered = count_renders(item)
+    player = CubePlayer()
+    shown = []
+    player.frameShown.connect(shown.append)
+    player.start(rc, 0, fps=1)
+    # drive the player by hand rather than by its timer, with its clock set to the middle of each frame period in
+    # turn, so that the frame shown does not depend on how long rendering takes
+    player._timer.stop()
+    try:
+        player._tick()
+        for frame in range(1, 4):
+            concurrent.futures.wait(list(player._futures.values()))
+            monkeypatch.setattr(player, "_t0", time.time() - (frame + .5) / player.frameRate())
+            player._tick()
+            assert shown[-1] == frame == rc.currentSlice()[0]
+            argb = draw_view(item, 300, 200, zoom=1.5)
+            assert rendered == []
+            assert numpy.array_equal(argb, draw_view(item, 300, 200, zoom=1.5, use_cache=False))
+            rendered.clear()
+    finally:
+        player.stop()
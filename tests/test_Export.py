@@ -0,0 +1,97 @@
+# Copyright (C) 2002-2022
+# The MeqTree Foundation &
+# ASTRON (Netherlands Foundation for Research in Astronomy)
+# P.O.Box 2, 7990 AA Dwingeloo, The Netherlands
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>,
+# or write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""Tests for TigGUI.Images.Export"""
+
+import io
+
+import numpy
+import pytest
+
+pytest.importorskip("PyQt5.Qwt")
+Image = pytest.importorskip("PIL.Image")
+
+from TigGUI.Images.Export import BigTIFFWriter, PNGWriter, exportImage
+from TigGUI.Images.SkyImage import SkyImagePlotItem
+
+
+def _argb(height, width, seed=1):
+    """Makes a [height, width] array of random ARGB32 pixels, with a transparent corner as in exported images"""
+    argb = numpy.random.default_rng(seed).integers(0, 2 ** 32, (height, width), dtype=numpy.uint32)
+    argb[:3, :3] = 0
+    return argb
+
+
+def _write(writer_class, argb, nrows):
+    file = io.BytesIO()
+    writer = writer_class(file, argb.shape[1], argb.shape[0])
+    for y in range(0, argb.shape[0], nrows):
+        writer.writeRows(argb[y:y + nrows])
+    writer.finish()
+    file.seek(0)
+    return file
+
+
+def _readRGBA(file):
+    image = Image.open(file)
+    image.load()
+    assert image.mode == "RGBA"
+    return numpy.asarray(image)
+
+
+def _toRGBA(argb):
+    return numpy.stack([(argb >> shift) & 255 for shift in (16, 8, 0, 24)], axis=-1).astype(numpy.uint8)
+
+
+@pytest.mark.parametrize("nrows", [1, 7, 100])
+def test_png_round_trip(nrows):
+    argb = _argb(37, 23)
+    assert numpy.array_equal(_readRGBA(_write(PNGWriter, argb, nrows)), _toRGBA(argb))
+
+
+@pytest.mark.parametrize("nrows", [1, 7, 100])
+def test_bigtiff_round_trip(nrows, monkeypatch):
+    # strips of fewer rows than the image, and a partial last strip
+    monkeypatch.setattr(BigTIFFWriter, "RowsPerStrip", 16)
+    argb = _argb(37, 23, seed=2)
+    file = _write(BigTIFFWriter, argb, nrows)
+    assert file.getvalue()[:4] == b"II+\0"
+    assert numpy.array_equal(_readRGBA(file), _toRGBA(argb))
+
+
+def test_export_image(tmp_path):
+    image = numpy.random.default_rng(3).normal(size=(40, 30))
+    image[:5, :5] = numpy.nan
+    item = SkyImagePlotItem()
+    item.setImage(image, minmax=(numpy.nanmin(image), numpy.nanmax(image)))
+    item.setImageCoordinates(40, 30, 20, 15, 0, 0, -1e-3, 1e-3)
+    fractions = []
+    exported = []
+    for name in "image.png", "image.tif":
+        exportImage(item, str(tmp_path / name), scale=2, progress=fractions.append)
+        exported.append(_readRGBA(str(tmp_path / name)))
+    assert exported[0].shape == (60, 80, 4)
+    assert numpy.array_equal(exported[0], exported[1])
+    assert fractions[-1] == 1
+    # undefined pixels are transparent, the rest opaque
+    assert (exported[0][..., 3] == 0).any() and (exported[0][..., 3] == 255).any()
+    with pytest.raises(ValueError):
+        exportImage(item, str(tmp_path / "image.jpg"))
@@ -0,0 +1,148 @@
+# Copyright (C) 2002-2022
+# The MeqTree Foundation &
+# ASTRON (Netherlands Foundation for Research in Astronomy)
+# P.O.Box 2, 7990 AA Dwingeloo, The Netherlands
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>,
+# or write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""Tests for TigGUI.Images.Expressions"""
+
+import tracemalloc
+
+import numpy
+import pytest
+
+from TigGUI.Images.Expressions import ExpressionArray, evaluateElementwise, evaluateExpression, isElementwise, \
+    trimArray
+
+
+@pytest.mark.parametrize("expression,used", [
+    ("a", {"a"}),
+    ("a + b * 2", {"a", "b"}),
+    ("-a ** 2 / (b - 1.5)", {"a", "b"}),
+    ("sqrt(abs(a)) + log10(b)", {"a", "b"}),
+    ("where(a > 0, a, nan)", {"a"}),
+    ("clip(a, 0, 1) * pi", {"a"}),
+    ("(a > b) & (a < 3)", {"a", "b"}),
+    ("arctan2(b, a) + 1j", {"a", "b"}),
+    ("nan_to_num(a, nan=0.)", {"a"}),
+])
+def test_is_elementwise(expression, used):
+    assert isElementwise(expression, ["a", "b", "c"]) == (True, used)
+
+
+@pytest.mark.parametrize("expression", [
+    "a.mean()",
+    "a - a.mean()",
+    "a.T",
+    "a[0]",
+    "a[:, ::-1] + b",
+    "fft.fft2(a)",
+    "sum(a)",
+    "cumsum(a)",
+    "a @ b",
+    "where(*a)",
+    "numpy.sqrt(a)",
+    "x + a",
+    "a if b else c",
+    "[a, b]",
+    "'a'",
+    "lambda: a",
+    "1 + 2",
+    "pi",
+    "a +",
+])
+def test_is_not_elementwise(expression):
+    assert not isElementwise(expression, ["a", "b", "c"])[0]
+
+
+def _func(a, b):
+    return numpy.sqrt(abs(a)) * b - 1
+
+
+@pytest.mark.parametrize("order", ["C", "F"])
+def test_evaluate_elementwise_matches_direct(order):
+    rng = numpy.random.default_rng(1)
+    a = numpy.asarray(rng.normal(size=(7, 11, 13)), order=order)
+    b = numpy.asarray(rng.normal(size=(7, 11, 13)).astype(numpy.float32), order=order)
+    result, converted = evaluateElementwise(_func, [a, b], chunk_size=100)
+    assert not converted
+    assert result.dtype == _func(a, b).dtype
+    assert numpy.array_equal(result, _func(a, b))
+
+
+def test_evaluate_elementwise_masks_and_complex():
+    a = numpy.ma.masked_array(numpy.arange(1000.), numpy.arange(1000) % 7 == 0)
+    result, converted = evaluateElementwise(lambda a, b: a * 1j + 1, [a, None], chunk_size=64)
+    assert converted
+    expected = abs(a.data * 1j + 1)
+    assert numpy.array_equal(numpy.isnan(result), a.mask)
+    assert numpy.array_equal(result[~a.mask], expected[~a.mask])
+
+
+def test_evaluate_elementwise_declines_mismatched_arrays():
+    assert evaluateElementwise(_func, [numpy.ones((4, 5)), numpy.ones((5, 4))]) == (None, False)
+    assert evaluateElementwise(_func, [numpy.ones((4, 6))[:, ::2], numpy.ones((4, 3))]) == (None, False)
+
+
+def test_expression_array_is_lazy():
+    rng = numpy.random.default_rng(2)
+    a, b = rng.normal(size=(3, 20, 30)), rng.normal(size=(3, 20, 30))
+    array = ExpressionArray(_func, [a, b])
+    assert array.shape == a.shape and array.dtype == numpy.float64
+    assert numpy.array_equal(array[1], _func(a[1], b[1]))
+    assert not array.isMaterialized()
+    assert numpy.array_equal(numpy.asarray(array), _func(a, b))
+    assert array.isMaterialized()
+
+
+def test_evaluate_expression_trims_trailing_axes():
+    a, b = numpy.ones((4, 5, 1)), numpy.full((4, 5, 1, 1), 2.)
+    assert trimArray(b).shape == (4, 5) and trimArray(b).base is not None
+    result, converted = evaluateExpression(lambda a, b: a + b, "a + b", ["a", "b"], [a, b])
+    assert result.shape == (4, 5) and numpy.all(result == 3) and not converted
+    result, converted = evaluateExpression(lambda a, b: a - a.mean(), "a - a.mean()", ["a", "b"], [a, b])
+    assert result.shape == (4, 5) and numpy.all(result == 0)
+
+
+def _peakMemory(func):
+    tracemalloc.start()
+    try:
+        result = func()
+        return result, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+@pytest.mark.parametrize("shape", [(1024, 1024, 1), (64, 64, 256, 1)])
+def test_scaled_data_is_not_converted_as_a_whole(shape, monkeypatch):
+    ScaledData = pytest.importorskip("TigGUI.Images.SkyImage").ScaledData
+    monkeypatch.setattr("TigGUI.Images.Expressions.ChunkSize", 2 ** 12)
+    raw = numpy.asfortranarray(numpy.random.default_rng(1).integers(-1000, 1000, shape, dtype=numpy.int16))
+    data = ScaledData(raw, .5, 3.)
+    func = lambda a: a * 2 + 1
+    result, peak = _peakMemory(lambda: evaluateExpression(func, "a * 2 + 1", ["a"], [data])[0])
+    expected = (raw * numpy.float32(.5) + numpy.float32(3.)) * 2 + 1
+    # images are computed into the result array, and cubes are left as virtual arrays, so at most the result is
+    # allocated, never a scaled copy of the argument as well
+    assert result.shape == trimArray(raw).shape
+    assert peak < (data.nbytes * 1.5 if result.ndim == 2 else data.nbytes / 8)
+    if isinstance(result, ExpressionArray):
+        assert numpy.array_equal(result[:, :, 3], expected[:, :, 3, 0])
+        result, peak = _peakMemory(result.materialize)
+        assert peak < data.nbytes * 1.5
+    assert numpy.allclose(result, expected.reshape(result.shape))
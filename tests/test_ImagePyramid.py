@@ -0,0 +1,68 @@
+# Copyright (C) 2002-2022
+# The MeqTree Foundation &
+# ASTRON (Netherlands Foundation for Research in Astronomy)
+# P.O.Box 2, 7990 AA Dwingeloo, The Netherlands
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>,
+# or write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""Tests for TigGUI.Images.ImagePyramid, and its accounting in the image caches (TigGUI.Images.RenderCache)"""
+
+import numpy
+import pytest
+
+from TigGUI.Images.ImagePyramid import ImagePyramid, downsample2
+from TigGUI.Images.RenderCache import CacheManager, ManagedCache
+
+
+@pytest.mark.parametrize("shape", [(8, 6), (7, 6), (8, 5), (7, 5), (1, 1)])
+def test_downsample2_shapes(shape):
+    image = numpy.arange(numpy.prod(shape), dtype=numpy.float32).reshape(shape)
+    result = downsample2(image)
+    assert result.shape == ((shape[0] + 1) // 2, (shape[1] + 1) // 2)
+    assert result.dtype == numpy.float32
+    # the last row/column of an odd-sized image averages over the available pixels only
+    assert result[-1, -1] == image[2 * (result.shape[0] - 1):, 2 * (result.shape[1] - 1):].mean()
+
+
+def test_downsample2_skips_nans():
+    image = numpy.ones((4, 4))
+    image[:2, :2] = numpy.nan
+    image[2, 2] = 5
+    result = downsample2(image)
+    assert numpy.isnan(result[0, 0])
+    assert result[1, 1] == 2 and result[0, 1] == 1
+
+
+def test_pyramid_nbytes():
+    image = numpy.zeros((64, 64), numpy.float32)
+    pyramid = ImagePyramid(image)
+    assert pyramid.nbytes == image.nbytes
+    pyramid.level(2)
+    assert pyramid.nbytes == image.nbytes * (1 + 1 / 4 + 1 / 16)
+
+
+def test_pyramid_is_charged_to_cache_budget():
+    manager = CacheManager(2 ** 30)
+    cache = ManagedCache("pyramids", manager=manager)
+    pyramid = ImagePyramid(numpy.zeros((256, 256), numpy.float32))
+    pyramid.level(1)
+    cache.put("plane", pyramid)
+    assert manager.usageByTier()["pyramids"] == pyramid.nbytes > 0
+    # pyramids are evicted under pressure like anything else
+    manager.setBudget(pyramid.nbytes - 1)
+    cache.put("other", numpy.zeros(10))
+    assert "plane" not in cache
@@ -0,0 +1,75 @@
+# Copyright (C) 2002-2022
+# The MeqTree Foundation &
+# ASTRON (Netherlands Foundation for Research in Astronomy)
+# P.O.Box 2, 7990 AA Dwingeloo, The Netherlands
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>,
+# or write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+
+"""Tests for TigGUI.Images.Manager"""
+
+import threading
+
+import numpy
+import pytest
+
+pytest.importorskip("PyQt5.Qwt")
+
+from TigGUI.Images.Manager import _readImageJob
+from TigGUI.Images.SkyImage import FITSImagePlotItem
+from TigGUI.Images.Workers import BackgroundJob
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_background_load(fits_cube, wait_for, lazy):
+    data = numpy.random.default_rng(1).normal(size=(3, 40, 60)).astype(numpy.float32)
+    filename = fits_cube(data)
+    image = FITSImagePlotItem()
+    job = BackgroundJob(_readImageJob, image, filename, lazy)
+    progress, finished = [], []
+    job.progress.connect(lambda fraction, message: progress.append(fraction))
+    job.finished.connect(finished.append)
+    job.start()
+    wait_for(lambda: finished)
+    assert finished == [image] and image.isLazy() == lazy
+    assert progress[0] == 0 and progress[-1] == 1
+    assert numpy.array_equal(image.image(), data[0].T)
+    assert image.imageMinMax() == (data[0].min(), data[0].max())
+
+
+def test_background_load_cancelled(fits_cube, wait_for, monkeypatch):
+    filename = fits_cube(numpy.zeros((1, 40, 60), numpy.float32))
+    image = FITSImagePlotItem()
+    reading, release = threading.Event(), threading.Event()
+    read = image.read
+
+    def slowRead(*args, **kw):
+        reading.set()
+        release.wait(10)
+        return read(*args, **kw)
+
+    monkeypatch.setattr(image, "read", slowRead)
+    job = BackgroundJob(_readImageJob, image, filename, False)
+    events = []
+    job.finished.connect(lambda result: events.append("finished"))
+    job.cancelled.connect(lambda: events.append("cancelled"))
+    job.start()
+    assert reading.wait(10)
+    job.cancel()
+    release.set()
+    wait_for(lambda: events)
+    assert events == ["cancelled"]
@@ -0,0 +1,116 @@
+# Copyright (C) 2002-2022
+# The MeqTree Foundation &
+# ASTRON (Netherlands Foundation for Research in Astronomy)
+# P.O.Box 2, 7990 AA Dwingeloo, The Netherlands
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>,
+# or write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""Tests for TigGUI.Images.RenderControl"""
+
+import threading
+
+import numpy
+import pytest
+
+pytest.importorskip("PyQt5.Qwt")
+
+
+def _cube(nf=4, ny=150, nx=200):
+    data = numpy.random.default_rng(1).normal(size=(nf, ny, nx)).astype(numpy.float32)
+    data[:, 50:60, 70:90] += 50
+    return data
+
+
+def test_lazy_full_range_computed_in_background(fits_cube, load_image, render_control, wait_for,
+                                                monkeypatch):
+    data = _cube()
+    item = load_image(fits_cube(data), lazy=True)
+    rc = render_control(item)
+    assert rc.currentSubset()[3] == rc.SUBSET_SLICE
+    # the full-cube min/max is not worked out on the GUI thread
+    main_thread = threading.current_thread()
+    dataMinMax = item.dataMinMax
+
+    def backgroundDataMinMax(*args, **kw):
+        assert threading.current_thread() is not main_thread
+        return dataMinMax(*args, **kw)
+
+    monkeypatch.setattr(item, "dataMinMax", backgroundDataMinMax)
+    rc.setFullSubset()
+    assert rc.isComputingFullRange() and rc.currentSubset()[3] == rc.SUBSET_SLICE
+    wait_for(lambda: not rc.isComputingFullRange())
+    subset, minmax, desc, subset_type = rc.currentSubset()
+    assert subset_type == rc.SUBSET_FULL and desc == "full cube"
+    assert minmax == rc.displayRange() == (data.min(), data.max())
+
+
+def test_lazy_full_range_superseded(fits_cube, load_image, render_control, wait_for):
+    item = load_image(fits_cube(_cube()), lazy=True)
+    rc = render_control(item)
+    rc.setFullSubset()
+    # selecting another subset while the full range is being computed cancels the full subset
+    rc.setSliceSubset()
+    assert not rc.isComputingFullRange()
+    wait_for(lambda: rc._fullrange_job is None)
+    assert rc.currentSubset()[3] == rc.SUBSET_SLICE
+
+
+def test_lazy_full_range_from_stats_cache(fits_cube, load_image, render_control, monkeypatch):
+    data = _cube()
+    filename = fits_cube(data)
+    # the first load of the cube fills in the statistics cache
+    load_image(filename, lazy=True).dataMinMax()
+    item = load_image(filename, lazy=True)
+    monkeypatch.setattr(item, "_planewiseMinMax", lambda *args: pytest.fail("full range recomputed"))
+    rc = render_control(item)
+    rc.setFullSubset()
+    assert not rc.isComputingFullRange()
+    subset, minmax, desc, subset_type = rc.currentSubset()
+    assert subset_type == rc.SUBSET_FULL and minmax == (data.min(), data.max())
+
+
+def test_prefetched_slice_draws_from_tile_cache(fits_cube, load_image, render_control, draw_view, count_renders):
+    item = load_image(fits_cube(_cube()), lazy=True)
+    rc = render_control(item)
+    rc.setPrefetchEnabled(False)
+    draw_view(item, 300, 200, zoom=1.5)
+    # render the next plane ahead, as the slice prefetcher does
+    assert item.prerenderPlane(item.plane((1, 0))) == item.lastViewNumTiles() > 1
+    rendered = count_renders(item)
+    rc.incrementSlice(0, 1)
+    assert item.currentSlice()[2] == 1
+    argb = draw_view(item, 300, 200, zoom=1.5)
+    assert rendered == []
+    # the prefetched tiles are the same as freshly rendered ones
+    assert numpy.array_equal(argb, draw_view(item, 300, 200, zoom=1.5, use_cache=False))
+
+
+def test_display_range_change_invalidates_tiles(fits_cube, load_image, render_control, draw_view, count_renders):
+    item = load_image(fits_cube(_cube()), lazy=True)
+    rc = render_control(item)
+    rc.setPrefetchEnabled(False)
+    argb = draw_view(item, 300, 200)
+    rendered = count_renders(item)
+    # an unchanged display range leaves the tiles alone
+    rc.setDisplayRange(*rc.displayRange())
+    draw_view(item, 300, 200)
+    assert rendered == []
+    lo, hi = rc.displayRange()
+    rc.setDisplayRange(lo, (lo + hi) / 2)
+    argb1 = draw_view(item, 300, 200)
+    assert len(rendered) == item.lastViewNumTiles()
+    assert not numpy.array_equal(argb, argb1)
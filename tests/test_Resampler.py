@@ -0,0 +1,59 @@
+# Copyright (C) 2002-2022
+# The MeqTree Foundation &
+# ASTRON (Netherlands Foundation for Research in Astronomy)
+# P.O.Box 2, 7990 AA Dwingeloo, The Netherlands
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>,
+# or write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""Tests for TigGUI.Images.Resampler"""
+
+import numpy
+import pytest
+from scipy import ndimage
+
+from TigGUI.Images.Resampler import resample, zeroNonFinite
+
+
+def _grid(coords0, coords1):
+    return numpy.array(numpy.meshgrid(coords0, coords1, indexing='ij'))
+
+
+@pytest.mark.parametrize("order", [0, 1, 2, 3])
+def test_resample_matches_map_coordinates(order):
+    rng = numpy.random.default_rng(order)
+    image = rng.normal(size=(40, 30))
+    # (nearest-neighbour rounding of exact half-pixels differs, so avoid those)
+    coords0 = numpy.linspace(0, 39, 57) + .013
+    coords1 = numpy.linspace(0, 29, 23) + .007
+    coords0[-1], coords1[-1] = 39, 29
+    result = resample(image, coords0, coords1, order=order, dtype=numpy.float64)
+    # orders 2 and 3 interpolate spline coefficients, i.e. the image is prefiltered separately
+    expected = ndimage.map_coordinates(image, _grid(coords0, coords1), order=order, mode='mirror', prefilter=False)
+    assert numpy.allclose(result, expected)
+
+
+def test_resample_outside_image_is_nan():
+    image = numpy.ones((10, 10), numpy.float32)
+    result = resample(image, numpy.array([-1., 0., 5., 9.5]), numpy.array([2., 10.]), order=1)
+    assert result.dtype == numpy.float32
+    assert numpy.isnan(result[[0, 3]]).all() and numpy.isnan(result[:, 1]).all()
+    assert (result[1:3, 0] == 1).all()
+
+
+def test_zero_non_finite():
+    data = numpy.ma.masked_array([1., numpy.nan, numpy.inf, 4.], [False, False, False, True])
+    assert zeroNonFinite(data).tolist() == [1., 0., 0., 0.]
@@ -0,0 +1,346 @@
+# Copyright (C) 2002-2022
+# The MeqTree Foundation &
+# ASTRON (Netherlands Foundation for Research in Astronomy)
+# P.O.Box 2, 7990 AA Dwingeloo, The Netherlands
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>,
+# or write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""Tests for TigGUI.Images.SkyImage"""
+
+import mmap
+import threading
+import tracemalloc
+
+import numpy
+import pytest
+
+pytest.importorskip("PyQt5.Qwt")
+
+from TigGUI.Images import Colormaps
+from TigGUI.Images.ImagePyramid import ImagePyramid
+from TigGUI.Images.SkyImage import ScaledData, SkyImagePlotItem
+from TigGUI.Images.Statistics import computeStats
+
+
+def _isMemoryMapped(array):
+    while array is not None:
+        if isinstance(array, (numpy.memmap, mmap.mmap)):
+            return True
+        array = getattr(array, "base", None)
+    return False
+
+
+def test_lazy_load_matches_eager_load(fits_cube, load_image):
+    data = numpy.random.default_rng(1).normal(size=(3, 40, 60)).astype(numpy.float32)
+    filename = fits_cube(data)
+    lazy, eager = load_image(filename, lazy=True), load_image(filename, lazy=False)
+    assert lazy.isLazy() and not eager.isLazy()
+    # the lazily-loaded cube stays on disk, and is paged in a plane at a time
+    assert _isMemoryMapped(lazy.data())
+    for freq in range(3):
+        lazy.selectSlice(freq, 0)
+        eager.selectSlice(freq, 0)
+        assert numpy.array_equal(lazy.image(), data[freq].T)
+        assert numpy.array_equal(eager.image(), data[freq].T)
+        assert lazy.imageMinMax() == eager.imageMinMax() == (data[freq].min(), data[freq].max())
+    assert lazy.dataMinMax()[:2] == eager.dataMinMax()[:2] == (data.min(), data.max())
+
+
+def test_tiles_are_reused_after_panning(fits_cube, load_image, draw_view, count_renders):
+    data = numpy.random.default_rng(1).normal(size=(1, 500, 700)).astype(numpy.float32)
+    item = load_image(fits_cube(data))
+    rendered = count_renders(item)
+    draw_view(item, 600, 400)
+    tiles0 = set(rendered)
+    # panning by whole pixels only renders the newly exposed tiles
+    for pan in (300, 0), (300, 200), (-50, -170):
+        rendered.clear()
+        argb = draw_view(item, 600, 400, pan=pan)
+        new_tiles = set(rendered)
+        # (drawing without the cache renders all tiles of the view)
+        rendered.clear()
+        assert numpy.array_equal(argb, draw_view(item, 600, 400, pan=pan, use_cache=False))
+        tiles = set(rendered)
+        assert new_tiles == tiles - tiles0
+        tiles0 |= tiles
+    # panning back renders nothing
+    rendered.clear()
+    draw_view(item, 600, 400)
+    assert rendered == []
+
+
+def test_tiles_are_keyed_by_zoom(fits_cube, load_image, draw_view, count_renders):
+    data = numpy.random.default_rng(1).normal(size=(1, 300, 400)).astype(numpy.float32)
+    item = load_image(fits_cube(data))
+    draw_view(item, 400, 300)
+    rendered = count_renders(item)
+    argb = draw_view(item, 400, 300, zoom=2)
+    tiles = list(rendered)
+    rendered.clear()
+    assert numpy.array_equal(argb, draw_view(item, 400, 300, zoom=2, use_cache=False))
+    assert tiles == rendered
+    rendered.clear()
+    draw_view(item, 400, 300)
+    draw_view(item, 400, 300, zoom=2)
+    assert rendered == []
+
+
+def test_prefilter_only_covers_view(fits_cube, load_image, draw_view, monkeypatch):
+    data = numpy.random.default_rng(1).normal(size=(1, 1024, 1024)).astype(numpy.float32)
+    filename = fits_cube(data)
+    item = load_image(filename)
+    # zoomed in a bit, so that the view is rendered with a spline, and samples the central ~130 pixels
+    argb = draw_view(item, 200, 200, zoom=1.5)
+    # the view straddles the corners of the four central 256-pixel blocks, out of 16
+    assert len(item._cache_prefilter) == 4
+    # prefiltering the whole plane in one block gives the same result
+    monkeypatch.setattr(SkyImagePlotItem, "PrefilterBlockSize", 1024)
+    item1 = load_image(filename)
+    assert numpy.array_equal(argb, draw_view(item1, 200, 200, zoom=1.5))
+    assert len(item1._cache_prefilter) == 1
+
+
+@pytest.mark.parametrize("zoom", [.2, 1, 1.5, 4])
+def test_parallel_render_matches_serial(fits_cube, load_image, draw_view, monkeypatch, zoom):
+    data = numpy.random.default_rng(1).normal(size=(1, 600, 800)).astype(numpy.float32)
+    filename = fits_cube(data)
+    serial, parallel = load_image(filename), load_image(filename)
+    serial.setRenderThreads(1)
+    parallel.setRenderThreads(4)
+    threads = set()
+    renderTile = parallel._renderTile
+
+    def recordingRenderTile(*args, **kw):
+        threads.add(threading.current_thread())
+        return renderTile(*args, **kw)
+
+    monkeypatch.setattr(parallel, "_renderTile", recordingRenderTile)
+    argb = draw_view(parallel, 700, 500, zoom=zoom)
+    assert numpy.array_equal(argb, draw_view(serial, 700, 500, zoom=zoom))
+    assert threads and threading.current_thread() not in threads
+
+
+def _channels(argb):
+    return numpy.stack([(argb >> shift) & 255 for shift in (0, 8, 16, 24)]).astype(int)
+
+
+@pytest.mark.parametrize("imap", [Colormaps.LinearIntensityMap(), Colormaps.LogIntensityMap(6),
+                                  Colormaps.HistEqIntensityMap()], ids=lambda imap: type(imap).__name__)
+def test_quantized_render_matches_intensity_map(imap):
+    # a high-dynamic-range image: mostly faint noise, with a few bright pixels
+    rng = numpy.random.default_rng(1)
+    image = rng.exponential(1e-4, (64, 48))
+    image[::16, ::16] = 1e3
+    item = SkyImagePlotItem()
+    item.setImage(image, minmax=(image.min(), image.max()))
+    item.setImageCoordinates(64, 48, 0, 0, 0, 0, 1, 1)
+    imap.setDataSubset(image)
+    imap.setDataRange(image.min(), image.max())
+    item.setIntensityMap(imap, emit=False)
+    render = item._getRenderParameters(1, 1)
+    argb = render[6][item._quantizeTile(image, render[5], render[9])]
+    expected = item.colorMap().lookup(imap.remap(image))
+    # quantization may shift colours by a level, but must not lump the faint values together
+    assert abs(_channels(argb) - _channels(expected)).max() <= 1
+
+
+def test_intensity_map_changes_take_effect_via_set_intensity_map():
+    image = numpy.arange(48, dtype=numpy.float32).reshape(8, 6)
+    item = SkyImagePlotItem()
+    item.setImage(image, minmax=(0, 47))
+    item.setImageCoordinates(8, 6, 0, 0, 0, 0, 1, 1)
+    imap = Colormaps.LogIntensityMap(6)
+    imap.setDataRange(0, 47)
+    item.setIntensityMap(imap, emit=False)
+    render = item._getRenderParameters(1, 1)
+    # rendering (possibly in other threads) uses a copy, which is unaffected by further changes to the map...
+    imap.log_cycles = 2
+    assert render[9] is not imap and render[9].log_cycles == 6
+    assert item._getRenderParameters(1, 1)[9].log_cycles == 6
+    # ...until the image is told about them
+    item.setIntensityMap(emit=False)
+    render2 = item._getRenderParameters(1, 1)
+    assert render2[9].log_cycles == 2 and render2[10] != render[10]
+
+
+def test_scaled_data_views():
+    raw = numpy.asfortranarray(numpy.arange(24, dtype=numpy.int16).reshape(2, 3, 4))
+    data = ScaledData(raw, -.5, 1.)
+    expected = raw * numpy.float32(-.5) + numpy.float32(1.)
+    for view, values in ((data.T, expected.T), (data.transpose(1, 0, 2), expected.transpose(1, 0, 2)),
+                         (data.reshape(6, 4, order='F'), expected.reshape(6, 4, order='F')),
+                         (data.ravel(order='F'), expected.ravel(order='F'))):
+        assert isinstance(view, ScaledData) and numpy.shares_memory(view.raw, raw)
+        assert view.shape == values.shape and numpy.array_equal(view[...], values)
+    assert numpy.array_equal(numpy.asarray(data), expected)
+
+
+def test_scaled_data_statistics_are_computed_chunkwise(monkeypatch):
+    monkeypatch.setattr("TigGUI.Images.Statistics.ChunkSize", 2 ** 12)
+    raw = numpy.asfortranarray(numpy.random.default_rng(1).integers(-1000, 1000, (64, 64, 256), dtype=numpy.int16))
+    data = ScaledData(raw, .5, 3.)
+    values = raw * .5 + 3.
+    tracemalloc.start()
+    try:
+        stats = computeStats(data.ravel(order='F'), threads=False)
+        imap = Colormaps.HistEqIntensityMap()
+        imap.setDataSubset(data)
+        imap.setDataRange(*stats.minMax())
+        imap.freeze()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    # (a scaled copy of the data would take data.nbytes, chunks in flight take much less)
+    assert peak < data.nbytes / 2
+    assert stats.minMax() == (values.min(), values.max())
+    assert numpy.isclose(stats.mean, values.mean()) and numpy.isclose(stats.std, values.std())
+    assert numpy.isclose(imap.remap(numpy.array([numpy.median(values)]))[0], .5, atol=.01)
+
+
+def _saveAndReload(item, tmp_path):
+    from astropy.io import fits
+    filename = str(tmp_path / "saved.fits")
+    item.save(filename)
+    with fits.open(filename) as hdul:
+        return hdul[0].header, hdul[0].data.copy()
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_save_round_trip(fits_cube, load_image, tmp_path, lazy):
+    data = numpy.random.default_rng(1).normal(size=(3, 40, 60)).astype(numpy.float32)
+    data[1, :5, :] = numpy.nan
+    item = load_image(fits_cube(data), lazy=lazy)
+    header, saved = _saveAndReload(item, tmp_path)
+    # planes are written in the same order, and NaNs stay NaNs
+    assert saved.shape == (1, 3, 40, 60) and header["BITPIX"] == -32
+    assert numpy.array_equal(saved[0], data, equal_nan=True)
+    assert header["CTYPE3"] == "FREQ" and header["NAXIS3"] == 3
+
+
+def test_save_masked_data(fits_cube, load_image, tmp_path):
+    data = numpy.random.default_rng(1).normal(size=(2, 40, 60)).astype(numpy.float32)
+    item = load_image(fits_cube(data))
+    # the datacube is [nx,ny,nfreq,nstokes]
+    mask = numpy.zeros(item.data().shape, bool)
+    mask[10:20, 5, 1, 0] = True
+    item.setData(numpy.ma.masked_array(item.data(), mask))
+    header, saved = _saveAndReload(item, tmp_path)
+    expected = data.copy()
+    expected[1, 5, 10:20] = numpy.nan
+    assert numpy.array_equal(saved[0], expected, equal_nan=True)
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_save_scaled_data(fits_cube, load_image, tmp_path, lazy):
+    from astropy.io import fits
+    raw = numpy.random.default_rng(1).integers(-1000, 1000, size=(3, 20, 30)).astype(numpy.int16)
+    filename = fits_cube(raw * .5 + 10)
+    with fits.open(filename, mode="update") as hdul:
+        hdul[0].scale("int16", bscale=.5, bzero=10.)
+    item = load_image(filename, lazy=lazy)
+    assert isinstance(item.data(), ScaledData)
+    # physical values are written, so BSCALE/BZERO must not be applied again on reading
+    header, saved = _saveAndReload(item, tmp_path)
+    assert header["BITPIX"] == -32 and "BSCALE" not in header and "BZERO" not in header
+    assert numpy.array_equal(saved[0], raw * .5 + 10)
+
+
+def test_save_unsigned_data(fits_cube, load_image, tmp_path):
+    data = numpy.random.default_rng(1).integers(0, 65536, size=(2, 20, 30)).astype(numpy.uint16)
+    item = load_image(fits_cube(data))
+    assert item.data().dtype == numpy.uint16
+    header, saved = _saveAndReload(item, tmp_path)
+    assert header["BITPIX"] == 16 and header["BZERO"] == 32768
+    assert saved.dtype == numpy.uint16 and numpy.array_equal(saved[0], data)
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_nans_are_kept_unmasked(fits_cube, load_image, lazy):
+    data = numpy.random.default_rng(1).normal(size=(2, 40, 60)).astype(numpy.float32)
+    data[0, :10, :] = numpy.nan
+    item = load_image(fits_cube(data), lazy=lazy)
+    assert not numpy.ma.isMA(item.data()) and not numpy.ma.isMA(item.image())
+    assert numpy.array_equal(item.image(), data[0].T, equal_nan=True)
+    # statistics skip the NaNs
+    assert item.imageMinMax() == (numpy.nanmin(data[0]), numpy.nanmax(data[0]))
+    assert item.dataMinMax()[:2] == (numpy.nanmin(data), numpy.nanmax(data))
+    value, undefined = item.imagePixel(5, 5)
+    assert numpy.isnan(value) and undefined
+    assert item.imagePixel(5, 20) == (data[0, 20, 5], False)
+
+
+# (zoomed out further, NaNs are left out of the pyramid averages instead, see test_ImagePyramid)
+@pytest.mark.parametrize("zoom", [.5, 1, 3])
+def test_nans_render_as_zero(fits_cube, load_image, draw_view, zoom):
+    data = numpy.random.default_rng(1).normal(size=(1, 40, 60)).astype(numpy.float32)
+    data[0, :10, :] = numpy.nan
+    item = load_image(fits_cube(data, name="nans.fits"))
+    zeroed = load_image(fits_cube(numpy.nan_to_num(data), name="zeroed.fits"))
+    assert numpy.array_equal(draw_view(item, 120, 80, zoom=zoom), draw_view(zeroed, 120, 80, zoom=zoom))
+
+
+def test_render_dtype(fits_cube, load_image):
+    item = load_image(fits_cube(numpy.zeros((1, 20, 30), numpy.float32)))
+    for dtype in ">f4", "<f4", ">i2", "u1":
+        assert item.renderDtype(numpy.dtype(dtype)) == numpy.float32
+    for dtype in ">f8", ">i4":
+        assert item.renderDtype(numpy.dtype(dtype)) == numpy.float64
+    item.setRenderPrecision("double")
+    assert item.renderDtype(numpy.dtype(">f4")) == numpy.float64
+
+
+@pytest.mark.parametrize("zoom", [.2, 1.5, 4])
+def test_single_precision_render(fits_cube, load_image, draw_view, zoom):
+    data = numpy.random.default_rng(1).normal(size=(1, 300, 400)).astype(numpy.float32)
+    filename = fits_cube(data)
+    single, double = load_image(filename), load_image(filename)
+    double.setRenderPrecision("double")
+    dtypes = {}
+    for item in single, double:
+        dtypes[item] = types = set()
+        for cache in item._cache_interp_tiles, item._cache_prefilter, item._cache_pyramid:
+            def put(key, value, nbytes=None, put=cache.put, types=types):
+                # (the base level of a pyramid is the image itself)
+                arrays = value._levels[1:] if isinstance(value, ImagePyramid) else [value]
+                types.update(array.dtype for array in arrays if array is not False)
+                return put(key, value, nbytes)
+
+            cache.put = put
+    argb = draw_view(single, 300, 200, zoom=zoom)
+    assert dtypes[single] == {numpy.dtype(numpy.float32)}
+    # single precision looks no different, give or take rounding at the odd level boundary
+    assert numpy.abs(_channels(argb) - _channels(draw_view(double, 300, 200, zoom=zoom))).max() <= 1
+    assert dtypes[double] == {numpy.dtype(numpy.float64)}
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_big_endian_planes_are_paged_in_natively(fits_cube, load_image, lazy):
+    data = numpy.random.default_rng(1).normal(size=(3, 40, 60)).astype(numpy.float32)
+    item = load_image(fits_cube(data), lazy=lazy)
+    # FITS data is big-endian, and is left as it is on disk...
+    assert not item.data().dtype.isnative and item.hasPlaneCache()
+    planes = {}
+    for freq in (0, 1, 2, 0):
+        item.selectSlice(freq, 0)
+        # ...while planes are converted as they are paged into the plane cache
+        assert item.image().dtype.isnative and numpy.array_equal(item.image(), data[freq].T)
+        planes.setdefault(freq, item.image())
+        assert item.image() is planes[freq]
+        image, key, minmax = item.plane((freq, 0))
+        assert image is item.image() and minmax == (data[freq].min(), data[freq].max())
+    assert item.dataMinMax()[:2] == (data.min(), data.max())
+
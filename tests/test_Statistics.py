@@ -0,0 +1,230 @@
+# Copyright (C) 2002-2022
+# The MeqTree Foundation &
+# ASTRON (Netherlands Foundation for Research in Astronomy)
+# P.O.Box 2, 7990 AA Dwingeloo, The Netherlands
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>,
+# or write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""Tests for TigGUI.Images.Statistics"""
+
+import numpy
+import pytest
+
+from TigGUI.Images import Statistics
+from TigGUI.Images.Statistics import HistogramCache, QuantileSketch, chunkHistogram, computeHistogram, computeStats, \
+    nativeOrder, reduceChunks
+
+
+@pytest.mark.parametrize("threads", [False, True])
+@pytest.mark.parametrize("chunk_size", [None, 1000, 999])
+def test_stats_match_numpy(chunk_size, threads):
+    data = numpy.random.default_rng(1).normal(5., 2., size=10007).astype(numpy.float32)
+    stats = computeStats(data, chunk_size=chunk_size, threads=threads)
+    assert stats.count == data.size
+    assert stats.minMax() == (data.min(), data.max())
+    assert (stats.argmin, stats.argmax) == (data.argmin(), data.argmax())
+    assert numpy.isclose(stats.sum, data.sum(dtype=numpy.float64))
+    assert numpy.isclose(stats.mean, data.mean(dtype=numpy.float64))
+    assert numpy.isclose(stats.std, data.std(dtype=numpy.float64))
+
+
+def test_stats_skip_masked_and_nonfinite():
+    data = numpy.random.default_rng(2).normal(size=(50, 40))
+    data[3, 4] = numpy.nan
+    data[5, 6] = numpy.inf
+    mask = numpy.zeros(data.shape, bool)
+    mask[10:20] = True
+    data[12, 7] = 1e6
+    stats = computeStats(data, mask, chunk_size=128)
+    valid = numpy.isfinite(data) & ~mask
+    assert stats.count == valid.sum()
+    assert stats.minMax() == (data[valid].min(), data[valid].max())
+    assert data.ravel()[stats.argmax] == data[valid].max()
+    assert numpy.isclose(stats.mean, data[valid].mean())
+    assert numpy.isclose(stats.std, data[valid].std())
+
+
+def test_stats_of_masked_array():
+    data = numpy.ma.masked_array(numpy.arange(100.), numpy.arange(100) < 10)
+    data[50] = numpy.nan
+    stats = computeStats(data, data.mask, chunk_size=32)
+    assert stats.count == 89 and stats.minMax() == (10, 99) and stats.argmin == 10
+    assert numpy.isclose(stats.mean, numpy.nanmean(data.compressed()))
+
+
+def test_stats_of_big_endian_data():
+    data = numpy.random.default_rng(1).normal(size=10000)
+    swapped = data.astype(">f8")
+    assert nativeOrder(data) is data
+    assert nativeOrder(swapped).dtype.isnative and numpy.array_equal(nativeOrder(swapped), data)
+    stats, reference = computeStats(swapped, chunk_size=1000), computeStats(data, chunk_size=1000)
+    assert (stats.min, stats.max, stats.mean, stats.std) == (reference.min, reference.max, reference.mean, reference.std)
+    assert numpy.array_equal(computeHistogram(swapped, None, -2., 2., 50, chunk_size=1000),
+                             computeHistogram(data, None, -2., 2., 50, chunk_size=1000))
+
+
+def test_stats_of_nothing():
+    stats = computeStats(numpy.full(10, numpy.nan))
+    assert stats.count == 0 and numpy.isnan(stats.min) and numpy.isnan(stats.std)
+    stats = computeStats(numpy.ones(10), numpy.ma.masked_all(10).mask)
+    assert stats.count == 0
+
+
+def test_scaled_stats():
+    raw = numpy.arange(-50, 100, dtype=numpy.int16)
+    stats = computeStats(raw, chunk_size=32).scaled(-.5, 3.)
+    values = raw * -.5 + 3.
+    assert stats.minMax() == (values.min(), values.max())
+    assert (stats.argmin, stats.argmax) == (values.argmin(), values.argmax())
+    assert numpy.isclose(stats.mean, values.mean()) and numpy.isclose(stats.std, values.std())
+
+
+def test_reduce_chunks_merges_in_order():
+    results = []
+    reduceChunks(1000, lambda i0, i1: (i0, i1), results.append, chunk_size=64)
+    assert results == [(i0, min(i0 + 64, 1000)) for i0 in range(0, 1000, 64)]
+
+
+def test_reduce_chunks_can_be_abandoned():
+    def progress(fraction):
+        if fraction > .5:
+            raise RuntimeError("cancelled")
+
+    results = []
+    with pytest.raises(RuntimeError):
+        reduceChunks(1000, lambda i0, i1: i0, results.append, progress=progress, chunk_size=100)
+    assert results == list(range(0, 600, 100))
+
+
+QUANTILES = [0, .0005, .005, .05, .25, .5, .75, .95, .995, .9995, 1]
+
+
+def _rankError(values, sketch):
+    """Returns the max error in the ranks (as fractions of the data) of the sketch quantiles"""
+    values = numpy.sort(values)
+    ranks = numpy.searchsorted(values, sketch.quantile(QUANTILES)) / values.size
+    return abs(ranks - QUANTILES).max()
+
+
+def _heavyTailedData(size, seed=1):
+    rng = numpy.random.default_rng(seed)
+    return numpy.concatenate([rng.normal(0, 1e-3, size), rng.pareto(1., size // 100) * 5])
+
+
+def test_sketch_matches_numpy_quantiles():
+    data = _heavyTailedData(100000)
+    sketch = QuantileSketch.fromValues(data)
+    assert len(sketch.means) < QuantileSketch.Compression
+    assert sketch.count == data.size
+    assert sketch.quantile(0) == data.min() and sketch.quantile(1) == data.max()
+    assert _rankError(data, sketch) < 1e-3
+    # tails are more accurate than the middle
+    tails = numpy.quantile(data, [.0005, .9995])
+    assert numpy.allclose(sketch.quantile([.0005, .9995]), tails, rtol=.01, atol=1e-5)
+
+
+def test_sketch_of_chunked_stats():
+    data = _heavyTailedData(50000, seed=2)
+    data[::1000] = numpy.nan
+    stats = computeStats(data, chunk_size=4096, sketch=True)
+    valid = data[numpy.isfinite(data)]
+    assert stats.sketch.count == valid.size
+    assert _rankError(valid, stats.sketch) < 1e-3
+
+
+def test_sketch_merge_and_serialization():
+    data = _heavyTailedData(40000, seed=3)
+    sketch = QuantileSketch.fromValues(data[:30000]).merge(QuantileSketch.fromValues(data[30000:]))
+    assert _rankError(data, sketch) < 1e-3
+    copy = QuantileSketch.fromArray(sketch.toArray())
+    assert numpy.array_equal(copy.quantile(QUANTILES), sketch.quantile(QUANTILES))
+    assert numpy.isnan(QuantileSketch().quantile(.5))
+
+
+def test_scaled_sketch():
+    data = _heavyTailedData(10000, seed=4)
+    sketch = QuantileSketch.fromValues(data)
+    scaled = sketch.scaled(-2., 1.)
+    assert numpy.allclose(scaled.quantile(QUANTILES), sketch.quantile(QUANTILES)[::-1] * -2. + 1.)
+
+
+def test_histogram_matches_numpy():
+    data = numpy.random.default_rng(1).normal(size=10000)
+    hist = computeHistogram(data, None, -2., 2., 50, chunk_size=1000)
+    assert numpy.array_equal(hist, numpy.histogram(data, 50, (-2., 2.))[0])
+
+
+def test_histogram_of_degenerate_range():
+    data = numpy.full(100, 3.)
+    data[:10] = numpy.nan
+    hist = chunkHistogram(data, None, 3., 3., 10)
+    assert hist.sum() == 90 and hist[0] == 90
+    hist = computeHistogram(data, None, 3., 3., 10, chunk_size=16)
+    assert hist.sum() == 90 and hist[0] == 90
+    cache = HistogramCache(data, None, 3., 3.)
+    assert cache.fullHistogram().sum() == 90
+    assert numpy.isclose(cache.histogram(3., 3.5, 10).sum(), 90)
+
+
+def _noisePlusSources(size=100000, seed=1):
+    """Noise with a few bright sources, so that the noise peak is a small fraction of the data range"""
+    rng = numpy.random.default_rng(seed)
+    data = rng.normal(size=size)
+    data[rng.integers(0, size, 20)] = rng.uniform(100, 1000, 20)
+    return data
+
+
+def test_histogram_cache_of_full_range():
+    data = _noisePlusSources()
+    cache = HistogramCache(data, None, data.min(), data.max())
+    assert numpy.array_equal(cache.fullHistogram(),
+                             numpy.histogram(data, HistogramCache.NumBins, (data.min(), data.max()))[0])
+    # a coarser histogram of the full range is rebinned exactly from it
+    hist = cache.histogram(data.min(), data.max(), 100)
+    assert numpy.allclose(hist, numpy.histogram(data, 100, (data.min(), data.max()))[0])
+    # a supplied full-range histogram is used as is
+    cache = HistogramCache(data, None, data.min(), data.max(), hist=cache.fullHistogram())
+    assert len(cache._histograms) == 1
+
+
+def test_histogram_cache_refines_on_zoom(monkeypatch):
+    data = _noisePlusSources()
+    cache = HistogramCache(data, None, data.min(), data.max())
+    # the noise peak is less than 10 full-range bins wide, so zooming into it computes a finer histogram
+    hist = cache.histogram(-3., 3., 100)
+    assert len(cache._histograms) == 2
+    reference = numpy.histogram(data, 100, (-3., 3.))[0]
+    assert abs(hist.sum() - reference.sum()) < 1 and numpy.abs(hist - reference).max() <= .02 * reference.max()
+    # zooming and panning nearby are served from the cache, without going over the data
+    monkeypatch.setattr(Statistics, "computeHistogram", None)
+    for hmin, hmax in (-2., 2.), (-1., 1.5), (-3.5, 3.5), (0., .5):
+        hist = cache.histogram(hmin, hmax, 100)
+        reference = numpy.histogram(data, 100, (hmin, hmax))[0]
+        assert numpy.abs(hist - reference).max() <= .05 * reference.max() + 1
+    assert len(cache._histograms) == 2
+
+
+def test_histogram_cache_drops_oldest_refinements():
+    data = _noisePlusSources()
+    cache = HistogramCache(data, None, data.min(), data.max())
+    full = cache._histograms[0]
+    centres = numpy.linspace(-3, 3, HistogramCache.MaxRefinements + 4)
+    for centre in centres:
+        cache.histogram(centre - .01, centre + .01, 10)
+    assert len(cache._histograms) == HistogramCache.MaxRefinements + 1
+    assert cache._histograms[0] is full
+    assert cache._histograms[-1][0] < centres[-1] < cache._histograms[-1][1]
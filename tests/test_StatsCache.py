@@ -0,0 +1,76 @@
+# Copyright (C) 2002-2022
+# The MeqTree Foundation &
+# ASTRON (Netherlands Foundation for Research in Astronomy)
+# P.O.Box 2, 7990 AA Dwingeloo, The Netherlands
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>,
+# or write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+"""Tests for TigGUI.Images.StatsCache"""
+
+import os
+import time
+
+import numpy
+
+from TigGUI.Images.Statistics import QuantileSketch
+from TigGUI.Images.StatsCache import StatsCache
+
+
+def _makeCache(tmp_path):
+    image = tmp_path / "image.fits"
+    if not image.exists():
+        image.write_bytes(b"\0" * 2880)
+    return StatsCache(str(image), cachedir=str(tmp_path / "cache"))
+
+
+def test_round_trip(tmp_path):
+    cache = _makeCache(tmp_path)
+    sketch = QuantileSketch.fromValues(numpy.arange(1000.))
+    hist = numpy.arange(10)
+    cache.setMinMax(StatsCache.FULL, (-1., 2.), save=False)
+    cache.setMinMax((3, 0), (0., 1.), save=False)
+    cache.setMeanStd(StatsCache.FULL, .5, .25, save=False)
+    cache.setHistogram(StatsCache.FULL, -1., 2., hist, save=False)
+    cache.setSketch(StatsCache.FULL, sketch)
+    cache = _makeCache(tmp_path)
+    assert cache.getMinMax(StatsCache.FULL) == (-1., 2.)
+    assert cache.getMeanStd(StatsCache.FULL) == (.5, .25)
+    assert numpy.array_equal(cache.getHistogram(StatsCache.FULL, -1., 2., 10), hist)
+    assert cache.getHistogram(StatsCache.FULL, -1., 3., 10) is None
+    assert cache.planeMinMaxes() == {(3, 0): (0., 1.)}
+    loaded = cache.getSketch(StatsCache.FULL)
+    assert numpy.array_equal(loaded.means, sketch.means) and loaded.quantile(.5) == sketch.quantile(.5)
+
+
+def test_stale_cache_is_ignored(tmp_path):
+    cache = _makeCache(tmp_path)
+    cache.setMinMax(StatsCache.FULL, (-1., 2.))
+    image = tmp_path / "image.fits"
+    image.write_bytes(b"\0" * 5760)
+    os.utime(image, ns=(0, 0))
+    assert _makeCache(tmp_path).getMinMax(StatsCache.FULL) is None
+
+
+def test_save_later_batches_writes(tmp_path, monkeypatch):
+    monkeypatch.setattr(StatsCache, "SaveDelay", .1)
+    cache = _makeCache(tmp_path)
+    for i in range(20):
+        cache.setMinMax((i,), (i, i + 1.), save=False)
+        cache.saveLater()
+    assert not os.path.exists(cache.cachefile)
+    time.sleep(.5)
+    assert len(_makeCache(tmp_path).planeMinMaxes()) == 20
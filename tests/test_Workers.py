@@ -0,0 +1,107 @@
+# Copyright (C) 2002-2022
+# The MeqTree Foundation &
+# ASTRON (Netherlands Foundation for Research in Astronomy)
+# P.O.Box 2, 7990 AA Dwingeloo, The Netherlands
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>,
+# or write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+
+"""Tests for TigGUI.Images.Workers"""
+
+import threading
+
+import pytest
+
+from TigGUI.Images.Workers import BackgroundJob, getThreadPool
+
+
+def _connect(job):
+    """Connects to the signals of a job. Returns a list which receives (signal name, args) tuples."""
+    events = []
+    job.progress.connect(lambda fraction, message: events.append(("progress", fraction, message)))
+    job.finished.connect(lambda result: events.append(("finished", result)))
+    job.failed.connect(lambda message: events.append(("failed", message)))
+    job.cancelled.connect(lambda: events.append(("cancelled",)))
+    return events
+
+
+def _ended(events):
+    return bool(events) and events[-1][0] in ("finished", "failed", "cancelled")
+
+
+def test_job_reports_progress_and_result(wait_for):
+    def double(job, value, scale=1):
+        job.setProgress(.5, "halfway")
+        return value * 2 * scale
+
+    job = BackgroundJob(double, 21, scale=1, description="double")
+    events = _connect(job)
+    job.start()
+    wait_for(lambda: _ended(events))
+    assert events == [("progress", .5, "halfway"), ("finished", 42)]
+    assert job.isDone() and not job.isCancelled()
+
+
+def test_job_failure(wait_for):
+    def fail(job):
+        raise ValueError("no such file")
+
+    job = BackgroundJob(fail)
+    events = _connect(job)
+    job.start()
+    wait_for(lambda: _ended(events))
+    assert events == [("failed", "no such file")]
+
+
+def test_job_cancelled_while_running(wait_for):
+    started, cancelled = threading.Event(), threading.Event()
+
+    def work(job):
+        started.set()
+        cancelled.wait(10)
+        job.setProgress(.5)
+        return "result"
+
+    job = BackgroundJob(work)
+    events = _connect(job)
+    job.start()
+    assert started.wait(10)
+    job.cancel()
+    cancelled.set()
+    wait_for(lambda: _ended(events))
+    assert events == [("cancelled",)]
+
+
+def test_job_cancelled_before_starting(wait_for):
+    # occupy a single-threaded pool, so that the job is queued
+    pool = getThreadPool("test-workers", 1)
+    release = threading.Event()
+    pool.submit(release.wait, 10)
+    calls = []
+    job = BackgroundJob(lambda job: calls.append(job))
+    events = _connect(job)
+    job.start(pool)
+    job.cancel()
+    release.set()
+    wait_for(lambda: _ended(events))
+    pool.submit(lambda: None).result()
+    assert events == [("cancelled",)] and calls == []
+
+
+def test_thread_pools_are_shared_by_name():
+    assert getThreadPool("test-shared", 2) is getThreadPool("test-shared")
+    assert getThreadPool("test-shared") is not getThreadPool("test-other", 1)